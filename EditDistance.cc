@@ -26,8 +26,11 @@
  */
 
 #include "Assertions.hh"
+#include "Types.hh"
+#include <climits>
 #include <vector>
 #include <iostream>
+#include <string>
 
 struct Hyp {
     int cost;
@@ -124,3 +127,332 @@ PyObject *python_align(PyObject *self, PyObject *args) {
   return result;
 }
 
+
+/**
+ * Unit cost edit distance between sequences of integer symbol ids.
+ *
+ * The cost of the current row is kept in a single vector, and back
+ * pointers, if requested, in one contiguous table of
+ * (len(a) + 1) * (len(b) + 1) steps.  Ties are resolved as in
+ * python_align, so both yield the same alignment.
+ */
+class SymbolAligner {
+public:
+    typedef std::vector<int> Symbols;
+    enum Step { match, deletion, insertion };
+private:
+    std::vector<int> row_;
+    std::vector<u8> steps_;
+    size_t width_;
+public:
+    /**
+     * @return the edit distance, and remember the back pointers if
+     * shouldTrace.  Without traceback the computation is abandoned
+     * and bound is returned once the distance cannot be below bound.
+     */
+    int align(const Symbols &a, const Symbols &b, bool shouldTrace, int bound = INT_MAX) {
+        size_t la = a.size(), lb = b.size();
+        if (!shouldTrace && int((la > lb) ? la - lb : lb - la) >= bound)
+            return bound;
+        row_.resize(lb + 1);
+        if (shouldTrace) {
+            width_ = lb + 1;
+            steps_.resize((la + 1) * width_);
+        }
+        for (size_t j = 0; j <= lb; ++j) {
+            row_[j] = j;
+            if (shouldTrace) steps_[j] = insertion;
+        }
+        for (size_t i = 1; i <= la; ++i) {
+            int diagonal = row_[0];
+            row_[0] = i;
+            u8 *steps = (shouldTrace) ? &steps_[i * width_] : 0;
+            if (steps) steps[0] = deletion;
+            int ai = a[i-1];
+            int rowMinimum = row_[0];
+            for (size_t j = 1; j <= lb; ++j) {
+                int above = row_[j];
+                int c = row_[j-1] + 1;
+                u8 step = insertion;
+                if (above + 1 < c) {
+                    c = above + 1;
+                    step = deletion;
+                }
+                int d = diagonal + ((ai == b[j-1]) ? 0 : 1);
+                if (d < c) {
+                    c = d;
+                    step = match;
+                }
+                diagonal = above;
+                row_[j] = c;
+                if (steps) steps[j] = step;
+                if (c < rowMinimum) rowMinimum = c;
+            }
+            if (!steps && rowMinimum >= bound)
+                return bound;
+        }
+        return row_[lb];
+    }
+
+    /**
+     * @return the index of the first of references closest to
+     * candidate, and set errors to its distance.  The search stops
+     * at the first exact match.  If shouldTrace, the back pointers
+     * of the winner are kept.
+     */
+    size_t closest(const std::vector<Symbols> &references, const Symbols &candidate,
+                   bool shouldTrace, int &errors) {
+        require(references.size() > 0);
+        size_t best = 0;
+        errors = INT_MAX;
+        for (size_t r = 0; r < references.size() && errors > 0; ++r) {
+            int e = align(references[r], candidate, false, errors);
+            if (e < errors) {
+                errors = e;
+                best = r;
+            }
+        }
+        if (shouldTrace)
+            align(references[best], candidate, true);
+        return best;
+    }
+
+    /** Steps of the last traced alignment of sequences of the given lengths, last step first. */
+    template <class Visitor>
+    void traceback(size_t la, size_t lb, Visitor &visit) const {
+        size_t i = la, j = lb;
+        while (i > 0 || j > 0) {
+            u8 step = steps_[i * width_ + j];
+            visit(step, i, j);
+            if (step != insertion) --i;
+            if (step != deletion)  --j;
+        }
+    }
+
+    struct EditCounter {
+        int nInsertions, nDeletions, nSubstitutions;
+        const Symbols &a, &b;
+        EditCounter(const Symbols &_a, const Symbols &_b) :
+            nInsertions(0), nDeletions(0), nSubstitutions(0), a(_a), b(_b) {}
+        void operator() (u8 step, size_t i, size_t j) {
+            if (step == insertion)
+                ++nInsertions;
+            else if (step == deletion)
+                ++nDeletions;
+            else if (a[i-1] != b[j-1])
+                ++nSubstitutions;
+        }
+        PyObject *asPyObject(int errors) const {
+            return Py_BuildValue("(iiii)", errors, nInsertions, nDeletions, nSubstitutions);
+        }
+    };
+
+    struct AlignmentBuilder {
+        PyObject *alignment;
+        const Symbols &a, &b;
+        AlignmentBuilder(const Symbols &_a, const Symbols &_b) :
+            alignment(PyList_New(0)), a(_a), b(_b) {}
+        void operator() (u8 step, size_t i, size_t j) {
+            PyObject *p;
+            if (step == insertion)
+                p = Py_BuildValue("(Oi)", Py_None, b[j-1]);
+            else if (step == deletion)
+                p = Py_BuildValue("(iO)", a[i-1], Py_None);
+            else
+                p = Py_BuildValue("(ii)", a[i-1], b[j-1]);
+            PyList_Append(alignment, p); Py_DECREF(p);
+        }
+    };
+};
+
+/** @return false and set a Python exception on failure */
+static bool symbolIdsFromPyObject(PyObject *obj, SymbolAligner::Symbols &result) {
+    if (PyObject_CheckBuffer(obj)) {
+        // fast path for array('i') and other int buffers
+        Py_buffer view;
+        if (PyObject_GetBuffer(obj, &view, PyBUF_CONTIG_RO | PyBUF_FORMAT) == 0) {
+            const char *format = view.format ? view.format : "B";
+            if (*format == '@' || *format == '=') ++format;
+            bool matches = (view.itemsize == sizeof(int)) && (std::string(format) == "i");
+            if (matches) {
+                const int *data = static_cast<const int*>(view.buf);
+                result.assign(data, data + view.len / sizeof(int));
+            }
+            PyBuffer_Release(&view);
+            if (matches) return true;
+        } else {
+            PyErr_Clear();
+        }
+    }
+    PyObject *seq = PySequence_Fast(obj, "not a sequence");
+    if (!seq) return false;
+    Py_ssize_t length = PySequence_Fast_GET_SIZE(seq);
+    result.resize(length);
+    for (Py_ssize_t i = 0; i < length; ++i) {
+        long id = PyLong_AsLong(PySequence_Fast_GET_ITEM(seq, i));
+        if (id == -1 && PyErr_Occurred()) {
+            Py_DECREF(seq);
+            return false;
+        }
+        result[i] = id;
+    }
+    Py_DECREF(seq);
+    return true;
+}
+
+/** alignSymbols(a, b) -> (alignment, errors), like align() but for symbol ids */
+PyObject *python_alignSymbols(PyObject *self, PyObject *args) {
+    PyObject *pa = 0, *pb = 0;
+    if (!PyArg_ParseTuple(args, "OO", &pa, &pb)) return NULL;
+    SymbolAligner::Symbols a, b;
+    if (!symbolIdsFromPyObject(pa, a) || !symbolIdsFromPyObject(pb, b)) return NULL;
+    SymbolAligner aligner;
+    int errors = aligner.align(a, b, true);
+    SymbolAligner::AlignmentBuilder builder(a, b);
+    aligner.traceback(a.size(), b.size(), builder);
+    PyList_Reverse(builder.alignment);
+    return Py_BuildValue("(Ni)", builder.alignment, errors);
+}
+
+/** editDistance(a, b) -> errors, without traceback */
+PyObject *python_editDistance(PyObject *self, PyObject *args) {
+    PyObject *pa = 0, *pb = 0;
+    if (!PyArg_ParseTuple(args, "OO", &pa, &pb)) return NULL;
+    SymbolAligner::Symbols a, b;
+    if (!symbolIdsFromPyObject(pa, a) || !symbolIdsFromPyObject(pb, b)) return NULL;
+    SymbolAligner aligner;
+    return Py_BuildValue("i", aligner.align(a, b, false));
+}
+
+/** editCounts(a, b) -> (errors, insertions, deletions, substitutions) */
+PyObject *python_editCounts(PyObject *self, PyObject *args) {
+    PyObject *pa = 0, *pb = 0;
+    if (!PyArg_ParseTuple(args, "OO", &pa, &pb)) return NULL;
+    SymbolAligner::Symbols a, b;
+    if (!symbolIdsFromPyObject(pa, a) || !symbolIdsFromPyObject(pb, b)) return NULL;
+    SymbolAligner aligner;
+    int errors = aligner.align(a, b, true);
+    SymbolAligner::EditCounter counter(a, b);
+    aligner.traceback(a.size(), b.size(), counter);
+    return counter.asPyObject(errors);
+}
+
+/**
+ * editDistances(pairs, counts=False) -> list of editDistance(a, b),
+ * or of editCounts(a, b) if counts is true, for each (a, b) in pairs
+ */
+PyObject *python_editDistances(PyObject *self, PyObject *args) {
+    PyObject *pairs = 0;
+    int shouldCount = 0;
+    if (!PyArg_ParseTuple(args, "O|i", &pairs, &shouldCount)) return NULL;
+    PyObject *seq = PySequence_Fast(pairs, "not a sequence");
+    if (!seq) return NULL;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    PyObject *result = PyList_New(n);
+    SymbolAligner aligner;
+    SymbolAligner::Symbols a, b;
+    for (Py_ssize_t k = 0; k < n; ++k) {
+        PyObject *pa = 0, *pb = 0;
+        PyObject *pair = PySequence_Fast_GET_ITEM(seq, k);
+        if (!PyTuple_Check(pair))
+            PyErr_SetString(PyExc_TypeError, "not a tuple of size 2");
+        if (PyErr_Occurred() || !PyArg_ParseTuple(pair, "OO", &pa, &pb) ||
+            !symbolIdsFromPyObject(pa, a) || !symbolIdsFromPyObject(pb, b)) {
+            Py_DECREF(result);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        int errors = aligner.align(a, b, shouldCount);
+        PyObject *item;
+        if (shouldCount) {
+            SymbolAligner::EditCounter counter(a, b);
+            aligner.traceback(a.size(), b.size(), counter);
+            item = counter.asPyObject(errors);
+        } else {
+            item = Py_BuildValue("i", errors);
+        }
+        PyList_SET_ITEM(result, k, item);
+    }
+    Py_DECREF(seq);
+    return result;
+}
+
+/** @return false and set a Python exception on failure */
+static bool referencesFromPyObject(PyObject *obj, std::vector<SymbolAligner::Symbols> &result) {
+    PyObject *seq = PySequence_Fast(obj, "not a sequence");
+    if (!seq) return false;
+    Py_ssize_t length = PySequence_Fast_GET_SIZE(seq);
+    if (length == 0) {
+        Py_DECREF(seq);
+        PyErr_SetString(PyExc_ValueError, "no references");
+        return false;
+    }
+    result.resize(length);
+    for (Py_ssize_t i = 0; i < length; ++i) {
+        if (!symbolIdsFromPyObject(PySequence_Fast_GET_ITEM(seq, i), result[i])) {
+            Py_DECREF(seq);
+            return false;
+        }
+    }
+    Py_DECREF(seq);
+    return true;
+}
+
+/**
+ * alignClosest(references, candidate) -> (index, alignment, errors)
+ * for the first of references with the fewest errors
+ */
+PyObject *python_alignClosest(PyObject *self, PyObject *args) {
+    PyObject *pr = 0, *pc = 0;
+    if (!PyArg_ParseTuple(args, "OO", &pr, &pc)) return NULL;
+    std::vector<SymbolAligner::Symbols> references;
+    SymbolAligner::Symbols candidate;
+    if (!referencesFromPyObject(pr, references) || !symbolIdsFromPyObject(pc, candidate))
+        return NULL;
+    SymbolAligner aligner;
+    int errors;
+    size_t index = aligner.closest(references, candidate, true, errors);
+    SymbolAligner::AlignmentBuilder builder(references[index], candidate);
+    aligner.traceback(references[index].size(), candidate.size(), builder);
+    PyList_Reverse(builder.alignment);
+    return Py_BuildValue("(nNi)", Py_ssize_t(index), builder.alignment, errors);
+}
+
+/**
+ * closestEditCounts(items) -> list of (index, errors, insertions,
+ * deletions, substitutions) for the first of references with the
+ * fewest errors, for each (references, candidate) in items
+ */
+PyObject *python_closestEditCounts(PyObject *self, PyObject *args) {
+    PyObject *items = 0;
+    if (!PyArg_ParseTuple(args, "O", &items)) return NULL;
+    PyObject *seq = PySequence_Fast(items, "not a sequence");
+    if (!seq) return NULL;
+    Py_ssize_t n = PySequence_Fast_GET_SIZE(seq);
+    PyObject *result = PyList_New(n);
+    SymbolAligner aligner;
+    std::vector<SymbolAligner::Symbols> references;
+    SymbolAligner::Symbols candidate;
+    for (Py_ssize_t k = 0; k < n; ++k) {
+        PyObject *pr = 0, *pc = 0;
+        PyObject *item = PySequence_Fast_GET_ITEM(seq, k);
+        if (!PyTuple_Check(item))
+            PyErr_SetString(PyExc_TypeError, "not a tuple of size 2");
+        if (PyErr_Occurred() || !PyArg_ParseTuple(item, "OO", &pr, &pc) ||
+            !referencesFromPyObject(pr, references) ||
+            !symbolIdsFromPyObject(pc, candidate)) {
+            Py_DECREF(result);
+            Py_DECREF(seq);
+            return NULL;
+        }
+        int errors;
+        size_t index = aligner.closest(references, candidate, true, errors);
+        SymbolAligner::EditCounter counter(references[index], candidate);
+        aligner.traceback(references[index].size(), candidate.size(), counter);
+        PyList_SET_ITEM(result, k, Py_BuildValue(
+            "(niiii)", Py_ssize_t(index), errors,
+            counter.nInsertions, counter.nDeletions, counter.nSubstitutions));
+    }
+    Py_DECREF(seq);
+    return result;
+}
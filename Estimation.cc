@@ -35,6 +35,7 @@ using std::unordered_map;
 using std::tr1::unordered_map;
 #endif
 
+#include <algorithm>
 #include <vector>
 #include <stdexcept>
 #include <memory>
@@ -158,43 +159,179 @@ class EvidenceStore {
     };
 
   private:
+    friend class SequenceModelEstimator;
     typedef unordered_map<Event, Probability, Event::Hash> Store;
     Store evidence_;
 
     const SequenceModel *sequenceModel_;
+    bool acceptsAnonymized_;
+    LogProbability threshold_;
 
   public:
-    EvidenceStore() : sequenceModel_(0) {}
+    EvidenceStore() : sequenceModel_(0), acceptsAnonymized_(false), threshold_(LogProbability::impossible()) {}
 
     void setSequenceModel(SequenceModel *sm) {
       sequenceModel_ = sm;
     }
 
+    /** Anonymized multigrams must never enter training, but their
+     * posteriors are needed for the gradient of the devel likelihood. */
+    void setAcceptAnonymized(bool accept) {
+      acceptsAnonymized_ = accept;
+    }
+
+    /** Contributions below @c threshold are credited to the back-off
+     * history instead of creating an event of their own.  This keeps
+     * the mass, but not the fractional paths, of unlikely segmentations. */
+    void setThreshold(double threshold) {
+      threshold_ = (threshold > 0.0) ? LogProbability(Probability(threshold)) : LogProbability::impossible();
+    }
+
     void accumulate(
         SequenceModel::History history,
         SequenceModel::Token token,
         LogProbability evidence)
     {
-      require(token != MultigramInventory::voidIndex()); // don't accumulate with anonymized unknowns!
+      require(acceptsAnonymized_ || token != MultigramInventory::voidIndex()); // don't accumulate with anonymized unknowns!
       Event ev;
       ev.history = history;
       ev.token   = token;
+      if (evidence < threshold_) {
+        while (evidence_.find(ev) == evidence_.end() && sequenceModel_->shortened(ev.history))
+          ev.history = sequenceModel_->shortened(ev.history);
+      }
       evidence_[ev] += evidence;
     }
 
+    /** Remove events with evidence below @c minimum.  Their evidence is
+     * moved to the back-off history, deepest histories first, so that
+     * only events of the empty history are actually discarded.
+     * @return number of events removed */
+    u32 prune(double minimum) {
+      const Probability threshold(minimum);
+      u32 nRemoved = 0;
+      std::vector<std::pair<Event, Probability> > folded;
+      for (u32 length = maximumHistoryLength(); ; --length) {
+        folded.clear();
+        for (Store::iterator ev = evidence_.begin(); ev != evidence_.end();) {
+          if (ev->second < threshold && sequenceModel_->historyLength(ev->first.history) == length) {
+            folded.push_back(*ev);
+            ev = evidence_.erase(ev);
+            ++nRemoved;
+          } else {
+            ++ev;
+          }
+        }
+        if (length == 0) break;
+        for (u32 i = 0; i < folded.size(); ++i) {
+          Event e = folded[i].first;
+          e.history = sequenceModel_->shortened(e.history);
+          Store::iterator ev = evidence_.find(e);
+          if (ev == evidence_.end()) {
+            evidence_.insert(std::make_pair(e, folded[i].second));
+            --nRemoved;
+          } else {
+            ev->second += folded[i].second;
+          }
+        }
+      }
+      evidence_.rehash(0);
+      return nRemoved;
+    }
+
+    /** Replace the evidence by @c weight times itself plus
+     * @c otherWeight times the evidence in @c other.  Events are carried
+     * over to the histories of the sequence model of @c other. */
+    void interpolate(double weight, const EvidenceStore &other, double otherWeight) {
+      require(weight >= 0.0 && otherWeight >= 0.0);
+      Store result;
+      std::vector<SequenceModel::Token> history;
+      if (weight > 0.0) {
+        for (Store::const_iterator ev = evidence_.begin(); ev != evidence_.end(); ++ev) {
+          Event e = ev->first;
+          if (sequenceModel_ != other.sequenceModel_) {
+            sequenceModel_->historyAsVector(e.history, history);
+            e.history = other.sequenceModel_->historyFromVector(history);
+          }
+          result[e] += ev->second * Probability(weight);
+        }
+      }
+      if (otherWeight > 0.0) {
+        for (Store::const_iterator ev = other.evidence_.begin(); ev != other.evidence_.end(); ++ev)
+          result[ev->first] += ev->second * Probability(otherWeight);
+      }
+      evidence_.swap(result);
+      sequenceModel_ = other.sequenceModel_;
+    }
+
+  private:
+    PyObject *eventAsTuple(Store::const_iterator ev) const {
+      return Py_BuildValue("(Nif)",
+          sequenceModel_->historyAsTuple(ev->first.history),
+          int(ev->first.token),
+          ev->second.probability());
+    }
+
+    struct MoreEvident {
+      bool operator() (Store::const_iterator a, Store::const_iterator b) const {
+        if (a->second > b->second) return true;
+        if (b->second > a->second) return false;
+        return a->first.token > b->first.token;
+      }
+    };
+
+    struct LessEvident {
+      bool operator() (Store::const_iterator a, Store::const_iterator b) const {
+        return MoreEvident()(b, a);
+      }
+    };
+
+    typedef std::vector<Store::const_iterator> EventList;
+
+    /** The first @c limit events according to @c Ordering. */
+    template <class Ordering>
+    EventList firstEvents(u32 limit) const {
+      EventList events;
+      events.reserve(evidence_.size());
+      for (Store::const_iterator ev = evidence_.begin(); ev != evidence_.end(); ++ev)
+        events.push_back(ev);
+      if (limit < events.size()) {
+        std::partial_sort(events.begin(), events.begin() + limit, events.end(), Ordering());
+        events.resize(limit);
+      } else {
+        std::sort(events.begin(), events.end(), Ordering());
+      }
+      return events;
+    }
+
+    PyObject *eventsAsList(const EventList &events) const {
+      PyObject *result = PyList_New(events.size());
+      for (u32 i = 0; i < events.size(); ++i)
+        PyList_SET_ITEM(result, i, eventAsTuple(events[i]));
+      return result;
+    }
+
+  public:
     PyObject *asList() const {
       PyObject *result = PyList_New(evidence_.size());
       u32 i = 0;
-      for (Store::const_iterator ev = evidence_.begin(); ev != evidence_.end(); ++ev) {
-        PyObject *hte = Py_BuildValue("(Nif)",
-            sequenceModel_->historyAsTuple(ev->first.history),
-            int(ev->first.token),
-            ev->second.probability());
-        PyList_SET_ITEM(result, i++, hte);
-      }
+      for (Store::const_iterator ev = evidence_.begin(); ev != evidence_.end(); ++ev)
+        PyList_SET_ITEM(result, i++, eventAsTuple(ev));
       return result;
     }
 
+    /** The @c limit events with the highest evidence, in order of decreasing evidence. */
+    PyObject *mostEvident(u32 limit) const {
+      return eventsAsList(firstEvents<MoreEvident>(limit));
+    }
+
+    /** The @c limit events with the lowest evidence, in order of decreasing evidence. */
+    PyObject *leastEvident(u32 limit) const {
+      EventList events(firstEvents<LessEvident>(limit));
+      std::reverse(events.begin(), events.end());
+      return eventsAsList(events);
+    }
+
     size_t size() const {
       return evidence_.size();
     }
@@ -219,7 +356,9 @@ class EvidenceStore {
       return result;
     }
 
-    SequenceModelEstimator *makeSequenceModelEstimator() const;
+    /** Estimator for this evidence, which uses @c nThreads threads
+     * (zero meaning one per processor core). */
+    SequenceModelEstimator *makeSequenceModelEstimator(u32 nThreads = 1) const;
 
     size_t memoryUsed() const {
 #if defined(__GXX_EXPERIMENTAL_CXX0X__) || (__cplusplus >= 201103L) || (__APPLE__) || (_MSC_VER)
@@ -628,6 +767,82 @@ class EstimationGraphBuilder :
       eg->updateProbabilities(sequenceModel_);
     }
 
+    /**
+     * Add every multigram that build() may encounter for the given
+     * sample to the inventory.  Positions are visited in a fixed
+     * order, so the resulting multigram indices do not depend on the
+     * order in which the graphs are built afterwards.
+     */
+    void registerMultigrams(const Sequence &left, const Sequence &right) {
+      u32 width = right.size() + 1;
+      std::vector<bool> isReachable((left.size() + 1) * width, false);
+      isReachable[0] = true;
+      for (u32 l = 0; l <= left.size(); ++l) {
+        for (u32 r = 0; r <= right.size(); ++r) {
+          if (!isReachable[l * width + r]) continue;
+          for (SizeTemplateList::const_iterator st = sizeTemplates_.begin(); st != sizeTemplates_.end(); ++st) {
+            u32 nl = l + st->left, nr = r + st->right;
+            if (nl > left.size() || nr > right.size()) continue;
+            inventory_->index(JointMultigram(
+                    left.data()  + l, left.data()  + nl,
+                    right.data() + r, right.data() + nr));
+            isReachable[nl * width + nr] = true;
+          }
+        }
+      }
+    }
+
+    /**
+     * Build graphs for many samples using nThreads threads (zero
+     * meaning one per processor core).  Each thread uses its own
+     * builder, while the multigram inventory is extended serially
+     * beforehand, so the result does not depend on the number of
+     * threads.  Samples that have no segmentation yield a null
+     * pointer.
+     */
+    void createMany(
+        const std::vector<Sequence> &lefts,
+        const std::vector<Sequence> &rights,
+        std::vector<EstimationGraph*> &result,
+        u32 nThreads)
+    {
+      require(lefts.size() == rights.size());
+      nThreads = Core::numberOfThreads(nThreads);
+
+      MultigramEmergenceMode workerEmergence = multigramEmergence_;
+      if (multigramEmergence_ == emergeNewMultigrams) {
+        for (size_t i = 0; i < lefts.size(); ++i)
+          registerMultigrams(lefts[i], rights[i]);
+        workerEmergence = suppressNewMultigrams;
+      }
+
+      std::vector<EstimationGraphBuilder> workers(nThreads, *this);
+      for (u32 t = 0; t < nThreads; ++t)
+        workers[t].multigramEmergence_ = workerEmergence;
+
+      result.assign(lefts.size(), 0);
+      struct Job {
+        std::vector<EstimationGraphBuilder> &workers;
+        const std::vector<Sequence> &lefts, &rights;
+        std::vector<EstimationGraph*> &result;
+        void operator() (u32 thread, size_t i) {
+          try {
+            result[i] = workers[thread].create(lefts[i], rights[i]);
+          } catch (const std::runtime_error &e) {
+            if (std::string(e.what()) != "final node not reachable") throw;
+          }
+        }
+      } job = { workers, lefts, rights, result };
+      try {
+        Core::parallelFor(lefts.size(), nThreads, job);
+      } catch (...) {
+        for (size_t i = 0; i < result.size(); ++i)
+          delete result[i];
+        result.clear();
+        throw;
+      }
+    }
+
     size_t memoryUsed() const {
 #if defined(__GXX_EXPERIMENTAL_CXX0X__) || (__cplusplus >= 201103L) || (__APPLE__) || (_MSC_VER)
       struct NodeStateMapNode { typename NodeStateMap::value_type value; bool cond;};
@@ -673,35 +888,95 @@ class SequenceModelEstimator {
     };
     typedef std::vector<Item> ItemList;
 
+    static const u32 noGroup = 0xffffffff;
+
     struct Group {
+      SequenceModel::History history;
       struct { ItemList::iterator begin, end; } items;
       Probability total;
       Probability backOffWeight;
-      Group() : total() {}
+      LogProbability *backOffWeightParameter;
+      u32 index;   /**< position in groups */
+      u32 shorter; /**< index of the group of the shortened history, or noGroup */
+      Group() : history(0), total(), backOffWeightParameter(0), index(0), shorter(noGroup) {}
     };
 
-    typedef unordered_map<SequenceModel::History, Group, Core::conversion<SequenceModel::History, size_t> > GroupStore;
+    /** Groups of items by history, sorted by history like the items. */
+    typedef std::vector<Group> GroupStore;
 
     const SequenceModel *sequenceModel_;
     ItemList items;
     Item::Ordering itemOrdering;
     Item::TokenOrdering itemTokenOrdering;
     GroupStore groups;
-    std::vector<std::vector<SequenceModel::History> > historiesByLength;
+    /** Indices of the groups by history length.  Within each length,
+     * groups sharing the same shorter history are adjacent, and
+     * families[length] holds the positions where a new shorter
+     * history begins, followed by the end.  Discounting a family
+     * touches no items of any other family of the same length, so
+     * families are processed in parallel. */
+    std::vector<std::vector<u32> > groupsByLength, families;
+    u32 nThreads_;
+
+    /** In-place re-estimation: the model last built by makeSkeleton()
+     * and pointers to its parameters, parallel to @c items. */
+    const SequenceModel *skeleton_;
+    u32 skeletonRevision_;
+    std::vector<LogProbability*> probabilityParameters_;
+    typedef unordered_map<SequenceModel::History, SequenceModel::History, Core::conversion<SequenceModel::History, size_t> > HistoryMap;
+    HistoryMap skeletonHistories_; /**< skeleton history -> own history */
+
+    /** Derivatives of item probabilities, group totals and back-off
+     * weights with respect to the discounts, nGradient_ values each.
+     * Only updateSequenceModel() maintains them. */
+    u32 nGradient_;
+    std::vector<double> itemGradient_, totalGradient_, backOffWeightGradient_;
+    size_t gradientIndex(ItemList::const_iterator i) const {
+      return (i - items.begin()) * nGradient_;
+    }
+    size_t gradientIndex(const Group &g) const {
+      return g.index * nGradient_;
+    }
 
+    const Group &group(SequenceModel::History) const;
     void init(const SequenceModel*);
     void reset();
     void doKneserNeyDiscounting(const std::vector<double> &discounts);
+    void discountGroup(u32 level, Group &g, Probability discount, std::vector<double> &dShare);
     void computeProbabilities(double vocabularySize);
+    void interpolateGroup(Group &g, Probability zeroGramProbability,
+                          std::vector<double> &dSum, std::vector<double> &dLowerOrder);
+    void makeSkeleton(SequenceModel *target);
+    Probability backOffWeightOf(const Group&, SequenceModel::History) const;
+    Probability probability(SequenceModel::Token, SequenceModel::History, double *gradient) const;
   public:
+    SequenceModelEstimator() :
+      sequenceModel_(0), nThreads_(1), skeleton_(0), skeletonRevision_(0), nGradient_(0) {}
+
     void makeSequenceModel(
         SequenceModel *target,
         double vocabularySize,
         const std::vector<double> &discounts);
+
+    /** Like makeSequenceModel(), but if @c target was built by a
+     * previous call, only its probabilities and back-off weights are
+     * rewritten.  The model contains an explicit entry for every
+     * event, so its size differs from makeSequenceModel(), while its
+     * probabilities are the same. */
+    void updateSequenceModel(
+        SequenceModel *target,
+        double vocabularySize,
+        const std::vector<double> &discounts);
+
+    /** Gradient of the log-likelihood with respect to the discounts,
+     * given the @c posteriors of all events under the model written by
+     * the last call to updateSequenceModel(). */
+    std::vector<double> logLikGradient(const EvidenceStore &posteriors) const;
 };
 
-SequenceModelEstimator *EvidenceStore::makeSequenceModelEstimator() const {
+SequenceModelEstimator *EvidenceStore::makeSequenceModelEstimator(u32 nThreads) const {
   SequenceModelEstimator *sme = new SequenceModelEstimator();
+  sme->nThreads_ = Core::numberOfThreads(nThreads);
 
   sme->items.clear();
   SequenceModelEstimator::Item item;
@@ -734,6 +1009,7 @@ void SequenceModelEstimator::makeSequenceModel(
     double vocabularySize,
     const std::vector<double> &discounts)
 {
+  nGradient_ = 0;
   reset();
   doKneserNeyDiscounting(discounts);
   computeProbabilities(vocabularySize);
@@ -747,13 +1023,13 @@ void SequenceModelEstimator::makeSequenceModel(
 #endif
   std::vector<SequenceModel::Token> history;
   for (GroupStore::const_iterator g = groups.begin(); g != groups.end(); ++g) {
-    sequenceModel_->historyAsVector(g->first, history);
+    sequenceModel_->historyAsVector(g->history, history);
     std::reverse(history.begin(), history.end());
     data.get()->setHistory(&*history.begin(), &*history.end());
 
-    if (g->second.backOffWeight != Probability(1.0))
-      data->addBackOffWeight(g->second.backOffWeight);
-    for (ItemList::const_iterator i = g->second.items.begin; i != g->second.items.end; ++i) {
+    if (g->backOffWeight != Probability(1.0))
+      data->addBackOffWeight(g->backOffWeight);
+    for (ItemList::const_iterator i = g->items.begin; i != g->items.end; ++i) {
       if (i->probability > Probability(0.0))
         data->addProbability(i->token, i->probability);
     }
@@ -762,95 +1038,229 @@ void SequenceModelEstimator::makeSequenceModel(
   target->set(&*data);
 }
 
+void SequenceModelEstimator::makeSkeleton(SequenceModel *target) {
+#if defined(__GXX_EXPERIMENTAL_CXX0X__) || (__cplusplus >= 201103L) || (__APPLE__) || (_MSC_VER)
+  std::shared_ptr<SequenceModel::InitData> data(new SequenceModel::InitData);
+#else
+  std::auto_ptr<SequenceModel::InitData> data(new SequenceModel::InitData);
+#endif
+  std::vector<SequenceModel::Token> history;
+  for (GroupStore::const_iterator g = groups.begin(); g != groups.end(); ++g) {
+    sequenceModel_->historyAsVector(g->history, history);
+    std::reverse(history.begin(), history.end());
+    data.get()->setHistory(&*history.begin(), &*history.end());
+    data->addBackOffWeight(LogProbability::certain());
+    for (ItemList::const_iterator i = g->items.begin; i != g->items.end; ++i)
+      data->addProbability(i->token, LogProbability::certain());
+  }
+  target->setInitAndTerm(sequenceModel_->init(), sequenceModel_->term());
+  target->set(&*data);
+
+  probabilityParameters_.resize(items.size());
+  skeletonHistories_.clear();
+  for (GroupStore::iterator g = groups.begin(); g != groups.end(); ++g) {
+    sequenceModel_->historyAsVector(g->history, history);
+    SequenceModel::History th = target->historyFromVector(history);
+    verify(target->historyLength(th) == history.size());
+    skeletonHistories_[th] = g->history;
+    g->backOffWeightParameter = target->backOffWeightParameter(th);
+    for (ItemList::const_iterator i = g->items.begin; i != g->items.end; ++i) {
+      LogProbability *p = target->probabilityParameter(th, i->token);
+      verify(p);
+      probabilityParameters_[i - items.begin()] = p;
+    }
+  }
+  skeleton_ = target;
+  skeletonRevision_ = target->revision();
+}
+
+/** The back-off weight as stored by makeSequenceModel(), which omits
+ * weights of one, leaving the defaults of SequenceModel in place. */
+Probability SequenceModelEstimator::backOffWeightOf(const Group &g, SequenceModel::History history) const {
+  if (g.backOffWeight != Probability(1.0))
+    return g.backOffWeight;
+  return (sequenceModel_->historyLength(history) == 0) ?
+    Probability::impossible() : Probability::certain();
+}
+
+namespace {
+  /** product rule: (p, dp) *= (q, dq) */
+  inline void multiplyWithGradient(
+      Probability &p, double *dp, Probability q, const double *dq, u32 n)
+  {
+    if (dp) {
+      for (u32 k = 0; k < n; ++k)
+        dp[k] = dp[k] * q.probability() + ((dq) ? p.probability() * dq[k] : 0.0);
+    }
+    p *= q;
+  }
+}
+
+/** The probability SequenceModel::probability() yields for @c token
+ * after @c history in the model written by makeSequenceModel(), i.e.
+ * backing off over events with zero probability.  If @c gradient is
+ * given, the derivatives with respect to the discounts are stored
+ * there. */
+Probability SequenceModelEstimator::probability(
+    SequenceModel::Token token, SequenceModel::History history, double *gradient) const
+{
+  Item item;
+  item.token = token;
+  Probability result(1.0);
+  if (gradient) std::fill(gradient, gradient + nGradient_, 0.0);
+  for (u32 gi = group(history).index; gi != noGroup; gi = groups[gi].shorter) {
+    const Group &g(groups[gi]);
+    ItemList::const_iterator i = std::lower_bound(g.items.begin, g.items.end, item, itemTokenOrdering);
+    if (i != g.items.end && i->token == token && i->probability > Probability(0.0)) {
+      multiplyWithGradient(result, gradient, i->probability,
+          (gradient) ? &itemGradient_[gradientIndex(i)] : 0, nGradient_);
+      return result;
+    }
+    bool isDefault = (g.backOffWeight == Probability(1.0));
+    multiplyWithGradient(result, gradient, backOffWeightOf(g, g.history),
+        (gradient && !isDefault) ? &backOffWeightGradient_[gradientIndex(g)] : 0, nGradient_);
+  }
+  return result;
+}
+
+std::vector<double> SequenceModelEstimator::logLikGradient(const EvidenceStore &posteriors) const {
+  require(nGradient_ > 0);
+  require(posteriors.sequenceModel_ == skeleton_);
+  std::vector<double> result(nGradient_, 0.0), gradient(nGradient_);
+  for (EvidenceStore::Store::const_iterator ev = posteriors.evidence_.begin(); ev != posteriors.evidence_.end(); ++ev) {
+    HistoryMap::const_iterator h = skeletonHistories_.find(ev->first.history);
+    verify(h != skeletonHistories_.end());
+    Probability p = probability(ev->first.token, h->second, &gradient[0]);
+    if (!(p > Probability(0.0))) continue;
+    double weight = ev->second.probability() / p.probability();
+    for (u32 k = 0; k < nGradient_; ++k)
+      result[k] += weight * gradient[k];
+  }
+  return result;
+}
+
+void SequenceModelEstimator::updateSequenceModel(
+    SequenceModel *target,
+    double vocabularySize,
+    const std::vector<double> &discounts)
+{
+  nGradient_ = discounts.size();
+  reset();
+  doKneserNeyDiscounting(discounts);
+  computeProbabilities(vocabularySize);
+
+  if (target != skeleton_ || target->revision() != skeletonRevision_)
+    makeSkeleton(target);
+
+  for (GroupStore::const_iterator g = groups.begin(); g != groups.end(); ++g)
+    *g->backOffWeightParameter = backOffWeightOf(*g, g->history);
+  for (ItemList::const_iterator i = items.begin(); i != items.end(); ++i) {
+    *probabilityParameters_[i - items.begin()] = (i->probability > Probability(0.0)) ?
+      LogProbability(i->probability) : LogProbability(probability(i->token, i->history, 0));
+  }
+  target->touch();
+  skeletonRevision_ = target->revision();
+}
+
+namespace {
+  struct HistoryOrdering {
+    template <class Group>
+    bool operator() (const Group &g, SequenceModel::History h) const {
+      return g.history < h;
+    }
+  };
+}
+
+const SequenceModelEstimator::Group &SequenceModelEstimator::group(SequenceModel::History h) const {
+  GroupStore::const_iterator g = std::lower_bound(groups.begin(), groups.end(), h, HistoryOrdering());
+  verify(g != groups.end() && g->history == h);
+  return *g;
+}
+
 void SequenceModelEstimator::init(const SequenceModel *sm) {
   require(items.size() > 0);
 
   sequenceModel_ = sm;
 
-  std::sort(items.begin(), items.end(), itemOrdering);
+  Core::parallelSort(items.begin(), items.end(), itemOrdering, nThreads_);
 
   groups.clear();
-  historiesByLength.clear();
   Group ng;
-  ItemList::iterator &i(ng.items.begin);
-  i = items.begin();
-  GroupStore::iterator g = groups.insert(std::make_pair(i->history, ng)).first;
-  for (++i; i != items.end(); ++i) {
-    if (i->history != g->first) {
-      g->second.items.end = i;
-      g = groups.insert(std::make_pair(i->history, ng)).first;
+  for (ItemList::iterator i = items.begin(); i != items.end(); ++i) {
+    if (groups.empty() || i->history != groups.back().history) {
+      if (!groups.empty()) groups.back().items.end = i;
+      ng.history = i->history;
+      ng.items.begin = i;
+      ng.index = groups.size();
+      groups.push_back(ng);
     }
   }
-  g->second.items.end = items.end();
+  groups.back().items.end = items.end();
+
+  groupsByLength.clear();
+  for (GroupStore::iterator g = groups.begin(); g != groups.end(); ++g) {
+    SequenceModel::History shorterHistory = sequenceModel_->shortened(g->history);
+    if (shorterHistory)
+      g->shorter = group(shorterHistory).index;
+    u32 hl = sequenceModel_->historyLength(g->history);
+    if (hl >= groupsByLength.size()) groupsByLength.resize(hl+1);
+    groupsByLength[hl].push_back(g->index);
+  }
 
-  for (GroupStore::const_iterator g = groups.begin(); g != groups.end(); ++g) {
-    u32 hl = sequenceModel_->historyLength(g->first);
-    if (hl >= historiesByLength.size()) historiesByLength.resize(hl+1);
-    historiesByLength[hl].push_back(g->first);
+  families.assign(groupsByLength.size(), std::vector<u32>());
+  for (u32 level = 0; level < groupsByLength.size(); ++level) {
+    std::vector<u32> &gl(groupsByLength[level]);
+    std::vector<std::pair<u32, u32> > byShorter(gl.size());
+    for (u32 k = 0; k < gl.size(); ++k)
+      byShorter[k] = std::make_pair(groups[gl[k]].shorter, gl[k]);
+    std::sort(byShorter.begin(), byShorter.end());
+    for (u32 k = 0; k < gl.size(); ++k) {
+      gl[k] = byShorter[k].second;
+      if (k == 0 || byShorter[k].first != byShorter[k-1].first)
+        families[level].push_back(k);
+    }
+    families[level].push_back(gl.size());
   }
 }
 
 void SequenceModelEstimator::reset() {
   for (ItemList::iterator i = items.begin(); i != items.end(); ++i)
     i->probability = i->evidence;
+  itemGradient_.assign(items.size() * nGradient_, 0.0);
+  totalGradient_.assign(groups.size() * nGradient_, 0.0);
+  backOffWeightGradient_.assign(groups.size() * nGradient_, 0.0);
 }
 
 void SequenceModelEstimator::doKneserNeyDiscounting(const std::vector<double> &discounts) {
-  require(historiesByLength.size() > 0);
-  require(discounts.size() >= historiesByLength.size());
-  for (u32 level = historiesByLength.size()-1; level > 0; --level) {
+  require(groupsByLength.size() > 0);
+  require(discounts.size() >= groupsByLength.size());
+  std::vector<std::vector<double> > dShare(nThreads_, std::vector<double>(nGradient_));
+  for (u32 level = groupsByLength.size()-1; level > 0; --level) {
     Probability discount(discounts[level]);
-    std::vector<SequenceModel::History>::const_iterator h, h_end = historiesByLength[level].end();
-    for (h = historiesByLength[level].begin(); h != h_end; ++h) {
-      SequenceModel::History history = *h;
-      SequenceModel::History shorterHistory = sequenceModel_->shortened(history);
-      Group &g(groups[history]);
-      verify_(groups.find(shorterHistory) != groups.end());
-      Group &sg(groups[shorterHistory]);
-      Probability sum;
-      ItemList::iterator si = sg.items.begin;
-      for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
-#if 0 // DEBUG
-        std::cout << __FILE__ << ":" << __LINE__ << "\t"
-          << i - items.begin() << "\t"
-          << "(" << sequenceModel_->formatHistory(i->history) << ")\t"
-          << i->token << "\t"
-          << i->probability.probability() << std::endl;
-#endif
-        Item sItem = *i;
-        sum += i->probability;
-        if (i->probability > discount) {
-          i->probability -= discount;
-          sItem.probability = discount;
-        } else {
-          i->probability = Probability(0.0);
-        }
-        verify_(si != sg.items.end); while (itemTokenOrdering(*si, sItem)) {
-          ++si;
-#if 0 // DEBUG
-          std::cout << __FILE__ << ":" << __LINE__ << "\t"
-            << si - items.begin() << "\t"
-            << "(" << sequenceModel_->formatHistory(si->history) << ")\t"
-            << si->token << "\t"
-            << si->probability.probability() << std::endl;
-#endif
-          verify_(si != sg.items.end);
-        }
-        verify(si->token == sItem.token);
-        si->probability += sItem.probability;
-      }
-      g.total = sum;
-    }
+    const std::vector<u32> &gl(groupsByLength[level]), &fl(families[level]);
+    auto discountFamily = [&](u32 thread, size_t f) {
+      for (u32 k = fl[f]; k < fl[f+1]; ++k)
+        discountGroup(level, groups[gl[k]], discount, dShare[thread]);
+    };
+    Core::parallelFor(fl.size() - 1, nThreads_, discountFamily);
   }
   u32 level = 0;
   Probability discount(discounts[level]);
-  std::vector<SequenceModel::History>::const_iterator h, h_end = historiesByLength[level].end();
-  for (h = historiesByLength[level].begin(); h != h_end; ++h) {
-    SequenceModel::History history = *h;
-    Group &g(groups[history]);
+  std::vector<u32>::const_iterator h, h_end = groupsByLength[level].end();
+  for (h = groupsByLength[level].begin(); h != h_end; ++h) {
+    Group &g(groups[*h]);
     Probability sum;
     for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
       sum += i->probability;
+      if (nGradient_) {
+        double *di = &itemGradient_[gradientIndex(i)];
+        double *dTotal = &totalGradient_[gradientIndex(g)];
+        for (u32 k = 0; k < nGradient_; ++k) dTotal[k] += di[k];
+        if (i->probability > discount)
+          di[level] -= 1.0;
+        else
+          std::fill(di, di + nGradient_, 0.0);
+      }
       if (i->probability > discount) {
         i->probability -= discount;
       } else {
@@ -861,61 +1271,149 @@ void SequenceModelEstimator::doKneserNeyDiscounting(const std::vector<double> &d
   }
 }
 
+/** Discount the items of @c g and pass the discounted mass on to the
+ * items of the shorter history. */
+void SequenceModelEstimator::discountGroup(
+    u32 level, Group &g, Probability discount, std::vector<double> &dShare)
+{
+  verify_(g.shorter != noGroup);
+  Group &sg(groups[g.shorter]);
+  Probability sum;
+  double *dTotal = (nGradient_) ? &totalGradient_[gradientIndex(g)] : 0;
+  ItemList::iterator si = sg.items.begin;
+  for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
+    Item sItem = *i;
+    sum += i->probability;
+    if (nGradient_) {
+      double *di = &itemGradient_[gradientIndex(i)];
+      for (u32 k = 0; k < nGradient_; ++k) dTotal[k] += di[k];
+      if (i->probability > discount) {
+        std::fill(dShare.begin(), dShare.end(), 0.0);
+        dShare[level] = 1.0;
+        di[level] -= 1.0;
+      } else {
+        std::copy(di, di + nGradient_, dShare.begin());
+        std::fill(di, di + nGradient_, 0.0);
+      }
+    }
+    if (i->probability > discount) {
+      i->probability -= discount;
+      sItem.probability = discount;
+    } else {
+      i->probability = Probability(0.0);
+    }
+    verify_(si != sg.items.end); while (itemTokenOrdering(*si, sItem)) { ++si; verify_(si != sg.items.end); }
+    verify(si->token == sItem.token);
+    si->probability += sItem.probability;
+    if (nGradient_) {
+      double *dsi = &itemGradient_[gradientIndex(si)];
+      for (u32 k = 0; k < nGradient_; ++k) dsi[k] += dShare[k];
+    }
+  }
+  g.total = sum;
+}
+
 void SequenceModelEstimator::computeProbabilities(double vocabularySize) {
   // compute probabilities with interpolation
   Probability zeroGramProbability(1.0 / vocabularySize);
+  std::vector<std::vector<double> >
+    dSum(nThreads_, std::vector<double>(nGradient_)),
+    dLowerOrder(nThreads_, std::vector<double>(nGradient_));
+
+  // groups only depend on groups of shorter histories
+  for (u32 level = 0; level < groupsByLength.size(); ++level) {
+    const std::vector<u32> &gl(groupsByLength[level]);
+    auto interpolate = [&](u32 thread, size_t k) {
+      interpolateGroup(groups[gl[k]], zeroGramProbability, dSum[thread], dLowerOrder[thread]);
+    };
+    Core::parallelFor(gl.size(), nThreads_, interpolate);
+  }
+}
 
-  for (u32 level = 0; level < historiesByLength.size(); ++level) {
-    std::vector<SequenceModel::History>::const_iterator h, h_end = historiesByLength[level].end();
-    for (h = historiesByLength[level].begin(); h != h_end; ++h) {
-      SequenceModel::History history = *h;
-      Group &g(groups[history]);
-
-      Probability sum(0.0);
-      for (ItemList::const_iterator i = g.items.begin; i != g.items.end; ++i)
-        sum += i->probability;
-      if (sum > g.total) {
-        g.backOffWeight = Probability(0.0);
-      } else if (sum <= Probability(0.0)) {
-        g.backOffWeight = Probability(1.0);
-      } else {
-        g.backOffWeight = (sum / g.total).complement();
-      }
+void SequenceModelEstimator::interpolateGroup(
+    Group &g, Probability zeroGramProbability,
+    std::vector<double> &dSum, std::vector<double> &dLowerOrder)
+{
+  Probability sum(0.0);
+  for (ItemList::const_iterator i = g.items.begin; i != g.items.end; ++i)
+    sum += i->probability;
+  if (sum > g.total) {
+    g.backOffWeight = Probability(0.0);
+  } else if (sum <= Probability(0.0)) {
+    g.backOffWeight = Probability(1.0);
+  } else {
+    g.backOffWeight = (sum / g.total).complement();
+  }
 
-      SequenceModel::History shorterHistory = sequenceModel_->shortened(history);
-      if (shorterHistory == 0) {
-        g.backOffWeight *= zeroGramProbability;
-        for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
-          if (i->probability == Probability(0.0)) continue;
-          i->probability = i->probability / g.total + g.backOffWeight;
-        }
+  // derivatives by the quotient rule, d(p / total) = (dp - (p / total) dtotal) / total,
+  // not over total^2, which underflows for groups of tiny evidence
+  double total = g.total.probability();
+  double *dTotal = 0, *dBackOffWeight = 0;
+  if (nGradient_) {
+    dTotal = &totalGradient_[gradientIndex(g)];
+    dBackOffWeight = &backOffWeightGradient_[gradientIndex(g)];
+    std::fill(dSum.begin(), dSum.end(), 0.0);
+    for (ItemList::const_iterator i = g.items.begin; i != g.items.end; ++i) {
+      const double *di = &itemGradient_[gradientIndex(i)];
+      for (u32 k = 0; k < nGradient_; ++k) dSum[k] += di[k];
+    }
+    bool isConstant = (sum > g.total) || (sum <= Probability(0.0));
+    for (u32 k = 0; k < nGradient_; ++k)
+      dBackOffWeight[k] = (isConstant) ? 0.0 :
+        - (dSum[k] - sum.probability() / total * dTotal[k]) / total;
+  }
+
+  if (g.shorter == noGroup) {
+    g.backOffWeight *= zeroGramProbability;
+    for (u32 k = 0; k < nGradient_; ++k)
+      dBackOffWeight[k] *= zeroGramProbability.probability();
+    for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
+      if (i->probability == Probability(0.0)) continue;
+      if (nGradient_) {
+        double *di = &itemGradient_[gradientIndex(i)];
+        for (u32 k = 0; k < nGradient_; ++k)
+          di[k] = (di[k] - i->probability.probability() / total * dTotal[k]) / total
+            + dBackOffWeight[k];
+      }
+      i->probability = i->probability / g.total + g.backOffWeight;
+    }
+  } else {
+    const Group &sg(groups[g.shorter]);
+    ItemList::const_iterator si = sg.items.begin;
+    for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
+      if (i->probability == Probability(0.0)) continue;
+      Probability pLowerOrder;
+      double *dLower = (nGradient_) ? &dLowerOrder[0] : 0;
+      verify_(si != sg.items.end); while (itemTokenOrdering(*si, *i)) { ++si; verify_(si != sg.items.end); }
+      verify_(si->token == i->token);
+      if (si->probability > Probability(0.0)) {
+        pLowerOrder = si->probability;
+        if (dLower) std::copy(&itemGradient_[gradientIndex(si)], &itemGradient_[gradientIndex(si)] + nGradient_, dLower);
       } else {
-        const Group &sg(groups[shorterHistory]);
-        ItemList::const_iterator si = sg.items.begin;
-        for (ItemList::iterator i = g.items.begin; i != g.items.end; ++i) {
-          if (i->probability == Probability(0.0)) continue;
-          Probability pLowerOrder;
-          verify_(si != sg.items.end); while (itemTokenOrdering(*si, *i)) { ++si; verify_(si != sg.items.end); }
-          verify_(si->token == i->token);
-          if (si->probability > Probability(0.0)) {
-            pLowerOrder = si->probability;
-          } else {
-            pLowerOrder = sg.backOffWeight;
-            for (SequenceModel::History boh = sequenceModel_->shortened(shorterHistory); boh; boh = sequenceModel_->shortened(boh)) {
-              Group &bog(groups[boh]);
-              ItemList::const_iterator boi = std::lower_bound(bog.items.begin, bog.items.end, *i, itemTokenOrdering);
-              verify_(boi != bog.items.end && boi->token == i->token);
-              if (boi->probability > Probability(0.0)) {
-                pLowerOrder *= boi->probability;
-                break;
-              }
-              pLowerOrder *= bog.backOffWeight;
-            }
+        pLowerOrder = sg.backOffWeight;
+        if (dLower) std::copy(&backOffWeightGradient_[gradientIndex(sg)], &backOffWeightGradient_[gradientIndex(sg)] + nGradient_, dLower);
+        for (u32 bo = sg.shorter; bo != noGroup; bo = groups[bo].shorter) {
+          const Group &bog(groups[bo]);
+          ItemList::const_iterator boi = std::lower_bound(bog.items.begin, bog.items.end, *i, itemTokenOrdering);
+          verify_(boi != bog.items.end && boi->token == i->token);
+          if (boi->probability > Probability(0.0)) {
+            multiplyWithGradient(pLowerOrder, dLower, boi->probability,
+                (dLower) ? &itemGradient_[gradientIndex(boi)] : 0, nGradient_);
+            break;
           }
-
-          i->probability = i->probability / g.total + g.backOffWeight * pLowerOrder;
+          multiplyWithGradient(pLowerOrder, dLower, bog.backOffWeight,
+              (dLower) ? &backOffWeightGradient_[gradientIndex(bog)] : 0, nGradient_);
         }
       }
-    } // for (h)
-  } // for (level)
+
+      if (nGradient_) {
+        double *di = &itemGradient_[gradientIndex(i)];
+        for (u32 k = 0; k < nGradient_; ++k)
+          di[k] = (di[k] - i->probability.probability() / total * dTotal[k]) / total
+            + dBackOffWeight[k] * pLowerOrder.probability()
+            + g.backOffWeight.probability() * dLower[k];
+      }
+      i->probability = i->probability / g.total + g.backOffWeight * pLowerOrder;
+    }
+  }
 }
@@ -27,7 +27,10 @@ commercially. In any case guarantee/warranty shall be limited to gross
 negligent actions or intended actions or fraudulent concealment.
 """
 
-from sequitur_ import align
+import io
+import multiprocessing
+from sequitur_ import alignClosest, closestEditCounts
+from symbols import SymbolInventory
 
 try:
     unicode
@@ -37,9 +40,24 @@ except NameError:
 
 
 class Result:
-    def __init__(self, name=None, tableFile=None, print_header=False):
+    counters = (
+        "nStringsTranslated",
+        "nStringsFailed",
+        "nSymbolsTranslated",
+        "nSymbolsFailed",
+        "nInsertions",
+        "nDeletions",
+        "nSubstitutions",
+        "nStringErrors",
+    )
+
+    def __init__(self, name=None, tableFile=None, print_header=False, keepRows=False):
         self.name = name
         self.tableFile = tableFile
+        if keepRows:
+            self.rows = []  # table rows kept for a later merge
+        else:
+            self.rows = None
         self.nStringsTranslated = 0
         self.nStringsFailed = 0
         self.nSymbolsTranslated = 0
@@ -78,34 +96,44 @@ class Result:
         return u"\t".join(row)
 
     def accu(self, source, reference, candidate, alignment, errors, weight=1):
-        self.nStringsTranslated += weight
-        if errors > 0:
-            self.nStringErrors += weight
-            nStringErrors = weight
-        else:
-            nStringErrors = 0
-        nSymbols = len(reference) * weight
-        self.nSymbolsTranslated += nSymbols
-
         nInsertions = 0
         nDeletions = 0
         nSubstitutions = 0
         for ss, rr in alignment:
             if ss is None:
                 assert rr is not None
-                nInsertions += weight
+                nInsertions += 1
             elif rr is None:
                 assert ss is not None
-                nDeletions += weight
+                nDeletions += 1
             elif ss == rr:
                 pass
             else:
-                nSubstitutions += weight
+                nSubstitutions += 1
+        self.accuCounts(
+            source, reference, errors, nInsertions, nDeletions, nSubstitutions, weight
+        )
+
+    def accuCounts(
+        self, source, reference, errors, nInsertions, nDeletions, nSubstitutions, weight=1
+    ):
+        self.nStringsTranslated += weight
+        if errors > 0:
+            self.nStringErrors += weight
+            nStringErrors = weight
+        else:
+            nStringErrors = 0
+        nSymbols = len(reference) * weight
+        self.nSymbolsTranslated += nSymbols
+
+        nInsertions *= weight
+        nDeletions *= weight
+        nSubstitutions *= weight
         self.nInsertions += nInsertions
         self.nDeletions += nDeletions
         self.nSubstitutions += nSubstitutions
 
-        if self.tableFile:
+        if self.tableFile or self.rows is not None:
             row = self.build_row(
                 False,
                 source=source,
@@ -116,12 +144,30 @@ class Result:
                 nSubstitutions=nSubstitutions,
                 nStringErrors=nStringErrors,
             )
-            print(row, file=self.tableFile)
+            if self.tableFile:
+                print(row, file=self.tableFile)
+            else:
+                self.rows.append(row)
 
     def accuFailure(self, reference, weight=1):
         self.nStringsFailed += weight
         self.nSymbolsFailed += len(reference) * weight
 
+    def merge(self, other):
+        """
+        Add the counts of other, a result on different sources, and
+        append its table rows after those of self.
+        """
+        for counter in self.counters:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        if other.rows:
+            if self.tableFile:
+                for row in other.rows:
+                    print(row, file=self.tableFile)
+            elif self.rows is not None:
+                self.rows.extend(other.rows)
+        return self
+
     def relativeCount(self, n, total):
         if total:
             return "%d (%1.2f%%)" % (n, 100.0 * float(n) / float(total))
@@ -202,16 +248,71 @@ class Evaluator(object):
     resultFile = None
     compareFilter = None
     verboseLog = None
+    shardsPerJob = 4
 
     def setSample(self, sample):
         self.sources, self.references = collateSample(sample)
 
-    def evaluate(self, translator):
+    def evaluate(self, translator, jobs=1):
+        """
+        Translate all sources and compare them to their references.
+        With jobs > 1 (or 0 for one per processor), contiguous shards
+        of the sources are evaluated by that many worker processes,
+        which need a picklable translator.  Their results are merged
+        in order, so the outcome is the same as evaluating serially.
+        The largest stack usage of the workers is passed to the
+        translator's noteStackUsage(), if it has one.
+        """
+        if jobs == 0:
+            jobs = multiprocessing.cpu_count()
+        if jobs <= 1 or len(self.sources) <= 1:
+            result = Result(tableFile=self.resultFile)
+            self.evaluateSources(translator, self.sources, result, self.verboseLog)
+            return result
+
+        nShards = min(jobs * self.shardsPerJob, len(self.sources))
+        bounds = [len(self.sources) * i // nShards for i in range(nShards + 1)]
+        tasks = [
+            (
+                self.sources[bounds[i] : bounds[i + 1]],
+                self.resultFile is not None,
+                self.verboseLog is not None,
+            )
+            for i in range(nShards)
+        ]
+        worker = Evaluator()
+        worker.references = self.references
+        worker.compareFilter = self.compareFilter
+
         result = Result(tableFile=self.resultFile)
-        for source in self.sources:
+        stackUsage = 0
+        pool = multiprocessing.Pool(jobs, _initializeWorker, (worker, translator))
+        try:
+            for shardResult, log, shardStackUsage in pool.imap(_evaluateShard, tasks):
+                result.merge(shardResult)
+                if self.verboseLog:
+                    self.verboseLog.write(log)
+                stackUsage = max(stackUsage, shardStackUsage)
+        finally:
+            pool.close()
+            pool.join()
+        if hasattr(translator, "noteStackUsage"):
+            translator.noteStackUsage(stackUsage)
+        return result
+
+    def evaluateSources(self, translator, sources, result, verboseLog):
+        """
+        Among several references of a source, the candidate is
+        compared to the one with the fewest errors, the first in
+        sorted order on ties.
+        """
+        if not verboseLog:
+            return self.countErrors(translator, sources, result)
+        inventory = SymbolInventory()
+        for source in sources:
             references = self.references[source]
             if self.compareFilter:
-                references = map(self.compareFilter, references)
+                references = list(map(self.compareFilter, references))
 
             try:
                 candidate = translator(source)
@@ -222,15 +323,79 @@ class Evaluator(object):
             if self.compareFilter:
                 candidate = self.compareFilter(candidate)
 
-            eval = []
-            for reference in references:
-                alignment, errors = align(reference, candidate)
-                eval.append((errors, reference, alignment))
-            eval.sort()
-            errors, reference, alignment = eval[0]
+            references = sorted(references)
+            index, alignment, errors = alignClosest(
+                [inventory.parse(reference) for reference in references],
+                inventory.parse(candidate),
+            )
+            reference = references[index]
+            symbol = lambda ind: None if ind is None else inventory.symbol(ind)
+            alignment = [(symbol(ss), symbol(rr)) for ss, rr in alignment]
 
             result.accu(source, reference, candidate, alignment, errors)
-            if self.verboseLog:
-                showAlignedResult(source, alignment, errors, self.verboseLog)
+            showAlignedResult(source, alignment, errors, verboseLog)
+
+    def countErrors(self, translator, sources, result):
+        """
+        Like evaluateSources() without a verbose log.  Symbols are
+        mapped to integer ids and all (references, candidate) items
+        are scored by a single call to closestEditCounts(), which
+        counts the edit operations without building the alignments.
+        """
+        inventory = SymbolInventory()
+        translated = []
+        items = []
+        for source in sources:
+            references = self.references[source]
+            if self.compareFilter:
+                references = list(map(self.compareFilter, references))
 
-        return result
+            try:
+                candidate = translator(source)
+            except translator.TranslationFailure:
+                result.accuFailure(references[0])
+                continue
+
+            if self.compareFilter:
+                candidate = self.compareFilter(candidate)
+
+            references = sorted(references)
+            items.append(
+                (
+                    [inventory.parse(reference) for reference in references],
+                    inventory.parse(candidate),
+                )
+            )
+            translated.append((source, references))
+
+        counts = closestEditCounts(items)
+        for (source, references), (index, errors, nIns, nDel, nSub) in zip(
+            translated, counts
+        ):
+            result.accuCounts(source, references[index], errors, nIns, nDel, nSub)
+
+
+_worker = None
+
+
+def _initializeWorker(evaluator, translator):
+    global _worker
+    _worker = evaluator, translator
+
+
+def _evaluateShard(task):
+    sources, shouldKeepRows, shouldKeepLog = task
+    evaluator, translator = _worker
+    result = Result(keepRows=shouldKeepRows)
+    if shouldKeepLog:
+        log = io.StringIO()
+    else:
+        log = None
+    evaluator.evaluateSources(translator, sources, result, log)
+    if hasattr(translator, "stackUsage"):
+        stackUsage = translator.stackUsage()
+    else:
+        stackUsage = 0
+    if log is not None:
+        return result, log.getvalue(), stackUsage
+    return result, "", stackUsage
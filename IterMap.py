@@ -96,6 +96,85 @@ def mergeSort(seqs):
             heapq.heappop(queue)
 
 
+class LoserTree(object):
+    """
+    Merge of sorted sequences of (key, value) items by a tournament
+    tree.  Each inner node holds the loser of the match played there,
+    and the overall winner is kept apart, so that replacing the winner
+    replays the matches along a single leaf-to-root path, one
+    comparison per level.  Items with equal keys come in the order of
+    the sequences.
+    """
+
+    exhausted = object()
+
+    def __init__(self, seqs):
+        self.iters = [iter(s) for s in seqs]
+        self.heads = [next(it, self.exhausted) for it in self.iters]
+        k = len(self.iters)
+        self.losers = [None] * max(k, 1)
+        winners = [None] * k + list(range(k))
+        for node in range(k - 1, 0, -1):
+            a, b = winners[2 * node], winners[2 * node + 1]
+            if self.beats(a, b):
+                winners[node], self.losers[node] = a, b
+            else:
+                winners[node], self.losers[node] = b, a
+        if k == 0:
+            self.winner = None
+        elif k == 1:
+            self.winner = 0
+        else:
+            self.winner = winners[1]
+
+    def beats(self, i, j):
+        a, b = self.heads[i], self.heads[j]
+        if a is self.exhausted:
+            return False
+        if b is self.exhausted:
+            return True
+        return a[0] < b[0] or (a[0] == b[0] and i < j)
+
+    def __iter__(self):
+        if self.winner is None:
+            return
+        k = len(self.iters)
+        heads, iters, losers = self.heads, self.iters, self.losers
+        exhausted = self.exhausted
+        winner = self.winner
+        while True:
+            item = heads[winner]
+            if item is exhausted:
+                break
+            yield item
+            heads[winner] = next(iters[winner], exhausted)
+            node = (winner + k) // 2
+            while node >= 1:
+                if self.beats(losers[node], winner):
+                    losers[node], winner = winner, losers[node]
+                node //= 2
+        self.winner = winner
+
+
+def mergeConsolidated(seqs):
+    """
+    Merge sorted sequences of (key, value) items with a LoserTree and
+    add up the values of equal keys.
+    """
+    it = iter(LoserTree(seqs))
+    try:
+        key, value = next(it)
+    except StopIteration:
+        return
+    for k, v in it:
+        if k == key:
+            value = value + v
+        else:
+            yield key, value
+            key, value = k, v
+    yield key, value
+
+
 # ---------------------------------------------------------------------------
 def consolidateInPlaceAdd(seq):
     """
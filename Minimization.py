@@ -245,6 +245,84 @@ def directionSetMinimization(
     return current, fCurrent
 
 
+def boundedQuasiNewtonMinimization(
+    fg,
+    initialPoint,
+    lower,
+    upper,
+    tolerance=1.0e-6,
+    stepTolerance=1.0e-8,
+    maxIterations=maxIterations,
+):
+    """
+    Quasi-Newton (BFGS) minimization subject to lower and upper bounds
+    on each variable.  fg(x) must return the function value and its
+    gradient.  Variables sitting on a bound with the gradient pointing
+    outwards are held fixed, and each line search follows the
+    projection of the search direction onto the feasible box.
+    The search stops when no component of the projected gradient
+    exceeds tolerance in absolute value, or when no variable moves by
+    more than stepTolerance relative to max(|x|, 1).
+    inspired from: R. H. Byrd et. al., "A Limited Memory Algorithm for
+    Bound Constrained Optimization", SIAM J. Sci. Comput. 16 (1995)
+    """
+    lower = asarray(lower, dtype=float64)
+    upper = asarray(upper, dtype=float64)
+    current = clip(asarray(initialPoint, dtype=float64), lower, upper)
+    fCurrent, gCurrent = fg(current)
+    gCurrent = asarray(gCurrent, dtype=float64)
+    n = len(current)
+    inverseHessian = None
+    for iteration in range(maxIterations):
+        free = ~(
+            ((current <= lower) & (gCurrent >= 0.0))
+            | ((current >= upper) & (gCurrent <= 0.0))
+        )
+        if not any(free) or max(abs(gCurrent[free])) <= tolerance:
+            break
+        direction = zeros(n)
+        if inverseHessian is not None and all(free == lastFree):
+            direction[free] = -dot(inverseHessian[ix_(free, free)], gCurrent[free])
+        if not dot(direction, gCurrent) < 0.0:
+            # (re)start: largest component of the first move is one
+            inverseHessian = identity(n) / max(abs(gCurrent[free]))
+            direction[free] = -dot(inverseHessian[ix_(free, free)], gCurrent[free])
+            isFresh = True
+        lastFree = free
+
+        step = 1.0
+        for trial in range(40):
+            point = clip(current + step * direction, lower, upper)
+            fPoint, gPoint = fg(point)
+            gPoint = asarray(gPoint, dtype=float64)
+            # points where the gradient is undefined are backed away from
+            if (
+                fPoint <= fCurrent + 1.0e-4 * dot(gCurrent, point - current)
+                and all(isfinite(gPoint))
+            ):
+                break
+            step /= 2
+        else:
+            break
+
+        s = point - current
+        y = gPoint - gCurrent
+        sy = dot(s, y)
+        if sy > 1.0e-10 * sqrt(dot(s, s) * dot(y, y)):
+            if isFresh:
+                # Shanno-Phua scaling of the initial approximation
+                inverseHessian = identity(n) * sy / dot(y, y)
+                isFresh = False
+            v = identity(n) - outer(s, y) / sy
+            inverseHessian = dot(dot(v, inverseHessian), v.T) + outer(s, s) / sy
+
+        isStalled = max(abs(s) / maximum(abs(current), 1.0)) <= stepTolerance
+        current, fCurrent, gCurrent = point, fPoint, gPoint
+        if isStalled:
+            break
+    return current, fCurrent
+
+
 def hasSignificantDecrease(series):
     """
     Determines the slope of a series of values and its standard error.
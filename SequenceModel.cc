@@ -25,6 +25,7 @@
  * negligent actions or intended actions or fraudulent concealment.
  */
 
+#include <algorithm>
 #include <memory>
 #include <stdexcept>
 
@@ -100,8 +101,12 @@ class SequenceModel::Node {
     friend class SequenceModel;
 
     Token token_;  /**< least recent word in history */
-    LogProbability backOffWeight_;
     Depth depth_;  /**< number of words in history */
+    /** Slot of the direct index of high fan-out nodes in
+     * Internal::directIndexOffsets, zero for binary search.  It takes
+     * the padding after depth_, so nodes do not grow. */
+    u16 directIndexSlot_;
+    LogProbability backOffWeight_;
 
     union parent_t {
       Node *finalized;
@@ -111,7 +116,10 @@ class SequenceModel::Node {
     union node_struct_t {
       struct finalized_t {
         Node *firstChild_;
-        WordProbability *firstWordProbability_;
+        union {
+          WordProbability *full;
+          QuantizedWordProbability *quantized;
+        } firstWordProbability_;
       } finalized;
       struct done_t {
         Index firstChild_;
@@ -132,11 +140,16 @@ class SequenceModel::Node {
     const Node *childrenBegin() const { return           node_struct.finalized.firstChild_; }
     const Node *childrenEnd()   const { return (this+1)->node_struct.finalized.firstChild_; }
 
-    const WordProbability *probabilitiesBegin() const { return           node_struct.finalized.firstWordProbability_; }
-    const WordProbability *probabilitiesEnd()   const { return (this+1)->node_struct.finalized.firstWordProbability_; }
+    const WordProbability *probabilitiesBegin() const { return           node_struct.finalized.firstWordProbability_.full; }
+    const WordProbability *probabilitiesEnd()   const { return (this+1)->node_struct.finalized.firstWordProbability_.full; }
+
+    /** Only valid in quantized models. */
+    const QuantizedWordProbability *quantizedProbabilitiesBegin() const { return           node_struct.finalized.firstWordProbability_.quantized; }
+    const QuantizedWordProbability *quantizedProbabilitiesEnd()   const { return (this+1)->node_struct.finalized.firstWordProbability_.quantized; }
 
     const Node *findChild(Token) const;
     const WordProbability *findWordProbability(Token) const;
+    const QuantizedWordProbability *findQuantizedWordProbability(Token) const;
 };
 
 const SequenceModel::Node *SequenceModel::Node::findChild(Token t) const {
@@ -147,6 +160,10 @@ const SequenceModel::WordProbability *SequenceModel::Node::findWordProbability(T
   return binarySearch(probabilitiesBegin(), probabilitiesEnd() - 1, t);
 }
 
+const SequenceModel::QuantizedWordProbability *SequenceModel::Node::findQuantizedWordProbability(Token t) const {
+  return binarySearch(quantizedProbabilitiesBegin(), quantizedProbabilitiesEnd() - 1, t);
+}
+
 
 class SequenceModel::Internal {
   private:
@@ -158,6 +175,39 @@ class SequenceModel::Internal {
     typedef std::vector<WordProbability> WordProbabilities;
     WordProbabilities wordProbabilities;
 
+    /** Quantized models keep their probabilities here instead. */
+    typedef std::vector<QuantizedWordProbability> QuantizedWordProbabilities;
+    QuantizedWordProbabilities quantizedWordProbabilities;
+    std::vector<u8> codes8;    /**< codes if quantizationBits <= 8 */
+    std::vector<u16> codes16;  /**< codes otherwise */
+    std::vector<LogProbability> codebook;
+    u32 quantizationBits;
+
+    /** Direct indices of high fan-out nodes: the first token covered,
+     * the number of tokens covered, and for each of them the position
+     * of the child and of the probability plus one (zero if absent).
+     * Nodes get one if they have at least minDirectIndexFanOut
+     * children or probabilities and the tokens between the first and
+     * the last of them are at most maxDirectIndexSparsity times as
+     * many.  directIndexOffsets maps Node::directIndexSlot_ to the
+     * start of the index in directIndices; slot zero is unused. */
+    std::vector<u32> directIndices;
+    std::vector<u32> directIndexOffsets;
+    static const u32 minDirectIndexFanOut = 32;
+    static const u32 maxDirectIndexSparsity = 4;
+    static const u32 maxDirectIndexSlots = 65535;
+    void buildDirectIndices();
+    static void tokenRange(const Node&, Token &first, Token &last);
+
+    /** @return position plus one in the children (@c table = 0) or
+     * probabilities (@c table = 1) from the direct index, zero if absent */
+    u32 directPosition(const Node *n, Token t, u32 table) const {
+      const u32 *index = &directIndices[directIndexOffsets[n->directIndexSlot_]];
+      u32 i = t - index[0];
+      if (i >= index[1]) return 0;
+      return index[2 + table * index[1] + i];
+    }
+
     struct InitItemOrdering {
       bool operator() (const InitItem &a, const InitItem &b) const {
         if (a.history[0])
@@ -176,12 +226,40 @@ class SequenceModel::Internal {
     void dump(std::ostream&, const StringInventory*) const;
 #endif
     const Node *build(InitItem*, InitItem*);
+    void quantize(u32 bits);
+    void applyCodebook(u32 bits, const std::vector<double> &levels);
+    bool isQuantized() const { return quantizationBits != 0; }
+    LogProbability quantizedProbability(const QuantizedWordProbability *qs) const {
+      size_t i = qs - &quantizedWordProbabilities[0];
+      return codebook[(quantizationBits <= 8) ? codes8[i] : codes16[i]];
+    }
+    size_t nWordProbabilities() const {
+      return (isQuantized() ? quantizedWordProbabilities.size() : wordProbabilities.size()) - 1;
+    }
 
     static const Node *extendHistory(const Node *root, const Node *old, Token w);
     static LogProbability probability(const Node*, Token);
+
+    const Node *findChild(const Node *n, Token t) const {
+      if (!n->directIndexSlot_) return n->findChild(t);
+      u32 position = directPosition(n, t, 0);
+      return (position) ? n->childrenBegin() + position - 1 : 0;
+    }
+    const WordProbability *findWordProbability(const Node *n, Token t) const {
+      if (!n->directIndexSlot_) return n->findWordProbability(t);
+      u32 position = directPosition(n, t, 1);
+      return (position) ? n->probabilitiesBegin() + position - 1 : 0;
+    }
+    const QuantizedWordProbability *findQuantizedWordProbability(const Node *n, Token t) const {
+      if (!n->directIndexSlot_) return n->findQuantizedWordProbability(t);
+      u32 position = directPosition(n, t, 1);
+      return (position) ? n->quantizedProbabilitiesBegin() + position - 1 : 0;
+    }
 };
 
-SequenceModel::Internal::Internal(Node::Index nNodes, Node::Index nWordProbabilities) {
+SequenceModel::Internal::Internal(Node::Index nNodes, Node::Index nWordProbabilities) :
+  quantizationBits(0)
+{
   nodes.reserve(nNodes+1);
   wordProbabilities.reserve(nWordProbabilities);
 }
@@ -194,6 +272,7 @@ const SequenceModel::Node *SequenceModel::Internal::build(InitItem *begin, InitI
   root.backOffWeight_ = LogProbability::impossible();
   root.depth_        = 0;
   root.parent_.init  = Node::invalidIndex;
+  root.directIndexSlot_ = 0;
   root.node_struct.init.begin    = begin;
   root.node_struct.init.end      = end;
   nodes.push_back(root);
@@ -208,6 +287,7 @@ const SequenceModel::Node *SequenceModel::Internal::build(InitItem *begin, InitI
   sentinel.backOffWeight_ = LogProbability::certain(); // phony
   sentinel.depth_        = 0;   // phony
   sentinel.parent_.init  = nodes.size(); // phony
+  sentinel.directIndexSlot_ = 0;
   nodes.push_back(sentinel);
   WordProbability sentinel2;
   wordProbabilities.push_back(sentinel2);
@@ -218,13 +298,65 @@ const SequenceModel::Node *SequenceModel::Internal::build(InitItem *begin, InitI
     Node::Index firstChild     = n->node_struct.done.firstChild_;
     Node::Index firstWordProbability = n->node_struct.done.firstWordProbability_;
     n->node_struct.finalized.firstChild_     = &nodes[firstChild];
-    n->node_struct.finalized.firstWordProbability_ = &wordProbabilities[firstWordProbability];
+    n->node_struct.finalized.firstWordProbability_.full = &wordProbabilities[firstWordProbability];
   }
   nodes[0].parent_.finalized = 0;
+  buildDirectIndices();
 
   return &nodes[0];
 }
 
+/** Smallest and largest token of the children and probabilities of a
+ * node, which must have at least one of them. */
+void SequenceModel::Internal::tokenRange(const Node &n, Token &first, Token &last) {
+  first = Core::Type<Token>::max;
+  last  = 0;
+  if (n.childrenEnd() != n.childrenBegin()) {
+    first = std::min(first, n.childrenBegin()->token());
+    last  = std::max(last, (n.childrenEnd() - 1)->token());
+  }
+  if (n.probabilitiesEnd() != n.probabilitiesBegin()) {
+    first = std::min(first, n.probabilitiesBegin()->token());
+    last  = std::max(last, (n.probabilitiesEnd() - 1)->token());
+  }
+}
+
+void SequenceModel::Internal::buildDirectIndices() {
+  std::vector<std::pair<Node::Index, size_t> > indexed;
+  size_t size = 0;
+  for (Node::Index ni = 0; ni + 1 < nodes.size() && indexed.size() < maxDirectIndexSlots; ++ni) {
+    const Node &n(nodes[ni]);
+    u32 nChildren = n.childrenEnd() - n.childrenBegin();
+    u32 nWords    = n.probabilitiesEnd() - n.probabilitiesBegin();
+    u32 fanOut = std::max(nChildren, nWords);
+    if (fanOut < minDirectIndexFanOut) continue;
+    Token first, last;
+    tokenRange(n, first, last);
+    u32 range = last - first + 1;
+    if (range > maxDirectIndexSparsity * fanOut) continue;
+    indexed.push_back(std::make_pair(ni, size));
+    size += 2 + 2 * range;
+  }
+
+  directIndices.assign(size, 0);
+  directIndexOffsets.assign(indexed.size() + 1, 0);
+  for (u32 k = 0; k < indexed.size(); ++k) {
+    Node &n(nodes[indexed[k].first]);
+    u32 *index = &directIndices[indexed[k].second];
+    Token first, last;
+    tokenRange(n, first, last);
+    u32 range = last - first + 1;
+    index[0] = first;
+    index[1] = range;
+    for (const Node *c = n.childrenBegin(); c != n.childrenEnd(); ++c)
+      index[2 + c->token() - first] = c - n.childrenBegin() + 1;
+    for (const WordProbability *w = n.probabilitiesBegin(); w != n.probabilitiesEnd(); ++w)
+      index[2 + range + w->token() - first] = w - n.probabilitiesBegin() + 1;
+    directIndexOffsets[k + 1] = indexed[k].second;
+    n.directIndexSlot_ = k + 1;
+  }
+}
+
 void SequenceModel::Internal::buildNode(Node::Index ni) {
   Node &n(nodes[ni]);
   InitItem *i = n.node_struct.init.begin, *end = n.node_struct.init.end;
@@ -252,6 +384,7 @@ void SequenceModel::Internal::buildNode(Node::Index ni) {
     nn.depth_          = d;
     nn.token_          = *i->history++;
     nn.backOffWeight_   = LogProbability::certain();
+    nn.directIndexSlot_ = 0;
     nn.node_struct.init.begin      = i++;
     while (i < end && *i->history == nn.token_) { i->history++; ++i; }
     nn.node_struct.init.end        = i;
@@ -259,9 +392,103 @@ void SequenceModel::Internal::buildNode(Node::Index ni) {
   }
 }
 
+/**
+ * Scalar quantization of the scores of all probabilities: The
+ * codebook is initialized with equally populated cells and refined by
+ * Lloyd's algorithm, which, on sorted data, alternates between
+ * placing the cell boundaries half-way between codebook entries and
+ * moving each entry to the mean of its cell.
+ */
+void SequenceModel::Internal::quantize(u32 bits) {
+  require(!isQuantized());
+  require(1 <= bits && bits <= 16);
+  const size_t nLevels = size_t(1) << bits;
+  const size_t nProbabilities = wordProbabilities.size() - 1; // sentinel
+
+  std::vector<double> scores(nProbabilities);
+  for (size_t i = 0; i < nProbabilities; ++i)
+    scores[i] = wordProbabilities[i].probability_.score();
+  std::sort(scores.begin(), scores.end());
+
+  std::vector<double> levels(scores);
+  levels.erase(std::unique(levels.begin(), levels.end()), levels.end());
+  if (levels.size() > nLevels) {
+    levels.resize(nLevels);
+    for (size_t k = 0; k < nLevels; ++k)
+      levels[k] = scores[(2 * k + 1) * nProbabilities / (2 * nLevels)];
+    levels.erase(std::unique(levels.begin(), levels.end()), levels.end());
+
+    std::vector<double> cumulative(nProbabilities + 1, 0.0);
+    for (size_t i = 0; i < nProbabilities; ++i)
+      cumulative[i + 1] = cumulative[i] + scores[i];
+    for (u32 iteration = 0; iteration < 20; ++iteration) {
+      bool hasChanged = false;
+      size_t begin = 0;
+      for (size_t k = 0; k < levels.size(); ++k) {
+        size_t end = nProbabilities;
+        if (k + 1 < levels.size())
+          end = std::upper_bound(scores.begin(), scores.end(),
+                                 (levels[k] + levels[k + 1]) / 2) - scores.begin();
+        if (end > begin) {
+          double mean = (cumulative[end] - cumulative[begin]) / (end - begin);
+          if (mean != levels[k]) {
+            levels[k] = mean;
+            hasChanged = true;
+          }
+        }
+        begin = end;
+      }
+      if (!hasChanged) break;
+    }
+  }
+  applyCodebook(bits, levels);
+}
+
+/**
+ * Replace each probability by the nearest of the sorted, distinct
+ * scores in @c levels, storing its code in one byte if @c bits is at
+ * most eight.
+ */
+void SequenceModel::Internal::applyCodebook(u32 bits, const std::vector<double> &levels) {
+  require(!isQuantized());
+  require(1 <= bits && bits <= 16);
+  require(levels.size() <= (size_t(1) << bits));
+  const size_t nProbabilities = wordProbabilities.size() - 1; // sentinel
+
+  codebook.resize(levels.size());
+  for (size_t k = 0; k < levels.size(); ++k)
+    codebook[k] = LogProbability(levels[k]);
+
+  quantizedWordProbabilities.resize(nProbabilities + 1); // sentinel
+  if (bits <= 8)
+    codes8.resize(nProbabilities + 1);
+  else
+    codes16.resize(nProbabilities + 1);
+  for (size_t i = 0; i < nProbabilities; ++i) {
+    double score = wordProbabilities[i].probability_.score();
+    size_t k = std::lower_bound(levels.begin(), levels.end(), score) - levels.begin();
+    if (k == levels.size() || (k > 0 && score - levels[k - 1] < levels[k] - score))
+      --k;
+    quantizedWordProbabilities[i].token_ = wordProbabilities[i].token_;
+    if (bits <= 8)
+      codes8[i] = k;
+    else
+      codes16[i] = k;
+  }
+  quantizedWordProbabilities[nProbabilities].token_ = 0;
+
+  for (Nodes::iterator n = nodes.begin(); n != nodes.end(); ++n) {
+    size_t first = n->node_struct.finalized.firstWordProbability_.full - &wordProbabilities[0];
+    n->node_struct.finalized.firstWordProbability_.quantized = &quantizedWordProbabilities[first];
+  }
+  WordProbabilities().swap(wordProbabilities);
+  quantizationBits = bits;
+}
+
 SequenceModel::SequenceModel() {
   internal_ = 0;
   root_ = 0;
+  revision_ = 0;
   initialize(0, 0);
   sentenceBegin_ = sentenceEnd_ = 0;
 }
@@ -280,13 +507,64 @@ void SequenceModel::initialize(InitItem *begin, InitItem *end) {
 
   internal_ = new Internal(nNodes, nWordProbabilities);
   root_ = internal_->build(begin, end);
+  touch();
+}
+
+void SequenceModel::touch() {
+  static u32 lastRevision = 0;
+  revision_ = ++lastRevision;
 }
 
 size_t SequenceModel::memoryUsed() const {
   return sizeof(SequenceModel)
     + sizeof(Internal)
     + internal_->nodes.capacity() * sizeof(Internal::Nodes::value_type)
-    + internal_->wordProbabilities.capacity() * sizeof(Internal::WordProbabilities::value_type);
+    + internal_->wordProbabilities.capacity() * sizeof(Internal::WordProbabilities::value_type)
+    + internal_->quantizedWordProbabilities.capacity() * sizeof(Internal::QuantizedWordProbabilities::value_type)
+    + internal_->codes8.capacity() * sizeof(u8)
+    + internal_->codes16.capacity() * sizeof(u16)
+    + internal_->codebook.capacity() * sizeof(LogProbability)
+    + internal_->directIndices.capacity() * sizeof(u32)
+    + internal_->directIndexOffsets.capacity() * sizeof(u32);
+}
+
+void SequenceModel::quantize(u32 bits) {
+  internal_->quantize(bits);
+  touch();
+}
+
+u32 SequenceModel::quantization() const {
+  return internal_->quantizationBits;
+}
+
+PyObject *SequenceModel::codebook() const {
+  PyObject *result = PyList_New(internal_->codebook.size());
+  for (size_t k = 0; k < internal_->codebook.size(); ++k)
+    PyList_SET_ITEM(result, k, PyFloat_FromDouble(internal_->codebook[k].score()));
+  return result;
+}
+
+void SequenceModel::setCodebook(u32 bits, PyObject *obj) {
+  if (!PySequence_Check(obj))
+    throw PythonException(PyExc_TypeError, "not a sequence");
+  std::vector<double> levels;
+  int len = PySequence_Length(obj);
+  for (int i = 0; i < len; ++i) {
+    PyObject *item = PySequence_GetItem(obj, i);
+    double score = PyFloat_AsDouble(item);
+    Py_DECREF(item);
+    if (score == -1.0 && PyErr_Occurred())
+      throw ExistingPythonException();
+    levels.push_back(score);
+  }
+  std::sort(levels.begin(), levels.end());
+  levels.erase(std::unique(levels.begin(), levels.end()), levels.end());
+  if (bits < 1 || bits > 16 || levels.size() > (size_t(1) << bits))
+    throw PythonException(PyExc_ValueError, "codebook does not fit the number of bits");
+  if (internal_->isQuantized())
+    throw PythonException(PyExc_ValueError, "model is already quantized");
+  internal_->applyCodebook(bits, levels);
+  touch();
 }
 
 // ===========================================================================
@@ -297,7 +575,7 @@ SequenceModel::~SequenceModel() {
 }
 
 SequenceModel::History SequenceModel::initial() const {
-  const Node *n = root_->findChild(sentenceBegin_);
+  const Node *n = internal_->findChild(root_, sentenceBegin_);
   if (!n) n = root_;
   ensure(n);
   return n;
@@ -314,7 +592,7 @@ SequenceModel::History SequenceModel::advanced(const Node *old, Token w) const {
 
   const Node *result = root_;
   for (Node::Depth d = 0; d <= old->depth(); ++d) {
-    const Node *n = result->findChild(hist[d]);
+    const Node *n = internal_->findChild(result, hist[d]);
     if (!n) break;
     result = n;
   }
@@ -376,8 +654,19 @@ void SequenceModel::historyAsVector(const Node *h, std::vector<Token> &out) cons
 LogProbability SequenceModel::probability(Token w, const Node *h) const {
   require_(h);
   LogProbability probability = LogProbability::certain();
+  if (internal_->isQuantized()) {
+    for (const Node *n = h; n;  n = n->parent()) {
+      const QuantizedWordProbability *qs = internal_->findQuantizedWordProbability(n, w);
+      if (qs) {
+        probability *= internal_->quantizedProbability(qs);
+        break;
+      }
+      probability *= n->backOffWeight();
+    }
+    return probability;
+  }
   for (const Node *n = h; n;  n = n->parent()) {
-    const WordProbability *ws = n->findWordProbability(w);
+    const WordProbability *ws = internal_->findWordProbability(n, w);
     if (ws) {
       probability *= ws->probability();
       break;
@@ -387,14 +676,31 @@ LogProbability SequenceModel::probability(Token w, const Node *h) const {
   return probability;
 }
 
-LogProbability SequenceModel::probability(Token w, const std::vector<Token> &history) const {
+SequenceModel::History SequenceModel::historyFromVector(const std::vector<Token> &history) const {
   const Node *hn = root_;
   for (unsigned int i = history.size(); i;) {
-    const Node *n = hn->findChild(history[--i]);
+    const Node *n = internal_->findChild(hn, history[--i]);
     if (!n) break;
     hn = n;
   }
-  return probability(w, hn);
+  return hn;
+}
+
+LogProbability SequenceModel::probability(Token w, const std::vector<Token> &history) const {
+  return probability(w, historyFromVector(history));
+}
+
+LogProbability *SequenceModel::backOffWeightParameter(const Node *h) {
+  require(h);
+  require(!internal_->isQuantized());
+  return &const_cast<Node*>(h)->backOffWeight_;
+}
+
+LogProbability *SequenceModel::probabilityParameter(const Node *h, Token w) {
+  require(h);
+  require(!internal_->isQuantized());
+  const WordProbability *wp = internal_->findWordProbability(h, w);
+  return (wp) ? &const_cast<WordProbability*>(wp)->probability_ : 0;
 }
 
 // ===========================================================================
@@ -513,14 +819,22 @@ void SequenceModel::setInitAndTerm(u32 init, u32 term) {
 
 
 PyObject *SequenceModel::get() const {
-  PyObject *result = PyList_New(internal_->nodes.size() + internal_->wordProbabilities.size() - 2);
+  PyObject *result = PyList_New(internal_->nodes.size() - 1 + internal_->nWordProbabilities());
   int i = 0;
   for (Internal::Nodes::iterator n = internal_->nodes.begin(); n+1 != internal_->nodes.end(); ++n) {
     PyObject *history = historyAsTuple(&*n);
-    for (const WordProbability *ws = n->probabilitiesBegin(); ws != n->probabilitiesEnd(); ++ws) {
-      PyObject *hps = Py_BuildValue("(Oif)", history, ws->token_, ws->probability_.score());
-      verify_(i < PyList_GET_SIZE(result));
-      PyList_SET_ITEM(result, i++, hps);
+    if (internal_->isQuantized()) {
+      for (const QuantizedWordProbability *qs = n->quantizedProbabilitiesBegin(); qs != n->quantizedProbabilitiesEnd(); ++qs) {
+        PyObject *hps = Py_BuildValue("(Oif)", history, qs->token_, internal_->quantizedProbability(qs).score());
+        verify_(i < PyList_GET_SIZE(result));
+        PyList_SET_ITEM(result, i++, hps);
+      }
+    } else {
+      for (const WordProbability *ws = n->probabilitiesBegin(); ws != n->probabilitiesEnd(); ++ws) {
+        PyObject *hps = Py_BuildValue("(Oif)", history, ws->token_, ws->probability_.score());
+        verify_(i < PyList_GET_SIZE(result));
+        PyList_SET_ITEM(result, i++, hps);
+      }
     }
     PyObject *hps = Py_BuildValue("(OOf)", history, Py_None, n->backOffWeight_.score());
     verify_(i < PyList_GET_SIZE(result));
@@ -533,8 +847,18 @@ PyObject *SequenceModel::get() const {
 
 PyObject *SequenceModel::getNode(const Node *nn) const {
   require(nn);
-  PyObject *result = PyList_New(nn->probabilitiesEnd() - nn->probabilitiesBegin() + 1);
   int i = 0;
+  if (internal_->isQuantized()) {
+    PyObject *result = PyList_New(nn->quantizedProbabilitiesEnd() - nn->quantizedProbabilitiesBegin() + 1);
+    PyList_SET_ITEM(result, i++, Py_BuildValue(
+          "(Of)", Py_None, nn->backOffWeight_.score()));
+    for (const QuantizedWordProbability *qp = nn->quantizedProbabilitiesBegin(); qp != nn->quantizedProbabilitiesEnd(); ++qp)
+      PyList_SET_ITEM(result, i++, Py_BuildValue(
+            "(if)", qp->token_, internal_->quantizedProbability(qp).score()));
+    verify(i == PyList_GET_SIZE(result));
+    return result;
+  }
+  PyObject *result = PyList_New(nn->probabilitiesEnd() - nn->probabilitiesBegin() + 1);
   PyList_SET_ITEM(result, i++, Py_BuildValue(
         "(Of)", Py_None, nn->backOffWeight_.score()));
   for (const WordProbability *wp = nn->probabilitiesBegin(); wp != nn->probabilitiesEnd(); ++wp)
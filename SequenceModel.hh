@@ -104,7 +104,7 @@ class SequenceModel {
 public:
     typedef unsigned int Token;
     struct InitItem; class InitData;
-    struct WordProbability;
+    struct WordProbability; struct QuantizedWordProbability;
 
 private:
     class Internal; Internal *internal_;
@@ -112,6 +112,7 @@ private:
     void initialize(InitItem *begin, InitItem *end);
 
     Token sentenceBegin_, sentenceEnd_;
+    u32 revision_;
 
 public:
     typedef const Node *History;
@@ -140,9 +141,36 @@ public:
 #endif // OBSOLETE
     void historyAsVector(History, std::vector<Token>&) const;
     PyObject *historyAsTuple(History) const;
+    /** @return the longest history in the model which is a suffix of
+     * @c history (least recent word first) */
+    History historyFromVector(const std::vector<Token> &history) const;
     LogProbability probability(Token, const std::vector<Token> &history) const;
     LogProbability probability(Token, History) const;
 
+    /** Stamp which changes whenever the parameters of the model change.
+     * Stamps are unique across all models. */
+    u32 revision() const { return revision_; }
+    /** Record that the parameters have been modified in place. */
+    void touch();
+    /** Writable parameters for in-place re-estimation with unchanged
+     * topology.  probabilityParameter() returns zero if the model has
+     * no explicit probability for the token. */
+    LogProbability *backOffWeightParameter(History);
+    LogProbability *probabilityParameter(History, Token);
+
+    /** Replace each probability by the nearest entry of a shared
+     * codebook of 2^bits scores.  Back-off weights are kept exactly.
+     * A quantized model cannot be re-estimated in place. */
+    void quantize(u32 bits);
+    /** @return codebook size in bits, zero if the model is not quantized */
+    u32 quantization() const;
+    /** @return list of the scores in the codebook of a quantized model */
+    PyObject *codebook() const;
+    /** Quantize with the given codebook, a sequence of at most
+     * 2^bits scores, instead of estimating one.  Each probability is
+     * mapped to the nearest entry. */
+    void setCodebook(u32 bits, PyObject *codebook);
+
     Token init() const { return sentenceBegin_; }
     Token term() const { return sentenceEnd_; }
 
@@ -157,6 +185,15 @@ public:
     LogProbability probability() const { return probability_; }
 };
 
+/** The codes of quantized probabilities are held in a separate array
+ * of bytes, or of 16-bit words if the codebook has more than 256
+ * entries, at the same position as the token. */
+struct SequenceModel::QuantizedWordProbability {
+    Token token_;
+public:
+    Token token() const { return token_; }
+};
+
 struct SequenceModel::InitItem {
     Token *history; /**< zero-terminated string, recent-most first */
     Token token;    /**< predicted word, or zero iff back-off */
@@ -29,6 +29,7 @@ negligent actions or intended actions or fraudulent concealment.
 """
 
 import copy, math
+import numpy as num
 from misc import set
 import sequitur_
 
@@ -62,17 +63,18 @@ class EvidenceList:
         self.consolidate()
 
     def consolidate(self):
-        self.evidence.sort()
-        out = 0
-        for i in range(1, len(self.evidence)):
-            if self.evidence[i][:2] == self.evidence[out][:2]:
-                history, predicted, value = self.evidence[out]
-                value += self.evidence[i][2]
-                self.evidence[out] = history, predicted, value
-            else:
-                out += 1
-                self.evidence[out] = self.evidence[i]
-        del self.evidence[out + 1 :]
+        "Sum the values of equal (history, predicted) keys, sorted by key."
+        if not self.evidence:
+            return
+        keys = num.empty(len(self.evidence), dtype=object)
+        keys[:] = [(history, predicted) for history, predicted, value in self.evidence]
+        values = num.array([value for history, predicted, value in self.evidence])
+        keys, inverse = num.unique(keys, return_inverse=True)
+        totals = num.bincount(inverse.ravel(), weights=values)
+        self.evidence = [
+            (history, predicted, value)
+            for (history, predicted), value in zip(keys, totals.tolist())
+        ]
 
     def discount(self, discount):
         discounted = EvidenceList()
@@ -98,10 +100,7 @@ class EvidenceList:
     def grouped(self):
         result = {}
         for history, predicted, value in self.evidence:
-            if history in result:
-                result[history].append((predicted, value))
-            else:
-                result[history] = [(predicted, value)]
+            result.setdefault(history, []).append((predicted, value))
         return result
 
     def groupedSums(self):
@@ -291,15 +290,38 @@ class SequenceModelEstimator:
 
 class SequenceModel(sequitur_.SequenceModel):
     def __getstate__(self):
+        """
+        A quantized model is stored as its codebook and, for each
+        probability, the index of its score in the codebook.
+        """
         dct = copy.copy(self.__dict__)
         del dct["this"]
-        return (self.init(), self.term(), self.get(), dct)
+        data = self.get()
+        if self.quantization():
+            codebook = self.codebook()
+            code = dict((score, k) for k, score in enumerate(codebook))
+            data = [
+                (history, predicted, score if predicted is None else code[score])
+                for history, predicted, score in data
+            ]
+            dct["quantization"] = (self.quantization(), codebook)
+        return (self.init(), self.term(), data, dct)
 
     def __setstate__(self, data):
         super(SequenceModel, self).__init__()
         init, term, data, dct = data
+        dct = copy.copy(dct)
+        quantization = dct.pop("quantization", None)
+        if quantization:
+            bits, codebook = quantization
+            data = [
+                (history, predicted, score if predicted is None else codebook[score])
+                for history, predicted, score in data
+            ]
         self.setInitAndTerm(init, term)
         self.set(data)
+        if quantization:
+            self.setCodebook(bits, codebook)
         self.__dict__.update(dct)
 
     def size(self):
@@ -359,6 +381,116 @@ class SequenceModel(sequitur_.SequenceModel):
             data.append((history, None, 0.0))
         self.set(data)
 
+    def prune(self, threshold):
+        """
+        Relative entropy pruning: remove each probability whose removal
+        increases the perplexity of the model by less than the relative
+        amount threshold, and re-normalize the back-off weights of the
+        affected histories.  Probabilities of the empty history and
+        those extended by a longer history are kept.
+        adapted from: A. Stolcke, "Entropy-based Pruning of Backoff
+        Language Models", DARPA Broadcast News Workshop 1998
+        """
+        data = self.get()
+        prob = {}
+        backOff = {}
+        predictedIn = {}
+        for history, predicted, score in data:
+            if predicted is None:
+                backOff[history] = math.exp(-score)
+            else:
+                prob[(history, predicted)] = math.exp(-score)
+                predictedIn.setdefault(history, []).append(predicted)
+
+        def probability(history, predicted):
+            backOffWeight = 1.0
+            while True:
+                p = prob.get((history, predicted))
+                if p is not None:
+                    return backOffWeight * p
+                backOffWeight *= backOff.get(history, 1.0)
+                if not history:
+                    return backOffWeight
+                history = history[1:]
+
+        def normalization(history, shorterHistory):
+            explicit = predictedIn.get(history, [])
+            numerator = 1.0 - math.fsum(prob[(history, w)] for w in explicit)
+            denominator = 1.0 - math.fsum(probability(shorterHistory, w) for w in explicit)
+            return numerator, denominator
+
+        historyProbability = {(): 1.0}
+
+        def probabilityOfHistory(history):
+            if history not in historyProbability:
+                if history[0] == self.init():
+                    p = 1.0
+                else:
+                    p = probabilityOfHistory(history[:-1]) * probability(
+                        history[:-1], history[-1]
+                    )
+                historyProbability[history] = p
+            return historyProbability[history]
+
+        pruned = []
+        for history, explicit in predictedIn.items():
+            if not history:
+                continue
+            shorterHistory = history[1:]
+            numerator, denominator = normalization(history, shorterHistory)
+            if numerator <= 0.0 or denominator <= 0.0:
+                continue
+            backOffWeight = numerator / denominator
+            pHistory = probabilityOfHistory(history)
+            for predicted in explicit:
+                if history + (predicted,) in backOff:
+                    continue
+                p = prob[(history, predicted)]
+                pBackedOff = probability(shorterHistory, predicted)
+                newBackOffWeight = (numerator + p) / (denominator + pBackedOff)
+                deltaEntropy = -pHistory * (
+                    p * (math.log(pBackedOff * newBackOffWeight) - math.log(p))
+                    + numerator * (math.log(newBackOffWeight) - math.log(backOffWeight))
+                )
+                if math.exp(deltaEntropy) - 1.0 < threshold:
+                    pruned.append((history, predicted))
+        if not pruned:
+            return 0
+
+        prunedHistories = set()
+        for history, predicted in pruned:
+            del prob[(history, predicted)]
+            predictedIn[history].remove(predicted)
+            prunedHistories.add(history)
+        newBackOff = {}
+        for history in sorted(backOff, key=len):
+            if not history:
+                continue
+            if not any(history[i:] in prunedHistories for i in range(len(history))):
+                continue
+            if history in prunedHistories and not predictedIn[history]:
+                newBackOff[history] = None
+                backOff[history] = 1.0
+                continue
+            numerator, denominator = normalization(history, history[1:])
+            if numerator > 0.0 and denominator > 0.0:
+                newBackOff[history] = backOff[history] = numerator / denominator
+
+        pruned = set(pruned)
+        result = []
+        for history, predicted, score in data:
+            if predicted is not None:
+                if (history, predicted) in pruned:
+                    continue
+            elif history in newBackOff:
+                if newBackOff[history] is None:
+                    continue
+                score = -math.log(newBackOff[history])
+            result.append((history, predicted, score))
+        data = result
+        self.set(data)
+        return len(pruned)
+
     def setZerogram(self, vocabularySize):
         data = [((), None, math.log(vocabularySize))]
         self.set(data)
@@ -29,16 +29,19 @@ negligent actions or intended actions or fraudulent concealment.
 
 from collections import defaultdict
 import os.path
+import zlib
 from six.moves import cPickle as pickle
 import operator
 import numpy as num
 from sequitur import (
     Sequitur,
+    CompiledSample,
     ModelTemplate,
     DefaultDiscountAdjuster,
     StaticDiscounts,
     FixedDiscounts,
     EagerDiscountAdjuster,
+    RelativeImprovement,
 )
 from sequitur import Translator
 from Evaluation import Evaluator
@@ -66,57 +69,111 @@ def transposeSample(sample):
     return [(right, left) for left, right in sample]
 
 
+def isDevelOrth(orth, portion):
+    """
+    Deterministically assign an orthography to the devel portion by
+    hashing it, so that all variants of a word end up on the same side
+    and the split does not depend on the order of the sample.
+    """
+    key = u"\x00".join(orth).encode("utf-8")
+    return (zlib.crc32(key) & 0xFFFFFFFF) < portion * 0x100000000
+
+
+class SamplePortion(object):
+    def __init__(self, sample, portion, devel):
+        self.sample = sample
+        self.portion = portion
+        self.devel = devel
+        self.isRereadable = getattr(sample, "isRereadable", False)
+
+    def __iter__(self):
+        for s in self.sample:
+            if isDevelOrth(s[0], self.portion) == self.devel:
+                yield s
+
+
 def partition_sample(sample, portion=0.1):
+    if not isinstance(sample, list):
+        return (
+            SamplePortion(sample, portion, False),
+            SamplePortion(sample, portion, True),
+        )
     train_sample = []
     devel_sample = []
-    j = 0
-    for i, s in enumerate(group_by_orth(sample)):
-        if j / (i + 1) < portion:
-            for value in s[1]:
-                devel_sample.append((s[0], value))
-            j += 1
+    for s in sample:
+        if isDevelOrth(s[0], portion):
+            devel_sample.append(s)
         else:
-            for value in s[1]:
-                train_sample.append((s[0], value))
+            train_sample.append(s)
     return train_sample, devel_sample
 
 
-def group_by_orth(sample):
-    import random
-
-    source_values = set()
-    mapping = defaultdict(list)
-    for s in sample:
-        source_values.add(s[0])
-        mapping[s[0]].append(s[1])
-    source_values = list(source_values)
-    random.shuffle(source_values)
-    for s in source_values:
-        yield s, mapping[s]
-
-
 class Tool:
-    def __init__(self, options, loadSample, log=sys.stdout):
+    def __init__(
+        self,
+        options,
+        loadSample,
+        log=sys.stdout,
+        streamSample=None,
+        compileSample=None,
+    ):
         self.options = options
         self.loadSample = loadSample
+        self.streamSample = streamSample
+        self.compileSample = compileSample
         self.log = log
+        self.develLogLik = None
 
     def loadSamples(self):
-        self.trainSample = self.loadSample(self.options.trainSample)
+        if self.options.develSample and self.options.develSample.endswith("%"):
+            portion = float(self.options.develSample.rstrip("% ")) / 100.0
+        else:
+            portion = None
+        compiled = None
+        if self.options.stream and self.streamSample:
+            self.trainSample = self.streamSample(self.options.trainSample)
+        else:
+            if self.compileSample:
+                compiled = self.compileSample(
+                    self.sequitur, self.options.trainSample, portion, self.log
+                )
+            if compiled:
+                self.trainSample, develSample = compiled
+            else:
+                self.trainSample = self.loadSample(self.options.trainSample)
         if not self.options.develSample:
             self.develSample = []
-        elif self.options.develSample.endswith("%"):
-            portion = float(self.options.develSample.rstrip("% ")) / 100.0
+        elif compiled and portion is not None:
+            self.develSample = develSample
+        elif portion is not None:
             self.trainSample, self.develSample = partition_sample(
                 self.trainSample, portion
             )
+            self.develSample = list(self.develSample)
         else:
             self.develSample = self.loadSample(self.options.develSample)
-        print(
-            "training sample: %d + %d devel"
-            % (len(self.trainSample), len(self.develSample)),
-            file=self.log,
-        )
+        if isinstance(self.trainSample, CompiledSample):
+            print(
+                "training sample: %d (%d distinct) + %d devel"
+                % (
+                    sum(self.trainSample.weights),
+                    len(self.trainSample),
+                    len(self.develSample),
+                ),
+                file=self.log,
+            )
+        elif isinstance(self.trainSample, list):
+            print(
+                "training sample: %d + %d devel"
+                % (len(self.trainSample), len(self.develSample)),
+                file=self.log,
+            )
+        else:
+            print(
+                "training sample: streamed from %s + %d devel"
+                % (self.options.trainSample, len(self.develSample)),
+                file=self.log,
+            )
 
     def trainModel(self, initialModel):
         self.loadSamples()
@@ -168,6 +225,15 @@ class Tool:
             return
         template.minIterations = self.options.minIterations
         template.maxIterations = self.options.maxIterations
+        template.nJobs = self.options.jobs
+        template.minibatchSize = self.options.minibatch
+        if self.options.stopThreshold is not None:
+            template.convergence = RelativeImprovement(
+                self.options.stopThreshold, self.options.patience
+            )
+        template.develCheckSize = self.options.develCheckSize
+        template.evidenceThreshold = self.options.evidenceThreshold
+        template.minEvidence = self.options.minEvidence
         if self.options.checkpoint and self.options.newModelFile:
             template.checkpointInterval = 8 * 60 * 60
             base, ext = os.path.splitext(self.options.newModelFile)
@@ -193,8 +259,46 @@ class Tool:
         if self.options.shouldInitializeWithCounts:
             template.initializeWithOverlappingCounts(estimationContext)
         template.run(estimationContext)
+        previousOrder = None
+        while self.options.targetOrder and estimationContext.bestModel:
+            order = estimationContext.order + 1
+            if order >= self.options.targetOrder:
+                break
+            if previousOrder is not None and order <= previousOrder:
+                print(
+                    "warning: ramp up to order %d failed, stopping at order %d"
+                    % (previousOrder + 1, order),
+                    file=self.log,
+                )
+                break
+            print("ramping up to order %d" % (order + 1), file=self.log)
+            previousOrder = order
+            estimationContext = template.rampUpContext(estimationContext)
+            template.run(estimationContext)
+        if estimationContext.develSample:
+            develSample = estimationContext.develSample
+            self.develLogLik = lambda model: develSample.logLik(
+                model.sequenceModel, template.shallUseMaximumApproximation
+            )
         return estimationContext.bestModel
 
+    def pruneModel(self, model):
+        if self.develLogLik:
+            logLikBefore = self.develLogLik(model)
+        oldSize, newSize = model.prune(self.options.pruneThreshold)
+        print(
+            "pruned model from %d to %d entries (threshold %s)"
+            % (oldSize, newSize, self.options.pruneThreshold),
+            file=self.log,
+        )
+        if self.develLogLik:
+            logLikAfter = self.develLogLik(model)
+            print(
+                "LL devel: %s (before pruning), %s (after pruning)"
+                % (logLikBefore, logLikAfter),
+                file=self.log,
+            )
+
     def procureModel(self):
         if self.options.resume_from_checkpoint:
             model = ModelTemplate.resume(self.options.resume_from_checkpoint)
@@ -236,12 +340,27 @@ class Tool:
         if self.options.shouldTranspose:
             model.transpose()
 
+        if self.options.newModelFile and self.options.pruneThreshold:
+            self.pruneModel(model)
+
         if self.options.newModelFile:
             oldSize, newSize = model.strip()
             print(
                 "stripped number of multigrams from %d to %d" % (oldSize, newSize),
                 file=self.log,
             )
+            if self.options.quantization:
+                memoryBefore = model.sequenceModel.memoryUsed()
+                model.sequenceModel.quantize(self.options.quantization)
+                print(
+                    "quantized probabilities to %d bits, model memory from %d to %d bytes"
+                    % (
+                        self.options.quantization,
+                        memoryBefore,
+                        model.sequenceModel.memoryUsed(),
+                    ),
+                    file=self.log,
+                )
             f = open(self.options.newModelFile, "wb")
             pickle.dump(model, f, pickle.HIGHEST_PROTOCOL)
             f.close()
@@ -267,8 +386,10 @@ class Tool:
         return model
 
 
-def procureModel(options, loadSample, log=sys.stdout):
-    tool = Tool(options, loadSample, log)
+def procureModel(
+    options, loadSample, log=sys.stdout, streamSample=None, compileSample=None
+):
+    tool = Tool(options, loadSample, log, streamSample, compileSample)
     return tool.procureModel()
 
 
@@ -287,6 +408,12 @@ def addTrainOptions(optparser):
         help="read held-out training sample from FILE or use N% of the training data",
         metavar="FILE / N%",
     )
+    optparser.add_option(
+        "--stream",
+        action="store_true",
+        help="read the training sample from FILE anew in each iteration "
+        "instead of keeping it in memory",
+    )
     optparser.add_option(
         "-x",
         "--test",
@@ -322,6 +449,22 @@ def addTrainOptions(optparser):
         help="write model to FILE",
         metavar="FILE",
     )
+    optparser.add_option(
+        "--prune-threshold",
+        dest="pruneThreshold",
+        type="float",
+        help="before writing the model, remove probabilities whose removal "
+        "increases its perplexity by less than the relative amount T",
+        metavar="T",
+    )
+    optparser.add_option(
+        "--quantize",
+        dest="quantization",
+        type="int",
+        help="store the probabilities of the written model as indices into "
+        "a codebook of 2^BITS values (BITS at most 16, e.g. 8)",
+        metavar="BITS",
+    )
     optparser.add_option(
         "--continuous-test",
         dest="shouldTestContinuously",
@@ -361,6 +504,13 @@ def addTrainOptions(optparser):
         action="store_true",
         help="ramp up the model",
     )
+    optparser.add_option(
+        "--target-order",
+        dest="targetOrder",
+        type="int",
+        help="after training, ramp up and train again until the model has order N",
+        metavar="N",
+    )
     optparser.add_option(
         "-W",
         "--wipe-out",
@@ -391,6 +541,59 @@ def addTrainOptions(optparser):
         default=ModelTemplate.maxIterations,
         help="maximum number of EM iterations during training",
     )
+    optparser.add_option(
+        "--stop-threshold",
+        dest="stopThreshold",
+        type="float",
+        help="stop when the log-likelihood improves by less than this fraction "
+        "(instead of testing for a significant trend)",
+        metavar="R",
+    )
+    optparser.add_option(
+        "--patience",
+        type="int",
+        default=3,
+        help="number of iterations below the --stop-threshold before stopping",
+        metavar="N",
+    )
+    optparser.add_option(
+        "--devel-check-size",
+        dest="develCheckSize",
+        type="int",
+        help="measure devel log-likelihood on a fixed subsample of N distinct entries",
+        metavar="N",
+    )
+    optparser.add_option(
+        "-j",
+        "--jobs",
+        type="int",
+        default=ModelTemplate.nJobs,
+        help="number of threads used for building estimation graphs and models, "
+        "and of processes used for --test (0 for all cores)",
+        metavar="N",
+    )
+    optparser.add_option(
+        "--minibatch",
+        type="int",
+        help="use stepwise EM, updating the model after every N words",
+        metavar="N",
+    )
+    optparser.add_option(
+        "--evidence-threshold",
+        dest="evidenceThreshold",
+        type="float",
+        help="credit posteriors below P to the back-off history instead of "
+        "storing them as evidence of their own",
+        metavar="P",
+    )
+    optparser.add_option(
+        "--min-evidence",
+        dest="minEvidence",
+        type="float",
+        help="prune evidence types with less than E total evidence after each iteration "
+        "(with --minibatch at least 0.001, so that unused multigrams are dropped)",
+        metavar="E",
+    )
     optparser.add_option(
         "--eager-discount-adjustment",
         action="store_true",
@@ -28,11 +28,17 @@
 #ifndef _CORE_UTILITY_HH
 #define _CORE_UTILITY_HH
 
+#include <algorithm>
+#include <atomic>
 #include <cmath>
 #include <complex>
+#include <exception>
 #include <iostream>
+#include <mutex>
 #include <sstream>
 #include <string>
+#include <thread>
+#include <vector>
 #include "Types.hh"
 #include "Assertions.hh"
 
@@ -60,6 +66,36 @@ namespace Core {
         return itoa(s, i);
     }
 
+    /**
+     * Sort [begin, end) using at most nThreads threads: the range is
+     * cut into one piece per thread, the pieces are sorted in
+     * parallel and then merged pairwise, again in parallel.
+     */
+    template <class Iterator, class Ordering>
+    void parallelSort(Iterator begin, Iterator end, Ordering ordering, u32 nThreads) {
+        size_t n = end - begin;
+        if (nThreads <= 1 || n < 2 * size_t(nThreads)) {
+            std::sort(begin, end, ordering);
+            return;
+        }
+        std::vector<Iterator> pieces;
+        for (u32 t = 0; t <= nThreads; ++t)
+            pieces.push_back(begin + n * t / nThreads);
+        auto sortPiece = [&](u32, size_t i) {
+            std::sort(pieces[i], pieces[i + 1], ordering);
+        };
+        parallelFor(nThreads, nThreads, sortPiece);
+        for (size_t width = 1; width < nThreads; width *= 2) {
+            auto mergePieces = [&](u32, size_t i) {
+                size_t first = 2 * width * i;
+                size_t middle = std::min(first + width, size_t(nThreads));
+                size_t last = std::min(first + 2 * width, size_t(nThreads));
+                std::inplace_merge(pieces[first], pieces[middle], pieces[last], ordering);
+            };
+            parallelFor((nThreads + 2 * width - 1) / (2 * width), nThreads, mergePieces);
+        }
+    }
+
 } // namespace Core
 
 inline size_t __stl_hash_wstring(const wchar_t* __s) {
@@ -285,6 +321,55 @@ namespace Core {
         return a < b && !isAlmostEqualUlp(a, b, tolerance);
     }
 
+    /**
+     * Number of threads to use for a requested number of threads.
+     * Zero means one thread per processor core.
+     */
+    inline u32 numberOfThreads(u32 requested) {
+        if (requested == 0)
+            requested = std::thread::hardware_concurrency();
+        return (requested > 0) ? requested : 1;
+    }
+
+    /**
+     * Call f(thread, i) for every i in [0, n) using at most nThreads
+     * threads, where thread is in [0, nThreads).  Items are handed
+     * out in increasing order, but the assignment of items to threads
+     * is arbitrary, so f may only modify state that belongs either to
+     * item i or to the given thread.  If any call of f throws, the
+     * remaining items are skipped and the first exception is
+     * re-thrown once all threads have finished.
+     */
+    template <class F>
+    void parallelFor(size_t n, u32 nThreads, F &f) {
+        if (nThreads > n) nThreads = u32(n);
+        if (nThreads <= 1) {
+            for (size_t i = 0; i < n; ++i) f(0, i);
+            return;
+        }
+
+        std::atomic<size_t> next(0);
+        std::exception_ptr error;
+        std::mutex errorMutex;
+        std::vector<std::thread> threads;
+        for (u32 t = 0; t < nThreads; ++t) {
+            threads.push_back(std::thread([&, t]() {
+                for (size_t i = next++; i < n; i = next++) {
+                    try {
+                        f(t, i);
+                    } catch (...) {
+                        std::lock_guard<std::mutex> lock(errorMutex);
+                        if (!error) error = std::current_exception();
+                        next = n;
+                    }
+                }
+            }));
+        }
+        for (std::vector<std::thread>::iterator t = threads.begin(); t != threads.end(); ++t)
+            t->join();
+        if (error) std::rethrow_exception(error);
+    }
+
 } // namespace Core
 
 
@@ -35,81 +35,359 @@ commercially. In any case guarantee/warranty shall be limited to gross
 negligent actions or intended actions or fraudulent concealment.
 """
 
+import heapq
+import io
+import itertools
+import marshal
 import math
+import operator
 import sys
+import tempfile
+import time
 import SequiturTool
-from sequitur import Translator
-from misc import gOpenIn, gOpenOut, set
+from sequitur import CompiledSample, Translator
+from misc import gOpenIn, gOpenInBinary, gOpenOut, set
+from tool import UsageError
 import codecs
 
 
 # ===========================================================================
+plainSampleBlockSize = 1 << 20  # characters
+progressInterval = 10.0  # seconds
+
+
+def readPlainSampleBlocks(f, blockSize=plainSampleBlockSize):
+    """
+    Read a plain text sample from text stream f in blocks of about
+    blockSize characters and yield the complete lines of each block
+    as a list.
+    """
+    rest = u""
+    while True:
+        block = f.read(blockSize)
+        if not block:
+            break
+        lines = (rest + block).split(u"\n")
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+
+def parsePlainSample(f):
+    for lines in readPlainSampleBlocks(f):
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            left = tuple(fields[0])
+            right = tuple(fields[1:])
+            yield left, right
+
+
+def readPlainSample(fname, encoding=None):
+    f = gOpenIn(fname, encoding or defaultEncoding)
+    try:
+        for entry in parsePlainSample(f):
+            yield entry
+    finally:
+        f.close()
+
+
+def openG2PSample(fname):
+    """
+    Open a sample file once and tell its format by peeking at the
+    first bytes.  Returns (binary stream, True for a Bliss XML lexicon).
+    """
+    f = gOpenInBinary(fname)
+    return f, f.peek(5)[:5] == b"<?xml"
+
+
+def compilePlainSample(sequitur, fname, portion=None, log=None, encoding=None):
+    """
+    Read a plain text sample directly into a CompiledSample of
+    sequitur, without building tuples of symbol strings for the
+    training entries.  If portion is given, the entries of that
+    portion of the orthographies go to a devel sample instead, see
+    SequiturTool.isDevelOrth().  Progress and throughput are reported
+    to log.
+
+    Returns (train sample, devel sample), or None if fname is not a
+    plain text file.
+    """
+    f, isXml = openG2PSample(fname)
+    if isXml:
+        f.close()
+        return None
+    f = io.TextIOWrapper(f, encoding or defaultEncoding)
+    parseLeft = sequitur.leftInventory.parse
+    parseRight = sequitur.rightInventory.parse
+    isDevelOrth = SequiturTool.isDevelOrth
+    train = CompiledSample()
+    devel = []
+    nEntries = 0
+    nChars = 0
+    startTime = lastReport = time.time()
+    for lines in readPlainSampleBlocks(f):
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            if portion is not None and isDevelOrth(fields[0], portion):
+                devel.append((tuple(fields[0]), tuple(fields[1:])))
+            else:
+                train.append(parseLeft(fields[0]), parseRight(fields[1:]))
+            nEntries += 1
+        nChars += sum(map(len, lines)) + len(lines)
+        now = time.time()
+        if log and now - lastReport >= progressInterval:
+            lastReport = now
+            reportThroughput(log, fname, nEntries, nChars, now - startTime)
+    f.close()
+    train.compact()
+    if log:
+        reportThroughput(log, fname, nEntries, nChars, time.time() - startTime)
+    return train, devel
+
+
+def reportThroughput(log, fname, nEntries, nChars, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    print(
+        "read %d entries (%.1f M characters) from %s in %.1fs: %d entries/s, %.1f M characters/s"
+        % (
+            nEntries,
+            nChars / 1e6,
+            fname,
+            elapsed,
+            nEntries / elapsed,
+            nChars / 1e6 / elapsed,
+        ),
+        file=log,
+    )
+
+
 def loadPlainSample(fname, encoding=None):
-    sample = []
-    for line in gOpenIn(fname, encoding or defaultEncoding):
-        fields = line.split()
-        if not fields:
-            continue
-        left = tuple(fields[0])
-        right = tuple(fields[1:])
-        sample.append((left, right))
-    return sample
+    return list(readPlainSample(fname, encoding))
+
+
+class PlainSampleFile(object):
+    """
+    Re-iterable plain text sample, which is read from the file anew on
+    each iteration.
+    """
 
+    isRereadable = True
 
-def pronunciationsFromXmlLexicon(xml):
-    pronunciations = {}
-    lexicon = xml.getroot()
-    for lemma in lexicon.getiterator("lemma"):
+    def __init__(self, fname, encoding=None):
+        self.fname = fname
+        self.encoding = encoding or defaultEncoding
+
+    def __iter__(self):
+        return readPlainSample(self.fname, self.encoding)
+
+
+def readBlissLexicon(f):
+    """
+    Yield the (orth, phon) pairs of the Bliss XML lexicon in binary
+    stream f, lemma by lemma.  Each lemma is discarded once it has
+    been processed, so the document tree is never held in memory.
+    Orthographies in brackets, like [SILENCE], are skipped.
+    """
+    from xml.etree.ElementTree import iterparse
+
+    root = None
+    for event, elem in iterparse(f, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end" or elem.tag != "lemma":
+            continue
         orth = [
-            orth.text.strip() for orth in lemma.findall("orth") if orth.text is not None
+            orth.text.strip() for orth in elem.findall("orth") if orth.text is not None
         ]
-        phon = [tuple((phon.text or "").split()) for phon in lemma.findall("phon")]
+        phon = [tuple((phon.text or "").split()) for phon in elem.findall("phon")]
+        elem.clear()
+        root.clear()
         for w in orth:
-            if w in pronunciations:
-                pronunciations[w] += phon
-            else:
-                pronunciations[w] = phon
-    return pronunciations
-
-
-def loadBlissLexicon(fname):
-    from xml.etree.ElementTree import ElementTree
-
-    xml = ElementTree(file=gOpenIn(fname))
-    pronunciations = pronunciationsFromXmlLexicon(xml)
-    result = [
-        (orth, phon)
-        for orth in pronunciations
-        if not (orth.startswith("[") and orth.endswith("]"))
-        for phon in pronunciations[orth]
-    ]
-    result.sort()
+            if w.startswith("[") and w.endswith("]"):
+                continue
+            for p in phon:
+                yield w, p
+
+
+def loadBlissLexicon(fname, shouldSort=True):
+    f = gOpenInBinary(fname)
+    try:
+        result = list(readBlissLexicon(f))
+    finally:
+        if fname != "-":
+            f.close()
+    if shouldSort:
+        result.sort()
     return result
 
 
+class BlissSampleFile(object):
+    """
+    Re-iterable sample from a Bliss XML lexicon, which is parsed anew
+    on each iteration.  Entries come in the order of the file.
+    """
+
+    isRereadable = True
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __iter__(self):
+        f = gOpenInBinary(self.fname)
+        try:
+            for orth, phon in readBlissLexicon(f):
+                yield tuple(orth), phon
+        finally:
+            f.close()
+
+
 def loadG2PSample(fname):
+    f, isXml = openG2PSample(fname)
+    try:
+        if isXml:
+            return sorted((tuple(orth), phon) for orth, phon in readBlissLexicon(f))
+        f = io.TextIOWrapper(f, defaultEncoding)
+        return list(parsePlainSample(f))
+    finally:
+        if fname != "-":
+            f.close()
+
+
+def streamG2PSample(fname):
     if fname == "-":
-        sample = loadPlainSample(fname)
-    else:
-        firstLine = gOpenIn(fname, defaultEncoding).readline()
-        if firstLine.startswith("<?xml"):
-            sample = [
-                (tuple(orth), tuple(phon)) for orth, phon in loadBlissLexicon(fname)
-            ]
-        else:
-            sample = loadPlainSample(fname)
-    return sample
+        return loadG2PSample(fname)
+    f, isXml = openG2PSample(fname)
+    f.close()
+    if isXml:
+        return BlissSampleFile(fname)
+    return PlainSampleFile(fname)
 
 
-def loadP2PSample(compfname):
+def readG2PSample(fname):
+    "Iterate over the (orth, phon) pairs of a sample file in file order."
+    f, isXml = openG2PSample(fname)
+    if isXml:
+        return ((tuple(orth), phon) for orth, phon in readBlissLexicon(f))
+    return parsePlainSample(io.TextIOWrapper(f, defaultEncoding))
+
+
+p2pSortRunSize = 10 ** 6  # entries sorted in memory at a time
+p2pSpillChunkSize = 1000  # entries per marshalled chunk of a spilled run
+
+
+def spillSortedRun(run):
+    f = tempfile.TemporaryFile()
+    for i in range(0, len(run), p2pSpillChunkSize):
+        marshal.dump(run[i : i + p2pSpillChunkSize], f)
+    return f
+
+
+def readSpilledRun(f):
+    try:
+        f.seek(0)
+        while True:
+            try:
+                chunk = marshal.load(f)
+            except EOFError:
+                break
+            for item in chunk:
+                yield item
+    finally:
+        f.close()  # also when the merge is abandoned early
+
+
+def sortedSample(sample, runSize=p2pSortRunSize):
+    """
+    Iterate over sample in sorted order.  Samples of up to runSize
+    entries are sorted in memory.  Larger ones are sorted externally:
+    sorted runs of runSize entries are spilled to temporary files and
+    merged.
+    """
+    runs = []
+    current = []
+    for item in sample:
+        current.append(item)
+        if len(current) >= runSize:
+            current.sort()
+            runs.append(spillSortedRun(current))
+            current = []
+    current.sort()
+    if not runs:
+        return iter(current)
+    return heapq.merge(iter(current), *[readSpilledRun(f) for f in runs])
+
+
+def joinSamples(left, right):
+    """
+    Sort-merge join of two samples sorted by orthography.  For each
+    orthography found in both, all combinations of the left and right
+    pronunciations are generated as (left phon, right phon) pairs.
+    """
+    lefts = itertools.groupby(left, operator.itemgetter(0))
+    rights = itertools.groupby(right, operator.itemgetter(0))
+    try:
+        leftOrth, leftGroup = next(lefts)
+        rightOrth, rightGroup = next(rights)
+        while True:
+            if leftOrth < rightOrth:
+                leftOrth, leftGroup = next(lefts)
+            elif rightOrth < leftOrth:
+                rightOrth, rightGroup = next(rights)
+            else:
+                rightPhons = [phon for orth, phon in rightGroup]
+                for orth, leftPhon in leftGroup:
+                    for rightPhon in rightPhons:
+                        yield leftPhon, rightPhon
+                leftOrth, leftGroup = next(lefts)
+                rightOrth, rightGroup = next(rights)
+    except StopIteration:
+        return
+
+
+def readP2PSample(compfname):
     fnames = compfname.split(":")
     assert len(fnames) == 2
-    left = dict(loadG2PSample(fnames[0]))
-    right = dict(loadG2PSample(fnames[1]))
-    sample = []
-    for w in set(left.keys()) & set(right.keys()):
-        sample.append((left[w], right[w]))
-    return sample
+    left, right = [sortedSample(readG2PSample(fname)) for fname in fnames]
+    return joinSamples(left, right)
+
+
+def loadP2PSample(compfname):
+    return list(readP2PSample(compfname))
+
+
+def compileP2PSample(sequitur, compfname, portion=None, log=None):
+    """
+    Join the two lexicons of a phoneme-to-phoneme sample directly into
+    a CompiledSample of sequitur, without keeping the list of pairs.
+    A portion is split off as devel sample like partition_sample()
+    does.  Returns (train sample, devel sample).
+    """
+    parseLeft = sequitur.leftInventory.parse
+    parseRight = sequitur.rightInventory.parse
+    isDevelOrth = SequiturTool.isDevelOrth
+    train = CompiledSample()
+    devel = []
+    nEntries = 0
+    startTime = time.time()
+    for left, right in readP2PSample(compfname):
+        if portion is not None and isDevelOrth(left, portion):
+            devel.append((left, right))
+        else:
+            train.append(parseLeft(left), parseRight(right))
+        nEntries += 1
+    train.compact()
+    if log:
+        print(
+            "joined %d entries from %s in %.1fs"
+            % (nEntries, compfname, time.time() - startTime),
+            file=log,
+        )
+    return train, devel
 
 
 # ===========================================================================
@@ -162,6 +440,13 @@ class MemoryTranslator:
 
 
 # ===========================================================================
+supraSegmental = set([".", "'", '"'])
+
+
+def removeSupraSegmental(phon):
+    return tuple(p for p in phon if p not in supraSegmental)
+
+
 def mainTest(translator, testSample, options, output_file):
     if options.shouldTranspose:
         testSample = SequiturTool.transposeSample(testSample)
@@ -176,16 +461,53 @@ def mainTest(translator, testSample, options, output_file):
     evaluator.resultFile = resultFile
     evaluator.verboseLog = output_file
     if options.test_segmental:
-        supraSegmental = set([".", "'", '"'])
-
-        def removeSupraSegmental(phon):
-            return filter(lambda p: p not in supraSegmental, phon)
-
         evaluator.compareFilter = removeSupraSegmental
-    result = evaluator.evaluate(translator)
+    result = evaluator.evaluate(translator, options.jobs)
     print(result)
 
 
+class ApplyWriter(object):
+    """
+    Output stage of --apply.  Result lines are collected and written
+    to the binary stream out as encoded chunks of batchSize lines.
+
+    If inventory is given, pronunciations are written as
+    space-separated symbol indices of that inventory instead of the
+    symbols themselves.
+    """
+
+    batchSize = 1024
+
+    def __init__(self, out, encoding, inventory=None):
+        self.out = out
+        self.encoding = encoding
+        self.inventory = inventory
+        self.lines = []
+
+    def format(self, result):
+        if self.inventory is None:
+            return u" ".join(result)
+        return u" ".join(map(str, self.inventory.parse(result)))
+
+    def write(self, word, result):
+        self.lines.append(u"%s\t%s\n" % (word, self.format(result)))
+        if len(self.lines) >= self.batchSize:
+            self.flush()
+
+    def writeVariant(self, word, nVariant, posterior, result):
+        self.lines.append(
+            u"%s\t%d\t%f\t%s\n" % (word, nVariant, posterior, self.format(result))
+        )
+        if len(self.lines) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.out.write(u"".join(self.lines).encode(self.encoding))
+            self.lines = []
+        self.out.flush()
+
+
 def mainApply(translator, options, output_file):
     if options.phoneme_to_phoneme:
         words = readApplyP2P(options.applySample, options.encoding)
@@ -213,24 +535,19 @@ def mainApply(translator, options, output_file):
                     except StopIteration:
                         break
                     posterior = math.exp(logLik - nBest.logLikTotal)
-                    print(
-                        (
-                            "%s\t%d\t%f\t%s"
-                            % (word, nVariants, posterior, " ".join(result))
-                        ),
-                        file=output_file,
-                    )
+                    output_file.writeVariant(word, nVariants, posterior, result)
                     totalPosterior += posterior
                     nVariants += 1
             else:
                 result = translator(left)
-                print(("%s\t%s" % (word, " ".join(result))), file=output_file)
+                output_file.write(word, result)
         except translator.TranslationFailure:
             exc = sys.exc_info()[1]
             try:
                 print('failed to convert "%s": %s' % (word, exc), file=stderr)
             except:
                 pass
+    output_file.flush()
 
 
 def mainApplyWord(translator, options, output_file):
@@ -256,8 +573,12 @@ def main(options, args):
 
     if options.phoneme_to_phoneme:
         loadSample = loadP2PSample
+        streamSample = None
+        compileSample = compileP2PSample
     else:
         loadSample = loadG2PSample
+        streamSample = streamG2PSample
+        compileSample = compilePlainSample
 
     enc = locale.getpreferredencoding()
     if hasattr(sys.stdout, "buffer"):
@@ -285,7 +606,13 @@ def main(options, args):
     if options.fakeTranslator:
         translator = MemoryTranslator(loadSample(options.fakeTranslator))
     else:
-        model = SequiturTool.procureModel(options, loadSample, log=log_stdout)
+        model = SequiturTool.procureModel(
+            options,
+            loadSample,
+            log=log_stdout,
+            streamSample=streamSample,
+            compileSample=compileSample,
+        )
         if not model:
             return 1
         if options.testSample or options.applySample or options.applyWord:
@@ -299,9 +626,16 @@ def main(options, args):
         translator.reportStats(log_stdout)
 
     if options.applySample:
-        mainApply(
-            translator, options, gOpenOut("-", options.encoding or defaultEncoding)
+        if options.applyIds:
+            if not hasattr(translator, "sequitur"):
+                raise UsageError("--apply-ids needs a model")
+            inventory = translator.sequitur.rightInventory
+        else:
+            inventory = None
+        writer = ApplyWriter(
+            gOpenOut("-"), options.encoding or defaultEncoding, inventory
         )
+        mainApply(translator, options, writer)
         translator.reportStats(log_stderr)
 
     if options.applyWord:
@@ -373,6 +707,13 @@ if __name__ == "__main__":
         help="generate up to N pronunciation variants (only effective with --apply)",
         metavar="N",
     )
+    optparser.add_option(
+        "--apply-ids",
+        dest="applyIds",
+        action="store_true",
+        help="write pronunciations produced by --apply as indices of the "
+        "model's output symbols instead of the symbols themselves",
+    )
     optparser.add_option(
         "-f",
         "--fake",
@@ -27,22 +27,24 @@ negligent actions or intended actions or fraudulent concealment.
 """
 
 import marshal
-import os
 from mGramCounts import AbstractFileStorage
-from misc import restartable
+from misc import openCompressedIn, openCompressedOut, restartable
 import SparseVector
 
 
 class StoredCounts(AbstractFileStorage):
+    compression = "gzip"
+    compressionLevel = None
+
     def write(self, seq):
-        file = os.popen("gzip -fc >%s" % self.fname, "wb")
+        file = openCompressedOut(self.fname, self.compression, self.compressionLevel)
         for history, values in seq:
             marshal.dump(history, file)
             SparseVector.dump(values, file)
         file.close()
 
     def __iter__(self):
-        file = os.popen("gzip -dc %s" % self.fname, "rb")
+        file = openCompressedIn(self.fname, self.compression)
         while True:
             try:
                 history = marshal.load(file)
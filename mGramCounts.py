@@ -45,6 +45,7 @@ import sys
 from misc import sorted
 import marshal
 import os
+import struct
 import tempfile
 from heapq import heappush, heappop, heapreplace
 from misc import gOpenIn, gOpenOut
@@ -54,7 +55,7 @@ if sys.version_info[:2] >= (3, 0):
 
 # ===========================================================================
 from IterMap import (
-    mergeSort,
+    mergeConsolidated,
     # aggregate,
     consolidate,
     assertIsConsolidated,
@@ -170,17 +171,50 @@ class ListStorage(Storage):
 # ===========================================================================
 
 
+# Count files consist of blocks.  Each block is a header of a magic
+# string, the number of items and the payload size, followed by the
+# payload, which is the list of the block's items marshalled in one go.
+blockMagic = b"MGCB"
+blockHeader = struct.Struct("<4sII")
+blockSize = 4096  # items
+
+
+class CountFileFormatError(IOError):
+    pass
+
+
 class FileWriter(object):
-    def __init__(self, fname):
+    """
+    Writer of a count file.  compression is "gzip", "xz", "zstd" or
+    None, level None means the default of misc.compressionLevel.
+    """
+
+    def __init__(self, fname, compression="gzip", level=None):
         self.fname = fname
-        self.f = os.popen("gzip -fc >%s" % self.fname, "wb")
+        self.f = misc.openCompressedOut(self.fname, compression, level)
+        self.block = []
         self.n = 0
 
     def write(self, item):
-        marshal.dump(item, self.f)
-        self.n += 1
+        self.block.append(item)
+        if len(self.block) >= blockSize:
+            self.flush()
+
+    def writeBlock(self, items):
+        "Write a list of items."
+        self.flush()
+        payload = marshal.dumps(items)
+        self.f.write(blockHeader.pack(blockMagic, len(items), len(payload)))
+        self.f.write(payload)
+        self.n += len(items)
+
+    def flush(self):
+        if self.block:
+            block, self.block = self.block, []
+            self.writeBlock(block)
 
     def close(self):
+        self.flush()
         self.f.close()
         self.f = None
 
@@ -188,29 +222,51 @@ class FileWriter(object):
         assert self.f is None
 
 
-def writeToFile(fname, items):
-    w = FileWriter(fname)
-    for item in items:
-        w.write(item)
+def writeToFile(fname, items, compression="gzip", level=None):
+    w = FileWriter(fname, compression, level)
+    items = iter(items)
+    while True:
+        block = list(itertools.islice(items, blockSize))
+        if not block:
+            break
+        w.writeBlock(block)
     w.close()
     return w.n
 
 
 class FileReader(object):
-    def __init__(self, fname):
+    def __init__(self, fname, compression="gzip"):
         self.fname = fname
+        self.compression = compression
+
+    def blocks(self):
+        "Iterate over the lists of items of each block."
+        f = misc.openCompressedIn(self.fname, self.compression)
+        try:
+            while True:
+                header = f.read(blockHeader.size)
+                if not header:
+                    break
+                if len(header) < blockHeader.size:
+                    raise CountFileFormatError("truncated block header", self.fname)
+                magic, nItems, nBytes = blockHeader.unpack(header)
+                if magic != blockMagic:
+                    raise CountFileFormatError("not a count file", self.fname)
+                block = marshal.loads(f.read(nBytes))
+                if len(block) != nItems:
+                    raise CountFileFormatError("corrupt block", self.fname)
+                yield block
+        finally:
+            f.close()
 
     def __iter__(self):
-        f = os.popen("gzip -dc %s" % self.fname, "rb")
-        while True:
-            try:
-                yield marshal.load(f)
-            except EOFError:
-                break
-        f.close()
+        return itertools.chain.from_iterable(self.blocks())
 
 
 class AbstractFileStorage(object):
+    compression = "gzip"
+    compressionLevel = None
+
     def __init__(self, fname=None):
         self.isTemporary = fname is None
         if self.isTemporary:
@@ -230,27 +286,68 @@ class FileStorage(Storage, AbstractFileStorage):
     isConsolidated = True
 
     def set(self, other):
-        writeToFile(self.fname, other.iter(sorted=True, consolidated=True))
+        writeToFile(
+            self.fname,
+            other.iter(sorted=True, consolidated=True),
+            self.compression,
+            self.compressionLevel,
+        )
 
     def iter(self, sorted=True, consolidated=True):
-        return iter(FileReader(self.fname))
+        return iter(FileReader(self.fname, self.compression))
+
+
+def mergeFiles(task):
+    """
+    Merge and consolidate the sorted count files fnames into target.
+    Returns the number of items written.
+    """
+    fnames, target, compression, level = task
+    merged = mergeConsolidated([FileReader(f, compression) for f in fnames])
+    return writeToFile(target, merged, compression, level)
 
 
 class AbstractMultifileStorage(Storage):
+    """
+    External sort of counts: sorted and consolidated runs of up to
+    inMemoryLimit items are spilled to files, which are merged by a
+    loser tree, adding up the counts of equal keys on the way.  If
+    there are more than mergeFanIn files, groups of them are first
+    merged into intermediate files, by nJobs worker processes.
+    """
+
     hasRandomAccess = False
     isMutable = True
     isConsolidated = False
 
     inMemoryLimit = 10 ** 6
+    mergeFanIn = 64
+    nJobs = 1
+    compression = "gzip"  # of the files, see FileWriter
+    compressionLevel = None
 
     def __init__(self, dir=None):
         self.dir = tempfile.mkdtemp(dir=dir)
         self.files = []
+        self.nFilesCreated = 0
         self.nStoredItems = 0
 
     def setMemoryLimit(self, limit):
         self.inMemoryLimit = limit
 
+    def setJobs(self, nJobs):
+        self.nJobs = nJobs
+
+    def setCompression(self, compression, level=None):
+        self.compression = compression
+        self.compressionLevel = level
+
+    def openFile(self):
+        return FileWriter(self.newFile(), self.compression, self.compressionLevel)
+
+    def readFile(self, fname):
+        return FileReader(fname, self.compression)
+
     def clearFiles(self):
         for fname in self.files:
             os.unlink(fname)
@@ -262,21 +359,54 @@ class AbstractMultifileStorage(Storage):
             os.unlink(fname)
         os.rmdir(self.dir)
 
+    def newFileName(self):
+        fname = os.path.join(self.dir, str(self.nFilesCreated).zfill(8))
+        self.nFilesCreated += 1
+        return fname
+
     def newFile(self):
-        fname = os.path.join(self.dir, str(len(self.files)).zfill(8))
+        fname = self.newFileName()
         self.files.append(fname)
         return fname
 
     def flush(self):
         raise NotImplementedError
 
+    def reduceFiles(self):
+        "Merge files in groups until at most mergeFanIn are left."
+        while len(self.files) > self.mergeFanIn:
+            groups = [
+                self.files[i : i + self.mergeFanIn]
+                for i in range(0, len(self.files), self.mergeFanIn)
+            ]
+            targets = [self.newFileName() for group in groups]
+            tasks = [
+                (group, target, self.compression, self.compressionLevel)
+                for group, target in zip(groups, targets)
+            ]
+            if self.nJobs > 1 and len(tasks) > 1:
+                import multiprocessing
+
+                pool = multiprocessing.Pool(min(self.nJobs, len(tasks)))
+                try:
+                    counts = pool.map(mergeFiles, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                counts = list(map(mergeFiles, tasks))
+            for fname in self.files:
+                os.unlink(fname)
+            self.files = targets
+            self.nStoredItems = sum(counts)
+
     def iter(self, sorted=False, consolidated=False):
         self.flush()
-        iters = [FileReader(fname) for fname in self.files]
         if sorted or consolidated:
-            return consolidate(mergeSort(iters))
+            self.reduceFiles()
+            return mergeConsolidated([self.readFile(fname) for fname in self.files])
         else:
-            return itertools.chain(*iters)
+            return itertools.chain(*[self.readFile(fname) for fname in self.files])
 
 
 class SimpleMultifileStorage(AbstractMultifileStorage):
@@ -292,7 +422,7 @@ class SimpleMultifileStorage(AbstractMultifileStorage):
         return self.nStoredItems + len(self.current)
 
     def store(self, iter):
-        n = writeToFile(self.newFile(), iter)
+        n = writeToFile(self.newFile(), iter, self.compression, self.compressionLevel)
         self.nStoredItems += n
 
     def set(self, other):
@@ -303,7 +433,7 @@ class SimpleMultifileStorage(AbstractMultifileStorage):
         if len(self.current) == 0:
             return
         self.current.sort()
-        self.store(consolidate(self.current))
+        self.store(mergeConsolidated([self.current]))
         self.current = []
 
     def add(self, key, value):
@@ -345,7 +475,7 @@ class BiHeapMultifileStorage(AbstractMultifileStorage):
             else:
                 self.isUnderfull = False
                 assert self.currentFile is None
-                self.currentFile = FileWriter(self.newFile())
+                self.currentFile = self.openFile()
 
         if key < self.primary[0][0]:
             heappush(self.secondary, (key, value))
@@ -368,9 +498,9 @@ class BiHeapMultifileStorage(AbstractMultifileStorage):
     def flush(self):
         if self.primary:
             if self.currentFile is None:
-                self.currentFile = FileWriter(self.newFile())
+                self.currentFile = self.openFile()
             self.primary.sort()
-            for item in consolidate(self.primary):
+            for item in mergeConsolidated([self.primary]):
                 self.currentFile.write(item)
                 self.nStoredItems += 1
         if self.currentFile:
@@ -381,7 +511,10 @@ class BiHeapMultifileStorage(AbstractMultifileStorage):
         if self.secondary:
             self.secondary.sort()
             self.nStoredItems += writeToFile(
-                self.newFile(), consolidate(self.secondary)
+                self.newFile(),
+                mergeConsolidated([self.secondary]),
+                self.compression,
+                self.compressionLevel,
             )
         self.secondary = []
 
@@ -659,6 +792,13 @@ def createStorage(options):
     counts = storageClass()
     if options.memory_limit:
         counts.setMemoryLimit(options.memory_limit)
+    if options.jobs and hasattr(counts, "setJobs"):
+        counts.setJobs(options.jobs)
+    if hasattr(counts, "setCompression"):
+        if options.compression == "none":
+            counts.setCompression(None, options.compression_level)
+        else:
+            counts.setCompression(options.compression, options.compression_level)
     return counts
 
 
@@ -679,7 +819,7 @@ def main(options, args):
         if len(options.read) > 1:
             counts = createStorage(options)
             counts.addIter(
-                consolidate(mergeSort([TextStorage(fname) for fname in options.read]))
+                mergeConsolidated([TextStorage(fname) for fname in options.read])
             )
         else:
             counts = TextStorage(options.read[0])
@@ -725,6 +865,24 @@ if __name__ == "__main__":
 
     options.add_option("--storage-class", default="smf")
     options.add_option("--memory-limit", type="int")
+    options.add_option(
+        "--jobs",
+        type="int",
+        help="merge count files in N parallel processes",
+        metavar="N",
+    )
+    options.add_option(
+        "--compression",
+        choices=["none", "gzip", "xz", "zstd"],
+        default="gzip",
+        help="compression of temporary count files, none to write them "
+        "uncompressed (default: %default)",
+    )
+    options.add_option(
+        "--compression-level",
+        type="int",
+        help="compression level of temporary count files",
+    )
 
     options, args = options.parse_args()
     tool.run(main, options, args)
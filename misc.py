@@ -249,15 +249,89 @@ def reportMemoryProfile(root):
 # ===========================================================================
 
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compressionByExtension = {
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".zst": "zstd",
+}
+compressionLevel = {"gzip": 6, "xz": 6, "zstd": 3}
+compressionBlockSize = 1 << 20  # bytes
+
+
+def compressionOf(fname):
+    return compressionByExtension.get(os.path.splitext(fname)[1])
+
+
+def openCompressedOut(fname, compression=None, level=None, blockSize=None):
+    """
+    Open binary output file fname, compressed in-process with
+    compression, which is one of "gzip", "xz" or "zstd" (the latter
+    needs the zstandard module), or None for no compression.  level
+    defaults to compressionLevel[compression].  Output is buffered in
+    blocks of blockSize bytes.
+    """
+    blockSize = blockSize or compressionBlockSize
+    if compression is None:
+        return io.open(fname, "wb", buffering=blockSize)
+    if level is None:
+        level = compressionLevel[compression]
+    if compression == "gzip":
+        out = gzip.GzipFile(fname, "wb", compresslevel=level)
+    elif compression == "xz":
+        if lzma is None:
+            raise ValueError("xz compression needs the lzma module")
+        out = lzma.LZMAFile(fname, "wb", preset=level)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard module")
+        compressor = zstandard.ZstdCompressor(level=level)
+        out = compressor.stream_writer(io.open(fname, "wb"))
+    else:
+        raise ValueError("unknown compression", compression)
+    return io.BufferedWriter(out, blockSize)
+
+
+def openCompressedIn(fname, compression=None, blockSize=None):
+    "Counterpart of openCompressedOut()."
+    blockSize = blockSize or compressionBlockSize
+    if not os.path.isfile(fname):
+        raise IOError(errno.ENOENT, "No such file: '%s'" % fname)
+    if compression is None:
+        return io.open(fname, "rb", buffering=blockSize)
+    if compression == "gzip":
+        inp = gzip.GzipFile(fname, "rb")
+    elif compression == "xz":
+        if lzma is None:
+            raise ValueError("xz compression needs the lzma module")
+        inp = lzma.LZMAFile(fname, "rb")
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard module")
+        decompressor = zstandard.ZstdDecompressor()
+        inp = decompressor.stream_reader(io.open(fname, "rb"))
+    else:
+        raise ValueError("unknown compression", compression)
+    return io.BufferedReader(inp, blockSize)
+
+
 def gOpenOut(fname, encoding=None):
     if fname == "-":
         if hasattr(sys.stdout, "buffer"):
             out = sys.stdout.buffer
         else:
             out = sys.stdout
-    elif os.path.splitext(fname)[1] == ".gz":
-        out = os.popen("gzip -fc >%s" % fname, "w")
-    #       out = gzip.open(fname, 'w')
+    elif compressionOf(fname):
+        out = openCompressedOut(fname, compressionOf(fname))
     else:
         out = io.open(fname, "w", encoding=encoding)
         return out
@@ -274,10 +348,8 @@ def gOpenIn(fname, encoding=None):
             inp = sys.stdin.buffer
         else:
             inp = sys.stdin
-    elif os.path.splitext(fname)[1] == ".gz":
-        if not os.path.isfile(fname):
-            raise IOError(errno.ENOENT, "No such file: '%s'" % fname)
-        inp = gzip.open(fname, "rb")
+    elif compressionOf(fname):
+        inp = openCompressedIn(fname, compressionOf(fname))
     else:
         inp = io.open(fname, encoding=encoding)
         return inp
@@ -287,6 +359,20 @@ def gOpenIn(fname, encoding=None):
     return inp
 
 
+def gOpenInBinary(fname):
+    """
+    Like gOpenIn() without encoding, but plain files are opened in
+    binary mode too, so the result is always a buffered binary stream
+    supporting peek().
+    """
+    if fname == "-":
+        if hasattr(sys.stdin, "buffer"):
+            return sys.stdin.buffer
+        return io.open(sys.stdin.fileno(), "rb", closefd=False)
+    else:
+        return openCompressedIn(fname, compressionOf(fname))
+
+
 # ===========================================================================
 
 
@@ -97,34 +97,65 @@ namespace AssertionsPrivate {
 %}
 
 %native(align) python_align;
+%native(alignSymbols) python_alignSymbols;
+%native(editDistance) python_editDistance;
+%native(editCounts) python_editCounts;
+%native(editDistances) python_editDistances;
+%native(alignClosest) python_alignClosest;
+%native(closestEditCounts) python_closestEditCounts;
 
 // ===========================================================================
 %{
 #include "Multigram.hh"
-%}
 
-#ifdef SWIGPYTHON
-%typemap(in) Sequence {
-    PyObject *seq = PySequence_Fast($input, "not a sequence");
-    if (!seq) SWIG_fail;
+/** @return false and set a Python exception on failure */
+static bool sequenceFromPyObject(PyObject *obj, Sequence &result) {
+    if (PyObject_CheckBuffer(obj)) {
+        // fast path for array('H') / memoryview / numpy.uint16 buffers
+        Py_buffer view;
+        if (PyObject_GetBuffer(obj, &view, PyBUF_CONTIG_RO | PyBUF_FORMAT) == 0) {
+            const char *format = view.format ? view.format : "B";
+            if (*format == '@' || *format == '=') ++format;
+            bool matches = (view.itemsize == sizeof(Symbol)) &&
+                (std::string(format) == ((sizeof(Symbol) == 1) ? "B" : "H"));
+            if (matches) {
+                const Symbol *data = static_cast<const Symbol*>(view.buf);
+                result.assign(data, data + view.len / sizeof(Symbol));
+            }
+            PyBuffer_Release(&view);
+            if (matches) return true;
+        } else {
+            PyErr_Clear();
+        }
+    }
+    PyObject *seq = PySequence_Fast(obj, "not a sequence");
+    if (!seq) return false;
     int length = PySequence_Fast_GET_SIZE(seq);
-    $1.reserve(length);
+    result.clear();
+    result.reserve(length);
     for (int i = 0; i < length; ++i) {
         PyObject *sym = PySequence_Fast_GET_ITEM(seq, i);
         if (!PyInt_Check(sym)) {
             Py_DECREF(seq);
             PyErr_Format(PyExc_TypeError, "element %d not an integer", i);
-            SWIG_fail;
+            return false;
         }
         long ind = PyInt_AsLong(sym);
         if (ind < 0 || ind > Core::Type<Symbol>::max) {
             Py_DECREF(seq);
             PyErr_Format(PyExc_ValueError, "symbol out of range: %ld", ind);
-            SWIG_fail;
+            return false;
         }
-        $1.push_back(ind);
+        result.push_back(ind);
     }
     Py_DECREF(seq);
+    return true;
+}
+%}
+
+#ifdef SWIGPYTHON
+%typemap(in) Sequence {
+    if (!sequenceFromPyObject($input, $1)) SWIG_fail;
 }
 
 %typemap(in) Multigram {
@@ -204,6 +235,11 @@ public:
 
     PyObject *historyAsTuple(SequenceModel::History) const;
     Probability probability(Token, SequenceModel::History) const;
+    int revision() const;
+    void quantize(int bits);
+    int quantization() const;
+    PyObject *codebook() const;
+    void setCodebook(int bits, PyObject*);
 
     int memoryUsed();
 };
@@ -244,6 +280,53 @@ public:
     void update(EstimationGraph*);
     int memoryUsed();
 };
+%extend EstimationGraphBuilder {
+    /**
+     * Build graphs for a sequence of (left, right) pairs in parallel.
+     * Returns a list containing a graph, or None if the sample has no
+     * segmentation, for each pair.
+     */
+    PyObject *createMany(PyObject *samples, int nThreads) {
+        PyObject *seq = PySequence_Fast(samples, "not a sequence");
+        if (!seq) throw ExistingPythonException();
+        int length = PySequence_Fast_GET_SIZE(seq);
+        std::vector<Sequence> lefts(length), rights(length);
+        for (int i = 0; i < length; ++i) {
+            PyObject *left, *right;
+            if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(seq, i), "OO", &left, &right) ||
+                !sequenceFromPyObject(left, lefts[i]) ||
+                !sequenceFromPyObject(right, rights[i])) {
+                Py_DECREF(seq);
+                throw ExistingPythonException();
+            }
+        }
+        Py_DECREF(seq);
+
+        std::vector<EstimationGraph*> graphs;
+        std::exception_ptr error;
+        Py_BEGIN_ALLOW_THREADS
+        try {
+            self->createMany(lefts, rights, graphs, std::max(nThreads, 0));
+        } catch (...) {
+            error = std::current_exception();
+        }
+        Py_END_ALLOW_THREADS
+        if (error) std::rethrow_exception(error);
+
+        PyObject *result = PyList_New(length);
+        for (int i = 0; i < length; ++i) {
+            PyObject *item;
+            if (graphs[i]) {
+                item = SWIG_NewPointerObj(SWIG_as_voidptr(graphs[i]), SWIGTYPE_p_EstimationGraph, SWIG_POINTER_OWN);
+            } else {
+                Py_INCREF(Py_None);
+                item = Py_None;
+            }
+            PyList_SET_ITEM(result, i, item);
+        }
+        return result;
+    }
+};
 
 class SequenceModelEstimator {};
 
@@ -251,13 +334,19 @@ class EvidenceStore {
 public:
     EvidenceStore();
     void setSequenceModel(SequenceModel*);
+    void setAcceptAnonymized(bool);
+    void setThreshold(double);
+    int prune(double minimum);
+    void interpolate(double weight, const EvidenceStore &other, double otherWeight);
     PyObject *asList();
+    PyObject *mostEvident(int limit);
+    PyObject *leastEvident(int limit);
     size_t size();
     int maximumHistoryLength();
     Probability maximum();
     Probability total();
 
-    SequenceModelEstimator *makeSequenceModelEstimator();
+    SequenceModelEstimator *makeSequenceModelEstimator(int nThreads = 1);
 
     int memoryUsed();
 };
@@ -272,6 +361,23 @@ public:
             (double*) PyArray_DATA(discountArray) + PyArray_DIMS(discountArray)[0]);
         self->makeSequenceModel(target, vocabularySize, discounts);
     }
+    void updateSequenceModel(
+        SequenceModel *target,
+        double vocabularySize,
+        DoubleVector discountArray)
+    {
+        std::vector<double> discounts(
+            (double*) PyArray_DATA(discountArray),
+            (double*) PyArray_DATA(discountArray) + PyArray_DIMS(discountArray)[0]);
+        self->updateSequenceModel(target, vocabularySize, discounts);
+    }
+    PyObject *logLikGradient(const EvidenceStore *posteriors) {
+        std::vector<double> gradient = self->logLikGradient(*posteriors);
+        PyObject *result = PyList_New(gradient.size());
+        for (u32 k = 0; k < gradient.size(); ++k)
+            PyList_SET_ITEM(result, k, PyFloat_FromDouble(gradient[k]));
+        return result;
+    }
 };
 
 
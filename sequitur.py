@@ -28,7 +28,7 @@ commercially. In any case guarantee/warranty shall be limited to gross
 negligent actions or intended actions or fraudulent concealment.
 """
 
-import itertools, math, sys
+import array, itertools, math, random, sys, time
 import numpy as num
 import sequitur_, SequenceModel, Minimization, misc
 from symbols import SymbolInventory
@@ -74,10 +74,29 @@ class Sequitur:
         )
 
     def compileSample(self, sample):
-        return [
-            (self.leftInventory.parse(left), self.rightInventory.parse(right))
-            for left, right in sample
-        ]
+        """
+        Samples that declare themselves re-readable, by a true
+        isRereadable attribute, are streamed.  Any other iterable,
+        which might be exhausted after one pass, is compiled in memory.
+        """
+        if isinstance(sample, (CompiledSample, CompiledSampleStream)):
+            return sample
+        if getattr(sample, "isRereadable", False):
+            # Register all symbols up front, so that the inventory sizes
+            # are known before training starts.
+            size = 0
+            for left, right in sample:
+                self.leftInventory.parse(left)
+                self.rightInventory.parse(right)
+                size += 1
+            return CompiledSampleStream(self, sample, size)
+        result = CompiledSample()
+        for left, right in sample:
+            result.append(
+                self.leftInventory.parse(left), self.rightInventory.parse(right)
+            )
+        result.compact()
+        return result
 
     def symbol(self, i):
         "multigramFromTokenIndex"
@@ -128,6 +147,11 @@ class Model(object):
 
         return oldSequitur.inventory.size(), self.sequitur.inventory.size()
 
+    def prune(self, threshold):
+        oldSize = self.sequenceModel.size()
+        self.sequenceModel.prune(threshold)
+        return oldSize, self.sequenceModel.size()
+
     def transpose(self):
         oldInventory = self.sequitur.inventory
         self.sequitur = Sequitur(
@@ -169,7 +193,133 @@ class EstimationGraphBuilder(sequitur_.EstimationGraphBuilder):
             self.addSizeTemplate(left, right)
 
 
+if sys.version_info[:2] >= (3, 0):
+
+    def symbolBytes(symbols):
+        return symbols.tobytes()
+
+    def symbolView(symbols, begin, end):
+        return memoryview(symbols)[begin:end]
+
+
+else:
+
+    def symbolBytes(symbols):
+        return symbols.tostring()
+
+    def symbolView(symbols, begin, end):
+        return tuple(symbols[begin:end])
+
+
+class CompiledSample(object):
+    """
+    Compact storage of a compiled sample.  The symbol indices of all
+    left and right sequences are concatenated into two flat arrays,
+    delimited by offset arrays.  Identical (left, right) pairs are
+    stored only once, with a weight counting their occurrences.
+
+    Items are (left, right) pairs of buffer views, which the extension
+    module reads without conversion.
+    """
+
+    def __init__(self):
+        self.left = array.array("H")
+        self.right = array.array("H")
+        self.leftOffsets = array.array("L", [0])
+        self.rightOffsets = array.array("L", [0])
+        self.weights = array.array("L")
+        self.positions = {}
+
+    @classmethod
+    def fromPairs(cls, pairs):
+        result = cls()
+        for left, right in pairs:
+            result.append(left, right)
+        result.compact()
+        return result
+
+    def append(self, left, right):
+        left = array.array("H", left)
+        right = array.array("H", right)
+        # The index maps hash values rather than the symbol strings
+        # themselves, which would duplicate the whole sample in memory.
+        # Colliding entries are probed at the following hash values.
+        key = hash((symbolBytes(left), symbolBytes(right)))
+        while True:
+            i = self.positions.get(key)
+            if i is None:
+                break
+            if (
+                self.left[self.leftOffsets[i] : self.leftOffsets[i + 1]] == left
+                and self.right[self.rightOffsets[i] : self.rightOffsets[i + 1]] == right
+            ):
+                self.weights[i] += 1
+                return
+            key += 1
+        self.positions[key] = len(self.weights)
+        self.left.extend(left)
+        self.right.extend(right)
+        self.leftOffsets.append(len(self.left))
+        self.rightOffsets.append(len(self.right))
+        self.weights.append(1)
+
+    def compact(self):
+        "Discard the index used for merging duplicates."
+        self.positions = None
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return (
+            symbolView(self.left, self.leftOffsets[i], self.leftOffsets[i + 1]),
+            symbolView(self.right, self.rightOffsets[i], self.rightOffsets[i + 1]),
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["positions"] = None
+        return state
+
+
+class CompiledSampleStream(object):
+    """
+    Re-iterable sample that maps symbols to indices on the fly.  The
+    underlying sample is traversed anew on each iteration, so it must
+    be re-iterable itself, e.g. a reader that re-opens a file.  Its
+    number of entries is counted once, when it is compiled.
+    """
+
+    def __init__(self, sequitur, sample, size):
+        self.sequitur = sequitur
+        self.sample = sample
+        self.size = size
+
+    def __iter__(self):
+        leftInventory = self.sequitur.leftInventory
+        rightInventory = self.sequitur.rightInventory
+        for left, right in self.sample:
+            yield leftInventory.parse(left), rightInventory.parse(right)
+
+
 class Sample(object):
+    """
+    The sample is either a CompiledSample or a list of (left, right)
+    pairs, which is stored as a CompiledSample, or a
+    CompiledSampleStream, which is never held in memory and whose
+    graphs are built on demand.
+    """
+
     def __init__(self, sequitur, sizeTemplates, emergenceMode, sample, model):
         self.sequitur = sequitur
         self.sizeTemplates = sizeTemplates
@@ -177,10 +327,17 @@ class Sample(object):
         self.builder = EstimationGraphBuilder()
         self.builder.setSizeTemplates(self.sizeTemplates)
         self.builder.setEmergenceMode(self.emergenceMode)
-        self.sample = sample
+        if isinstance(sample, CompiledSampleStream):
+            self.sample, self.weights = sample, None
+        elif isinstance(sample, CompiledSample):
+            self.sample, self.weights = sample, sample.weights
+        else:
+            sample = CompiledSample.fromPairs(sample)
+            self.sample, self.weights = sample, sample.weights
 
         self.masterModel = model
         self.currentModel = None
+        self.currentRevision = None
         self.storedGraphs = None
 
     def __getstate__(self):
@@ -189,42 +346,118 @@ class Sample(object):
             "sizeTemplates": self.sizeTemplates,
             "emergenceMode": self.emergenceMode,
             "sample": self.sample,
+            "weights": self.weights,
             "masterModel": self.masterModel,
         }
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
+        if "weights" not in state:
+            self.sample = CompiledSample.fromPairs(self.sample)
+            self.weights = self.sample.weights
         self.builder = EstimationGraphBuilder()
         self.builder.setSizeTemplates(self.sizeTemplates)
         self.builder.setEmergenceMode(self.emergenceMode)
         self.currentModel = None
+        self.currentRevision = None
         self.storedGraphs = None
 
-    def size(self):
-        return len(self.sample)
+    def isStream(self):
+        return self.weights is None
 
-    def makeGraphs(self):
-        for left, right in self.sample:
-            self.builder.setSequenceModel(self.sequitur.inventory, self.masterModel)
-            try:
-                eg = self.builder.create(left, right)
-            except RuntimeError:
-                error = sys.exc_info()[1]
-                if str(error) != "final node not reachable":
-                    raise
+    def setMasterModel(self, model):
+        """
+        Switch to a master model with other histories, e.g. after ramp
+        up.  The graphs expand their nodes by history, so they are
+        rebuilt.
+        """
+        self.masterModel = model
+        self.currentModel = None
+        self.currentRevision = None
+        self.storedGraphs = None
+
+    def size(self):
+        if self.isStream():
+            return self.sample.size
+        return sum(self.weights)
+
+    def buildGraphs(self, pairs, weights):
+        self.builder.setSequenceModel(self.sequitur.inventory, self.masterModel)
+        graphs = []
+        for eg, pair, weight in zip(
+            self.builder.createMany(pairs, self.nJobs), pairs, weights
+        ):
+            if eg is None:
+                left, right = pair
                 print(
                     "warning: dropping one sample that has no segmentation",
-                    repr((left, right)),
+                    repr((tuple(left), tuple(right))),
                 )
                 continue
             eg.thisown = True
+            graphs.append((eg, weight))
+        return graphs
+
+    def batches(self, size=None):
+        if size is None:
+            size = self.maxStoredGraphs
+        if self.isStream():
+            batch = []
+            for pair in self.sample:
+                batch.append(pair)
+                if len(batch) >= size:
+                    yield batch, [1] * len(batch)
+                    batch = []
+            if batch:
+                yield batch, [1] * len(batch)
+        else:
+            for begin in range(0, len(self.sample), size):
+                end = begin + size
+                yield self.sample[begin:end], self.weights[begin:end]
+
+    def part(self, pairs, weights):
+        """
+        Sample of the given pairs sharing the configuration of this
+        one.  It stores its graphs only if this sample would.
+        """
+        result = Sample(
+            self.sequitur, self.sizeTemplates, self.emergenceMode, [], self.masterModel
+        )
+        result.sample, result.weights = list(pairs), list(weights)
+        result.nJobs = self.nJobs
+        result.storeGraphs = self.shouldStoreGraphs()
+        return result
+
+    def minibatches(self, size, seed=0):
+        """
+        Split the sample into parts of (at most) size distinct pairs.
+        Pairs are shuffled, so that no part is biased towards some
+        region of the lexicon; a stream is split in its own order.
+        """
+        if self.isStream():
+            for pairs, weights in self.batches(size):
+                yield self.part(pairs, weights)
+        else:
+            order = list(range(len(self.sample)))
+            random.Random(seed).shuffle(order)
+            for begin in range(0, len(order), size):
+                indices = order[begin : begin + size]
+                yield self.part(
+                    [self.sample[i] for i in indices], [self.weights[i] for i in indices]
+                )
+
+    def makeGraphs(self):
+        for pairs, weights in self.batches():
+            graphs = self.buildGraphs(pairs, weights)
             if self.currentModel is not self.masterModel:
                 self.builder.setSequenceModel(
                     self.sequitur.inventory, self.currentModel
                 )
-                self.builder.update(eg)
-            yield eg
+                for eg, weight in graphs:
+                    self.builder.update(eg)
+            for eg, weight in graphs:
+                yield eg, weight
 
     class GraphsOnDemand:
         def __init__(self, master, model):
@@ -236,49 +469,56 @@ class Sample(object):
             return self.master.makeGraphs()
 
     maxStoredGraphs = 5000
+    storeGraphs = None  # None: if there are at most maxStoredGraphs
+    nJobs = 1
+
+    def shouldStoreGraphs(self):
+        if self.storeGraphs is not None:
+            return self.storeGraphs
+        return not (self.isStream() or len(self.sample) > self.maxStoredGraphs)
 
     def graphs(self, model):
-        if len(self.sample) > self.maxStoredGraphs:
+        """
+        Return an iterable of (graph, weight) pairs, where weight is the
+        number of times the sample contains the graph's (left, right)
+        pair.
+        """
+        if not self.shouldStoreGraphs():
             self.currentModel = model
             return self.GraphsOnDemand(self, model)
         else:
             if self.storedGraphs is None:
-                self.builder.setSequenceModel(self.sequitur.inventory, self.masterModel)
-                graphs = []
-                for left, right in self.sample:
-                    try:
-                        eg = self.builder.create(left, right)
-                    except RuntimeError:
-                        error = sys.exc_info()[1]
-                        if str(error) != "final node not reachable":
-                            raise
-                        print(
-                            "warning: dropping one sample that has no segmentation",
-                            repr((left, right)),
-                        )
-                        continue
-                    eg.thisown = True
-                    graphs.append(eg)
-                self.storedGraphs = graphs
+                self.storedGraphs = self.buildGraphs(self.sample, self.weights)
                 self.currentModel = self.masterModel
-            if model is not self.currentModel:
+                self.currentRevision = self.masterModel.revision()
+            # The revision changes when a model is re-estimated in place.
+            if (
+                model is not self.currentModel
+                or model.revision() != self.currentRevision
+            ):
                 self.builder.setSequenceModel(self.sequitur.inventory, model)
-                for eg in self.storedGraphs:
+                for eg, weight in self.storedGraphs:
                     self.builder.update(eg)
                 self.currentModel = model
+                self.currentRevision = model.revision()
             return self.storedGraphs
 
-    def evidence(self, model, useMaximumApproximation):
+    def evidence(
+        self, model, useMaximumApproximation, shouldAcceptAnonymized=False, threshold=None
+    ):
         evidences = sequitur_.EvidenceStore()
         evidences.setSequenceModel(model)
+        evidences.setAcceptAnonymized(shouldAcceptAnonymized)
+        if threshold:
+            evidences.setThreshold(threshold)
         if useMaximumApproximation:
             accumulator = sequitur_.ViterbiAccumulator()
         else:
             accumulator = sequitur_.Accumulator()
         accumulator.setTarget(evidences)
         logLik = 0.0
-        for eg in self.graphs(model):
-            logLik += accumulator.accumulate(eg, 1.0)
+        for eg, weight in self.graphs(model):
+            logLik += weight * accumulator.accumulate(eg, weight)
         misc.reportMemoryUsage()
         return evidences, logLik
 
@@ -288,8 +528,8 @@ class Sample(object):
         else:
             accumulator = sequitur_.Accumulator()
         logLik = 0.0
-        for eg in self.graphs(model):
-            logLik += accumulator.logLik(eg)
+        for eg, weight in self.graphs(model):
+            logLik += weight * accumulator.logLik(eg)
         return logLik
 
     def overlappingOccurenceCounts(self, model):
@@ -297,8 +537,8 @@ class Sample(object):
         counts.setSequenceModel(model)
         accumulator = sequitur_.OneForAllAccumulator()
         accumulator.setTarget(counts)
-        for eg in self.graphs(model):
-            accumulator.accumulate(eg, 1.0)
+        for eg, weight in self.graphs(model):
+            accumulator.accumulate(eg, weight)
         return counts
 
 
@@ -308,6 +548,7 @@ class TrainingContext:
         self.order = None
         self.logLikTrain = []
         self.logLikDevel = []
+        self.iterationTimes = []
         self.bestModel = None
         self.bestLogLik = None
         self.log = sys.stdout
@@ -377,9 +618,22 @@ class DefaultDiscountAdjuster:
         self.discounts = [None, discount]
         self.shallUseMaximumApproximation = useMaximumApproximation
 
+    def trialSequenceModel(self, estimator, discount):
+        """
+        Sequence model for one step of the discount search.  The model
+        is built on the first step only; later steps just rewrite its
+        probabilities and back-off weights.
+        """
+        if self.trialModel is None:
+            self.trialModel = SequenceModel.SequenceModel()
+        estimator.updateSequenceModel(
+            self.trialModel, self.modelFactory.nPossibleMultigrams(), discount
+        )
+        return self.trialModel
+
     def adjustOrderZero(self, evidence, maximumDiscount):
         def criterion(discount):
-            sm = self.modelFactory.sequenceModel(evidence, [max(0.0, discount)])
+            sm = self.trialSequenceModel(evidence, [max(0.0, discount)])
             ll = self.develSample.logLik(sm, self.shallUseMaximumApproximation)
             crit = -ll - min(discount, 0) + max(discount - maximumDiscount, 0)
             print(discount, ll, crit)  # TESTING
@@ -401,19 +655,15 @@ class DefaultDiscountAdjuster:
 
     def adjustHigherOrder(self, evidence, order, maximumDiscount):
         def criterion(discount):
-            disc = tuple(num.maximum(0.0, discount))
-            sm = self.modelFactory.sequenceModel(evidence, disc)
-            ll = self.develSample.logLik(sm, self.shallUseMaximumApproximation)
-            crit = (
-                -ll
-                - sum(num.minimum(discount, 0))
-                + sum(num.maximum(discount - maximumDiscount, 0))
+            sm = self.trialSequenceModel(evidence, discount)
+            posteriors, ll = self.develSample.evidence(
+                sm, self.shallUseMaximumApproximation, shouldAcceptAnonymized=True
             )
-            print(discount, ll, crit)  # TESTING
-            return crit
+            gradient = num.array(evidence.logLikGradient(posteriors))
+            print(discount, ll, gradient)  # TESTING
+            return -ll, -gradient
 
         initialGuess = self.discounts[-1]
-        firstDirection = None
         if initialGuess is None:
             initialGuess = 0.1 * num.arange(1, order + 2, dtype=num.float64)
         elif len(initialGuess) < order + 1:
@@ -421,42 +671,36 @@ class DefaultDiscountAdjuster:
             oldSize = len(initialGuess)
             initialGuess = num.zeros(order + 1, dtype=num.float64)
             initialGuess[:oldSize] = oldGuess
-            initialGuess[oldSize:] = oldGuess[-1]
+            # Neither a zero discount, which leaves nothing for unseen
+            # events, nor one exceeding all evidence gives a useful
+            # gradient, so new orders start small.
+            initialGuess[oldSize:] = 0.1 * num.arange(oldSize + 1, order + 2)
         elif len(initialGuess) > order + 1:
             initialGuess = initialGuess[: order + 1]
-        else:
-            previous = self.discounts[-2]
-            if previous is not None and len(previous) == order + 1:
-                firstDirection = initialGuess - previous
-                if not num.sometrue(num.abs(firstDirection) > 1e-4):
-                    firstDirection = None
-
-        directions = num.identity(order + 1, dtype=num.float64)
-        directions = directions[::-1]
-        if firstDirection is not None:
-            directions = num.concatenate((firstDirection[num.newaxis, :], directions))
-        directions *= 0.1
-        print(directions)  # TESTING
-
-        discount, ll = Minimization.directionSetMinimization(
-            criterion, initialGuess, directions, tolerance=1e-4
-        )
 
-        discount = num.maximum(0.0, discount)
+        discount, ll = Minimization.boundedQuasiNewtonMinimization(
+            criterion,
+            initialGuess,
+            num.zeros(order + 1),
+            num.repeat(maximumDiscount, order + 1),
+            tolerance=1e-3,
+        )
         return discount, -ll
 
     def adjust(self, context, evidence, order):
         if self.shouldAdjustDiscount(context, evidence):
             print("adjusting discount ...", file=context.log)
             maximumDiscount = min(evidence.maximum(), self.maximumReasonableDiscount)
-            evidence = evidence.makeSequenceModelEstimator()
+            evidence = evidence.makeSequenceModelEstimator(self.modelFactory.nJobs)
             evidence.thisown = True
+            self.trialModel = None
             if order == 0:
                 discount, logLik = self.adjustOrderZero(evidence, maximumDiscount)
             else:
                 discount, logLik = self.adjustHigherOrder(
                     evidence, order, maximumDiscount
                 )
+            self.trialModel = None
             self.discounts.append(discount)
             print("optimal discount: %s" % discount, file=context.log)
             print("max. rel. change: %s" % self.maxRelChange(), file=context.log)
@@ -469,7 +713,7 @@ class DefaultDiscountAdjuster:
         if len(context.logLikDevel) < 1:
             return True
         tentativeModel = self.modelFactory.sequenceModel(evidence, self.discounts[-1])
-        logLikDevel = context.develSample.logLik(
+        logLikDevel = context.develCheckSample.logLik(
             tentativeModel, self.shallUseMaximumApproximation
         )
         return logLikDevel <= context.logLikDevel[-1]
@@ -494,6 +738,63 @@ class EagerDiscountAdjuster(DefaultDiscountAdjuster):
         return True
 
 
+class SignificantDecrease:
+    """
+    Convergence criterion: stop when the log-likelihood shows no
+    significant increase over the last window iterations.
+    """
+
+    threshold = 1e-6  # only for projecting the remaining iterations
+
+    def __init__(self, window=10):
+        self.window = window
+
+    def hasConverged(self, logLiks):
+        crit = [-ll for ll in logLiks[-self.window :]]
+        return not Minimization.hasSignificantDecrease(crit)
+
+
+class RelativeImprovement(SignificantDecrease):
+    """
+    Convergence criterion: stop when for patience iterations in a row
+    the log-likelihood fails to exceed the best one so far by a
+    fraction of threshold.
+    """
+
+    def __init__(self, threshold=1e-5, patience=3):
+        self.threshold = threshold
+        self.patience = patience
+
+    def hasConverged(self, logLiks):
+        best = logLiks[0]
+        stale = 0
+        for ll in logLiks[1:]:
+            if ll > best + self.threshold * abs(best):
+                stale = 0
+            else:
+                stale += 1
+            best = max(best, ll)
+        return stale >= self.patience
+
+
+def projectedIterations(logLiks, threshold):
+    """
+    Number of further iterations until the improvement per iteration
+    falls below threshold relative to the log-likelihood, assuming
+    that improvements keep shrinking at their latest rate.  None if
+    there is no such trend.
+    """
+    if len(logLiks) < 3:
+        return None
+    last, previous = logLiks[-1] - logLiks[-2], logLiks[-2] - logLiks[-3]
+    target = threshold * abs(logLiks[-1])
+    if last <= target:
+        return 0
+    if not 0.0 < last < previous:
+        return None
+    return int(math.ceil(math.log(target / last) / math.log(last / previous)))
+
+
 class ModelTemplate:
     sizeTemplates = [(1, 1), (1, 0), (0, 1)]
 
@@ -546,23 +847,18 @@ class ModelTemplate:
     def sequenceModel(self, evidence, discount):
         result = SequenceModel.SequenceModel()
         if type(evidence) is not sequitur_.SequenceModelEstimator:
-            evidence = evidence.makeSequenceModelEstimator()
+            evidence = evidence.makeSequenceModelEstimator(self.nJobs)
             evidence.thisown = True
         evidence.makeSequenceModel(result, self.nPossibleMultigrams(), discount)
         return result
 
     # =======================================================================
     def showMostEvident(self, f, evidence, limit):
-        sample = evidence.asList()
-        sample = [(value, predicted, history) for history, predicted, value in sample]
-        sample.sort()
-        sample.reverse()
-
         def asString(index):
             left, right = self.sequitur.symbol(index)
             return "".join(left) + ":" + "_".join(right)
 
-        def show(value, predicted, history):
+        def show(history, predicted, value):
             print(
                 "    ",
                 value,
@@ -573,16 +869,17 @@ class ModelTemplate:
                 file=f,
             )
 
-        if limit and 1.5 * limit < len(sample):
-            for vph in sample[:limit]:
-                show(*vph)
+        size = evidence.size()
+        if limit and 1.5 * limit < size:
+            for hpv in evidence.mostEvident(limit):
+                show(*hpv)
             print("    ...", file=f)
-            for vph in sample[-limit // 2 :]:
-                show(*vph)
+            for hpv in evidence.leastEvident(limit // 2):
+                show(*hpv)
         else:
-            for vph in sample:
-                show(*vph)
-        print(len(sample), "evidences total", file=f)
+            for hpv in evidence.mostEvident(size):
+                show(*hpv)
+        print(size, "evidences total", file=f)
         print(self.sequitur.inventory.size(), "multigrams ever seen", file=f)
 
     # =======================================================================
@@ -623,14 +920,91 @@ class ModelTemplate:
 
         context.log.flush()
 
-    def iterate(self, context):
-        evidence, logLikTrain = context.trainSample.evidence(
-            context.model.sequenceModel, self.shallUseMaximumApproximation
+    def stepwiseEvidence(self, context):
+        """
+        E-step of stepwise EM: one pass over the training sample in
+        mini-batches, re-estimating the model after each of them.  The
+        running evidence is interpolated with the evidence of each
+        batch, scaled up to the size of the whole sample, using a step
+        size of (k + 1) ** -stepSizeDecay for the k-th update.
+        adapted from: P. Liang and D. Klein, "Online EM for Unsupervised
+        Models", NAACL 2009
+        """
+        trainSample = context.trainSample
+        if trainSample.isStream() or context.minibatches is None:
+            batches = trainSample.minibatches(self.minibatchSize)
+            if not trainSample.isStream():
+                batches = context.minibatches = list(batches)
+        else:
+            batches = context.minibatches
+        if context.trainSize is None:
+            context.trainSize = trainSample.size()
+
+        logLik = 0.0
+        discount = context.model.discount
+        for batch in batches:
+            model = context.model.sequenceModel
+            evidence, batchLogLik = batch.evidence(
+                model, self.shallUseMaximumApproximation, threshold=self.evidenceThreshold
+            )
+            logLik += batchLogLik
+            stepSize = (context.nUpdates + 1) ** -self.stepSizeDecay
+            context.evidence.interpolate(
+                1.0 - stepSize,
+                evidence,
+                stepSize * context.trainSize / batch.size(),
+            )
+            context.evidenceModel = model  # the evidence refers to its histories
+            context.nUpdates += 1
+
+            order = context.evidence.maximumHistoryLength()
+            if discount is None:
+                discount = context.discountAdjuster.adjust(
+                    context, context.evidence, order
+                )
+            elif len(discount) < order + 1:
+                discount = num.concatenate(
+                    (discount, num.repeat(discount[-1], order + 1 - len(discount)))
+                )
+            context.model = Model(self.sequitur)
+            context.model.discount = discount
+            context.model.sequenceModel = self.sequenceModel(
+                context.evidence, discount
+            )
+        return context.evidence, logLik
+
+    def pruneEvidence(self, log, evidence, minEvidence):
+        memoryBefore = evidence.memoryUsed()
+        nRemoved = evidence.prune(minEvidence)
+        memoryAfter = evidence.memoryUsed()
+        print(
+            "  pruned %d evidence types below %s, %d bytes saved"
+            % (nRemoved, minEvidence, memoryBefore - memoryAfter),
+            file=log,
         )
 
+    def iterate(self, context):
+        startTime = time.time()
+        if self.minibatchSize:
+            evidence, logLikTrain = self.stepwiseEvidence(context)
+        else:
+            evidence, logLikTrain = context.trainSample.evidence(
+                context.model.sequenceModel,
+                self.shallUseMaximumApproximation,
+                threshold=self.evidenceThreshold,
+            )
+
         print(("LL train: %s (before)" % logLikTrain), file=context.log)
         context.logLikTrain.append(logLikTrain)
 
+        minEvidence = self.minEvidence
+        if self.minibatchSize:
+            # decayed evidence of multigrams no longer in use never
+            # reaches zero, so it would keep them in the model
+            minEvidence = max(minEvidence or 0.0, self.stepwiseMinEvidence)
+        if minEvidence:
+            self.pruneEvidence(context.log, evidence, minEvidence)
+
         if (not context.develSample) and (context.iteration > self.minIterations):
             context.registerNewModel(context.model, logLikTrain)
 
@@ -657,7 +1031,7 @@ class ModelTemplate:
         print("  model size: %s" % newModel.sequenceModel.size(), file=context.log)
 
         if context.develSample:
-            logLikDevel = context.develSample.logLik(
+            logLikDevel = context.develCheckSample.logLik(
                 newModel.sequenceModel, self.shallUseMaximumApproximation
             )
             print("LL devel: %s" % logLikDevel, file=context.log)
@@ -669,26 +1043,43 @@ class ModelTemplate:
         if (context.develSample) and (context.iteration >= self.minIterations):
             context.registerNewModel(newModel, logLikDevel)
 
+        context.iterationTimes.append(time.time() - startTime)
+        if context.develSample:
+            crit = context.logLikDevel
+        else:
+            crit = context.logLikTrain
         shouldStop = False
-        if context.bestModel:
-            if context.develSample:
-                crit = context.logLikDevel
-            else:
-                crit = context.logLikTrain
-            crit = [-ll for ll in crit[-self.convergenceWindow :]]
-            if not Minimization.hasSignificantDecrease(crit):
-                print("iteration converged.", file=context.log)
-                shouldStop = True
+        if context.bestModel and self.convergence.hasConverged(crit):
+            print("iteration converged.", file=context.log)
+            shouldStop = True
+        else:
+            nIterations = projectedIterations(crit, self.convergence.threshold)
+            if nIterations is not None:
+                nIterations = max(nIterations, self.minIterations - context.iteration - 1)
+                recentTimes = context.iterationTimes[-3:]
+                seconds = nIterations * sum(recentTimes) / len(recentTimes)
+                print(
+                    "  projected convergence: %d more iterations, %.0f seconds"
+                    % (nIterations, seconds),
+                    file=context.log,
+                )
 
         context.model = newModel
         return shouldStop
 
     maxIterations = 100
     minIterations = 20
-    convergenceWindow = 10
+    convergence = SignificantDecrease()  # or RelativeImprovement(threshold, patience)
+    develCheckSize = None  # distinct devel entries for checking progress, None for all
     DiscountAdjustmentStrategy = DefaultDiscountAdjuster
     checkpointInterval = None  # or CPU time in seconds
     checkpointFile = None  # filename template must contain '%d'
+    nJobs = 1  # threads for building estimation graphs and models, 0 for all cores
+    minibatchSize = None  # words per update for stepwise EM, None for batch EM
+    stepSizeDecay = 0.7  # between 0.5 and 1, smaller forgets faster
+    evidenceThreshold = None  # posteriors below are credited to the back-off history
+    minEvidence = None  # evidence types below are pruned after each E-step
+    stepwiseMinEvidence = 1e-3  # least minEvidence in stepwise EM
 
     def makeContext(self, trainSample, develSample, initialModel=None):
         context = TrainingContext()
@@ -697,14 +1088,22 @@ class ModelTemplate:
         else:
             context.model = self.obliviousModel()
         masterModel = self.masterSequenceModel(context.model)
-        context.trainSample = Sample(
-            self.sequitur,
-            self.sizeTemplates,
-            self.emergenceMode,
-            trainSample,
-            masterModel,
-        )
-        if develSample:
+        if isinstance(trainSample, Sample):
+            context.trainSample = trainSample
+            context.trainSample.setMasterModel(masterModel)
+        else:
+            context.trainSample = Sample(
+                self.sequitur,
+                self.sizeTemplates,
+                self.emergenceMode,
+                trainSample,
+                masterModel,
+            )
+        context.trainSample.nJobs = self.nJobs
+        if isinstance(develSample, Sample):
+            context.develSample = develSample
+            context.develSample.setMasterModel(masterModel)
+        elif develSample:
             context.develSample = Sample(
                 self.sequitur,
                 self.sizeTemplates,
@@ -712,8 +1111,21 @@ class ModelTemplate:
                 develSample,
                 masterModel,
             )
+            context.develSample.nJobs = self.nJobs
         else:
             context.develSample = None
+        context.develCheckSample = context.develSample
+        if self.develCheckSize and context.develSample:
+            if len(context.develSample.sample) > self.develCheckSize:
+                context.develCheckSample = next(
+                    context.develSample.minibatches(self.develCheckSize)
+                )
+        if self.minibatchSize:
+            context.evidence = sequitur_.EvidenceStore()
+            context.evidenceModel = None
+            context.minibatches = None
+            context.trainSize = None
+            context.nUpdates = 0
         context.discountAdjuster = self.DiscountAdjustmentStrategy(
             self,
             context.develSample,
@@ -723,6 +1135,17 @@ class ModelTemplate:
         context.iteration = 0
         return context
 
+    def rampUpContext(self, context):
+        """
+        Context for training the next higher order, starting from the
+        best model of the given context and sharing its samples.
+        """
+        model = context.bestModel
+        model.rampUp()
+        result = self.makeContext(context.trainSample, context.develSample, model)
+        result.log = context.log
+        return result
+
     def run(self, context):
         lastCheckpoint = misc.cputime()
         shouldStop = False
@@ -781,8 +1204,18 @@ class ModelTemplate:
 # ===========================================================================
 class Translator:
     def __init__(self, model):
+        self.stackLimit = None
+        self.copiesStackUsage = 0
         self.setModel(model)
 
+    def __getstate__(self):
+        return {"model": self.model, "stackLimit": self.stackLimit}
+
+    def __setstate__(self, state):
+        self.__init__(state["model"])
+        if state["stackLimit"]:
+            self.setStackLimit(state["stackLimit"])
+
     def setModel(self, model):
         self.model = model
         self.sequitur = self.model.sequitur
@@ -791,6 +1224,7 @@ class Translator:
         self.translator.setSequenceModel(self.model.sequenceModel)
 
     def setStackLimit(self, n):
+        self.stackLimit = n
         self.translator.setStackLimit(n)
 
     class TranslationFailure(RuntimeError):
@@ -863,8 +1297,20 @@ class Translator:
         left, right = self.jointToLeftRight(joint)
         return logLik, right
 
+    def stackUsage(self):
+        """
+        Largest stack size since the last call, including the one
+        of copies, e.g. in worker processes, passed to noteStackUsage().
+        """
+        result = max(self.translator.stackUsage(), self.copiesStackUsage)
+        self.copiesStackUsage = 0
+        return result
+
+    def noteStackUsage(self, stackUsage):
+        self.copiesStackUsage = max(self.copiesStackUsage, stackUsage)
+
     def reportStats(self, f):
-        print("stack usage: ", self.translator.stackUsage(), file=f)
+        print("stack usage: ", self.stackUsage(), file=f)
 
 
 class Segmenter:
@@ -55,7 +55,11 @@ class SymbolInventory:
             return result
 
     def parse(self, seq):
-        return tuple(map(self.index, list(seq)))
+        seq = list(seq)
+        try:
+            return tuple(map(self.dir.__getitem__, seq))
+        except KeyError:
+            return tuple(map(self.index, seq))
 
     def symbol(self, ind):
         return self.list[ind]
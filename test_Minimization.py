@@ -43,5 +43,43 @@ class LinearMinimizationTestCase(unittest.TestCase):
         self.assertAlmostEqual(fMin, -64, 6)
 
 
+class BoundedQuasiNewtonTestCase(unittest.TestCase):
+    def quadratic(self, center, scale):
+        center = array(center, dtype=float64)
+        scale = array(scale, dtype=float64)
+
+        def fg(x):
+            d = x - center
+            return sum(scale * d * d), 2 * scale * d
+
+        return fg
+
+    def testActiveBound(self):
+        fg = self.quadratic([1.0, -2.0, 3.0], [1.0, 10.0, 0.1])
+        x, fx = boundedQuasiNewtonMinimization(
+            fg, [0.5, 0.5, 0.5], zeros(3), repeat(5.0, 3), tolerance=1e-8
+        )
+        self.assertAlmostEqual(x[0], 1.0, 6)
+        self.assertEqual(x[1], 0.0)
+        self.assertAlmostEqual(x[2], 3.0, 6)
+        self.assertAlmostEqual(fx, 40.0, 6)
+
+    def testUnconstrained(self):
+        def fg(x):
+            a, b = x
+            f = (1 - a) ** 2 + 10 * (b - a * a) ** 2
+            return f, array([-2 * (1 - a) - 40 * a * (b - a * a), 20 * (b - a * a)])
+
+        x, fx = boundedQuasiNewtonMinimization(
+            fg, [-1.0, 2.0], repeat(-1e9, 2), repeat(1e9, 2), tolerance=1e-9
+        )
+        y, fy = directionSetMinimization(
+            lambda x: fg(x)[0], array([-1.0, 2.0]), directions=identity(2)
+        )
+        self.assertAlmostEqual(fx, fy, 8)
+        self.assertAlmostEqual(x[0], y[0], 4)
+        self.assertAlmostEqual(x[1], y[1], 4)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -72,5 +72,24 @@ class SequenceModelEstimatorTestCase(unittest.TestCase):
             print(history, predicted, probability)
 
 
+class EvidenceListTestCase(unittest.TestCase):
+    def testConsolidate(self):
+        evidence = EvidenceList()
+        evidence.add(("A", "B"), "X", 1.0)
+        evidence.add((), "Y", 0.5)
+        evidence.add(("B",), "X", 2.0)
+        other = EvidenceList()
+        other.add(("A", "B"), "X", 0.25)
+        other.add((), "Y", 0.5)
+        evidence.addList(other)
+        self.assertEqual(
+            evidence.evidence,
+            [((), "Y", 1.0), (("A", "B"), "X", 1.25), (("B",), "X", 2.0)],
+        )
+        empty = EvidenceList()
+        empty.consolidate()
+        self.assertEqual(empty.evidence, [])
+
+
 if __name__ == "__main__":
     unittest.main()
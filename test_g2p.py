@@ -0,0 +1,332 @@
+"""
+Tests of the sample readers and writers in g2p.py.
+"""
+
+from __future__ import print_function
+
+import io
+import math
+import os
+import random
+import tempfile
+import unittest
+import g2p
+from sequitur import Sequitur, CompiledSampleStream
+from SequiturTool import Tool, partition_sample
+from symbols import SymbolInventory
+
+
+class PlainSampleTestCase(unittest.TestCase):
+    text = u"".join(
+        u"%s %s\n" % (word, u" ".join(word.upper()))
+        for word in [u"abc", u"bca", u"aab", u"cab", u"ab", u"abc", u"c\u00e4b"] * 3
+    ) + u"\n  \nxyz X Y Z"
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix=".lex")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.text.encode("utf-8"))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def testBlocks(self):
+        for blockSize in [1, 7, 1000]:
+            lines = []
+            for block in g2p.readPlainSampleBlocks(io.StringIO(self.text), blockSize):
+                lines += block
+            self.assertEqual(lines, self.text.split(u"\n"))
+
+    def testCompile(self):
+        sample = g2p.loadPlainSample(self.fname, "utf-8")
+        self.assertEqual(len(sample), 22)
+        for portion in [None, 0.3]:
+            sequitur = Sequitur()
+            train, devel = g2p.compilePlainSample(
+                sequitur, self.fname, portion, encoding="utf-8"
+            )
+            if portion is None:
+                expectedTrain, expectedDevel = sample, []
+            else:
+                expectedTrain, expectedDevel = partition_sample(sample, portion)
+            compiled = []
+            for (left, right), weight in zip(train, train.weights):
+                left = sequitur.leftInventory.format(tuple(left))
+                right = sequitur.rightInventory.format(tuple(right))
+                compiled += [(left, right)] * weight
+            self.assertEqual(sorted(compiled), sorted(expectedTrain))
+            self.assertEqual(devel, expectedDevel)
+
+    def testStreamPortion(self):
+        # as set by g2p.main() from --encoding
+        g2p.defaultEncoding = "utf-8"
+        self.addCleanup(delattr, g2p, "defaultEncoding")
+        fname = self.fname
+
+        class Options:
+            trainSample = fname
+            develSample = "30%"
+            stream = True
+
+        sample = g2p.loadG2PSample(self.fname)
+        tool = Tool(
+            Options(),
+            g2p.loadG2PSample,
+            log=io.StringIO(),
+            streamSample=g2p.streamG2PSample,
+        )
+        tool.sequitur = Sequitur()
+        tool.loadSamples()
+        expectedTrain, expectedDevel = partition_sample(sample, 0.3)
+        self.assertEqual(tool.develSample, expectedDevel)
+        stream = tool.sequitur.compileSample(tool.trainSample)
+        self.assertTrue(isinstance(stream, CompiledSampleStream))
+        self.assertEqual(stream.size, len(expectedTrain))
+        self.assertEqual(list(tool.trainSample), expectedTrain)
+        self.assertEqual(list(tool.trainSample), expectedTrain)
+
+    def testParse(self):
+        inventory = SymbolInventory()
+        known = inventory.parse(u"abc")
+        self.assertEqual(inventory.parse(u"cab"), (known[2], known[0], known[1]))
+        # an unknown symbol takes the slow path, which adds it
+        mixed = inventory.parse(u"abd")
+        self.assertEqual(mixed[:2], known[:2])
+        self.assertEqual(inventory.format(mixed), tuple(u"abd"))
+        self.assertEqual(inventory.parse(u"d"), mixed[2:])
+        # a generator is consumed only once, also on the slow path
+        mixed = inventory.parse(c for c in u"abe")
+        self.assertEqual(inventory.format(mixed), tuple(u"abe"))
+
+
+class BlissLexiconTestCase(unittest.TestCase):
+    lexicon = u"""<?xml version="1.0" encoding="utf-8"?>
+<lexicon>
+  <lemma>
+    <orth>[SILENCE]</orth>
+    <orth>sil</orth>
+    <phon>si</phon>
+  </lemma>
+  <lemma>
+    <orth>tomato</orth>
+    <orth>tomatoes</orth>
+    <phon>t @ m A t @U</phon>
+    <phon>t @ m eI t @U</phon>
+  </lemma>
+  <lemma>
+    <orth>hm</orth>
+    <phon/>
+  </lemma>
+  <lemma>
+    <orth>\u00e4h</orth>
+    <phon>E</phon>
+  </lemma>
+</lexicon>
+"""
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.lexicon.encode("utf-8"))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def testLoad(self):
+        pron1, pron2 = ("t", "@", "m", "A", "t", "@U"), ("t", "@", "m", "eI", "t", "@U")
+        expected = [
+            (u"hm", ()),
+            (u"sil", ("si",)),
+            (u"tomato", pron1),
+            (u"tomato", pron2),
+            (u"tomatoes", pron1),
+            (u"tomatoes", pron2),
+            (u"\u00e4h", ("E",)),
+        ]
+        self.assertEqual(g2p.loadBlissLexicon(self.fname), expected)
+        self.assertEqual(
+            g2p.loadG2PSample(self.fname),
+            [(tuple(orth), phon) for orth, phon in expected],
+        )
+        self.assertEqual(
+            sorted(g2p.streamG2PSample(self.fname)), g2p.loadG2PSample(self.fname)
+        )
+
+    def testSingleOpen(self):
+        opened = []
+        gOpenInBinary = g2p.gOpenInBinary
+
+        def countingOpen(fname):
+            f = gOpenInBinary(fname)
+            opened.append(f)
+            return f
+
+        g2p.gOpenInBinary = countingOpen
+        try:
+            sample = g2p.loadG2PSample(self.fname)
+        finally:
+            g2p.gOpenInBinary = gOpenInBinary
+        self.assertEqual(len(sample), 7)
+        self.assertEqual(len(opened), 1)
+        self.assertTrue(opened[0].closed)
+
+
+class P2PSampleTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(3)
+        orths = ["%s%s" % (a, b) for a in "abcd" for b in "xyz"]
+
+        def sample(orths, n):
+            return [
+                (rng.choice(orths), tuple(rng.choice("PTK") for i in range(3)))
+                for j in range(n)
+            ]
+
+        # "dx" ... "dz" occur only on the left, "ax" ... "az" only on the right
+        self.left = sample(orths[3:], 40)
+        self.right = sample(orths[:9], 30)
+
+    def testSortedSample(self):
+        for runSize in [1, 7, 1000]:
+            self.assertEqual(
+                list(g2p.sortedSample(self.left, runSize)), sorted(self.left)
+            )
+
+    def testJoin(self):
+        expected = [
+            (leftPhon, rightPhon)
+            for leftOrth, leftPhon in self.left
+            for rightOrth, rightPhon in self.right
+            if leftOrth == rightOrth
+        ]
+        joined = g2p.joinSamples(
+            g2p.sortedSample(self.left, 7), g2p.sortedSample(self.right, 5)
+        )
+        self.assertEqual(sorted(joined), sorted(expected))
+        self.assertEqual(list(g2p.joinSamples([], self.right)), [])
+
+
+class FakeTranslator(object):
+    "Translates from a dictionary of n-best lists of (posterior, result)."
+
+    class TranslationFailure(RuntimeError):
+        pass
+
+    class NBest(object):
+        logLikTotal = 0.0
+
+    def __init__(self, memory):
+        self.memory = memory
+
+    def __call__(self, left):
+        return self.nBestInit(left).results[0][1]
+
+    def nBestInit(self, left):
+        if left not in self.memory:
+            raise self.TranslationFailure()
+        nBest = self.NBest()
+        nBest.results = list(self.memory[left])
+        return nBest
+
+    def nBestNext(self, nBest):
+        if not nBest.results:
+            raise StopIteration
+        posterior, result = nBest.results.pop(0)
+        return math.log(posterior), result
+
+
+class ApplyTestCase(unittest.TestCase):
+    words = [u"abc", u"b\u00e4", u"x", u"cab"] * 5
+    memory = {
+        tuple(u"abc"): [(0.5, ("A", "B", "C")), (0.3, ("A", "P", "C"))],
+        tuple(u"b\u00e4"): [(0.9, ("B", "\u00c4"))],
+        tuple(u"cab"): [(0.25, ("K", "A", "B")), (0.25, ()), (0.25, ("C",))],
+    }
+
+    class Options:
+        phoneme_to_phoneme = False
+        shouldTranspose = False
+        encoding = "utf-8"
+        variants_mass = None
+        variants_number = None
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix=".txt")
+        with os.fdopen(fd, "wb") as f:
+            f.write(u"".join(w + u"\n" for w in self.words).encode("utf-8"))
+        self.options = self.Options()
+        self.options.applySample = self.fname
+        g2p.stderr = io.StringIO()
+        self.addCleanup(delattr, g2p, "stderr")
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def unbatchedApply(self, wantVariants, format=u" ".join):
+        "The output of --apply as printed line by line before ApplyWriter."
+        out = io.StringIO()
+        for word in self.words:
+            for nVariant, (posterior, result) in enumerate(
+                self.memory.get(tuple(word), [])
+            ):
+                if wantVariants:
+                    print(
+                        u"%s\t%d\t%f\t%s" % (word, nVariant, posterior, format(result)),
+                        file=out,
+                    )
+                else:
+                    print(u"%s\t%s" % (word, format(result)), file=out)
+                    break
+        return out.getvalue().encode("utf-8")
+
+    def apply(self, batchSize, inventory=None):
+        out = io.BytesIO()
+        writer = g2p.ApplyWriter(out, "utf-8", inventory)
+        writer.batchSize = batchSize
+        g2p.mainApply(FakeTranslator(self.memory), self.options, writer)
+        return out.getvalue()
+
+    def testBatches(self):
+        out = io.BytesIO()
+        writer = g2p.ApplyWriter(out, "utf-8")
+        writer.batchSize = 3
+        writer.write(u"ab", ("A", "B"))
+        writer.writeVariant(u"ab", 0, 0.5, ("A", "B"))
+        self.assertEqual(out.getvalue(), b"")
+        writer.write(u"c", ())
+        self.assertEqual(out.getvalue(), b"ab\tA B\nab\t0\t0.500000\tA B\nc\t\n")
+        writer.write(u"d", ("D",))
+        writer.flush()
+        self.assertTrue(out.getvalue().endswith(b"c\t\nd\tD\n"))
+
+    def testApply(self):
+        expected = self.unbatchedApply(False)
+        for batchSize in [1, 4, 1024]:
+            self.assertEqual(self.apply(batchSize), expected)
+        self.assertEqual(g2p.stderr.getvalue().count(u"failed to convert"), 15)
+
+    def testVariants(self):
+        self.options.variants_number = 2
+        expected = self.unbatchedApply(True).splitlines()
+        for batchSize in [1, 4, 1024]:
+            lines = self.apply(batchSize).splitlines()
+            # at most two variants per word
+            self.assertEqual(lines, [l for l in expected if b"\t2\t" not in l])
+
+    def testIds(self):
+        inventory = SymbolInventory()
+        for posteriorsAndResults in self.memory.values():
+            for posterior, result in posteriorsAndResults:
+                inventory.parse(result)
+
+        def format(result):
+            return u" ".join(str(i) for i in inventory.parse(result))
+
+        expected = self.unbatchedApply(False, format)
+        for batchSize in [1, 4, 1024]:
+            self.assertEqual(self.apply(batchSize, inventory), expected)
+        self.assertFalse(u"\u00c4".encode("utf-8") in expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
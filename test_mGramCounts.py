@@ -24,8 +24,13 @@ agreed upon which comes closest to what the parties intended
 commercially. In any case guarantee/warranty shall be limited to gross
 negligent actions or intended actions or fraudulent concealment.
 """
+import gzip
+import os
+import shutil
 import sys
+import tempfile
 import unittest
+import misc
 from mGramCounts import *
 
 TestCase = unittest.TestCase
@@ -58,5 +63,84 @@ class MGramsTestCase(TestCase):
             self.templateTest(length, None)
 
 
+class CountFileTestCase(TestCase):
+    def runTest(self):
+        items = [((tuple("abc"[:i % 4]), "xyz"[i % 3]), i) for i in range(10000)]
+        storage = FileStorage()
+        writer = FileWriter(storage.fname)
+        for item in items[:10]:
+            writer.write(item)
+        writer.writeBlock(items[10:20])
+        writer.close()
+        self.assertEqual(list(FileReader(storage.fname)), items[:20])
+        self.assertEqual(writeToFile(storage.fname, items), len(items))
+        self.assertEqual(list(storage.iter()), items)
+        self.assertEqual(
+            [len(block) for block in FileReader(storage.fname).blocks()],
+            [blockSize, blockSize, len(items) - 2 * blockSize],
+        )
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testCountFiles(self):
+        items = [((tuple("abc"[:i % 4]), "xyz"[i % 3]), i) for i in range(10000)]
+        compressions = [None, "gzip", "xz"]
+        if misc.zstandard:
+            compressions.append("zstd")
+        for compression in compressions:
+            fname = os.path.join(self.dir, str(compression))
+            self.assertEqual(writeToFile(fname, items, compression), len(items))
+            self.assertEqual(list(FileReader(fname, compression)), items)
+            data = os.urandom(1000) + b"\0" * 100000
+            f = misc.openCompressedOut(fname, compression, 1, blockSize=4096)
+            f.write(data)
+            f.close()
+            if compression:
+                self.assertTrue(os.path.getsize(fname) < len(data))
+            f = misc.openCompressedIn(fname, compression, blockSize=4096)
+            self.assertEqual(f.read(), data)
+            f.close()
+
+    def testTextFiles(self):
+        text = u"gr\u00fc\u00dfe \u00e0 tous\n" * 1000
+        for extension, module in [(".gz", gzip), (".xz", misc.lzma)]:
+            fname = os.path.join(self.dir, "text" + extension)
+            f = misc.gOpenOut(fname, "utf-8")
+            f.write(text)
+            f.close()
+            f = module.open(fname, "rb")
+            self.assertEqual(f.read(), text.encode("utf-8"))
+            f.close()
+            f = misc.gOpenIn(fname, "utf-8")
+            self.assertEqual(f.read(), text)
+            f.close()
+
+
+class ExternalSortTestCase(TestCase):
+    def runTest(self):
+        keys = [((str(i % 7),), str(i % 11)) for i in range(500)]
+        expected = {}
+        for key in keys:
+            expected[key] = expected.get(key, 0) + 1
+        expected = sorted(expected.items())
+        for storageClass in [SimpleMultifileStorage, BiHeapMultifileStorage]:
+            for nJobs in [1, 2]:
+                counts = storageClass()
+                counts.setMemoryLimit(20)
+                counts.mergeFanIn = 3
+                counts.setJobs(nJobs)
+                counts.setCompression(["xz", None][nJobs - 1])
+                for key in keys:
+                    counts.add(key, 1)
+                self.assertEqual(list(counts.iter(sorted=True)), expected)
+                self.assertTrue(len(counts.files) <= 3)
+
+
 if __name__ == "__main__":
     unittest.main()
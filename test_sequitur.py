@@ -27,9 +27,13 @@ commercially. In any case guarantee/warranty shall be limited to gross
 negligent actions or intended actions or fraudulent concealment.
 """
 
+import io
+import os
 import unittest
 import math
+import pickle
 from sequitur import *
+import Evaluation
 
 
 class SequenceModelTestCase(unittest.TestCase):
@@ -82,6 +86,148 @@ class SequenceModelTestCase(unittest.TestCase):
             self.assertAlmostEqual(sm.probability(t, h), probs[t - 1])
             self.assertAlmostEqual(sm.probability(t, h2), probs2[t - 1])
 
+    def testHighFanOut(self):
+        # enough children and probabilities for a direct index at the root
+        tokens = list(range(5, 200, 3))
+        probs = dict((t, 1.0 / (t + 1)) for t in tokens)
+        data = [((), None, 0.0)]
+        data += [((), t, -math.log(p)) for t, p in probs.items()]
+        data += [((t,), None, -math.log(0.5)) for t in tokens[::2]]
+        data += [((t,), tokens[0], -math.log(0.25)) for t in tokens[::2]]
+        sm = SequenceModel.SequenceModel()
+        sm.setInitAndTerm(0, 0)
+        sm.set(data)
+        h = sm.initial()
+        for t in range(210):
+            if t in probs:
+                self.assertAlmostEqual(sm.probability(t, h), probs[t])
+            else:
+                self.assertEqual(sm.probability(t, h), 1.0)
+            h2 = sm.advanced(h, t)
+            if t in tokens[::2]:
+                self.assertEqual(sm.historyAsTuple(h2), (t,))
+                self.assertAlmostEqual(sm.probability(tokens[0], h2), 0.25)
+                self.assertAlmostEqual(
+                    sm.probability(tokens[1], h2), 0.5 * probs[tokens[1]]
+                )
+            else:
+                self.assertEqual(h2, h)
+
+
+class ConvergenceTestCase(unittest.TestCase):
+    def testRelativeImprovement(self):
+        criterion = RelativeImprovement(threshold=1e-3, patience=2)
+        self.assertFalse(criterion.hasConverged([-100.0, -90.0, -89.995]))
+        self.assertTrue(criterion.hasConverged([-100.0, -90.0, -89.995, -89.99]))
+        self.assertFalse(criterion.hasConverged([-100.0, -90.0, -89.995, -80.0]))
+
+    def testProjectedIterations(self):
+        logLiks = [-100.0 + 10.0 * (1 - 0.5 ** i) for i in range(4)]
+        self.assertEqual(projectedIterations(logLiks[:2], 1e-3), None)
+        self.assertEqual(projectedIterations(logLiks, 1e-3), 4)
+        self.assertEqual(projectedIterations(logLiks, 1e-2), 1)
+        self.assertEqual(projectedIterations(logLiks, 2e-2), 0)
+
+
+class DictionaryTranslator(object):
+    class TranslationFailure(RuntimeError):
+        pass
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.longest = 0
+
+    def __call__(self, left):
+        self.longest = max(self.longest, len(left))
+        if left not in self.memory:
+            raise self.TranslationFailure()
+        return self.memory[left]
+
+    def stackUsage(self):
+        result, self.longest = self.longest, 0
+        return result
+
+    def noteStackUsage(self, stackUsage):
+        self.longest = max(self.longest, stackUsage)
+
+
+class EvaluationTestCase(unittest.TestCase):
+    def testParallelEvaluate(self):
+        sample = [
+            (tuple(w), tuple(w.upper())) for w in ["abc", "bca", "aab", "cab", "ab", "b"]
+        ]
+        sample.append((tuple("ab"), tuple("AC")))
+        memory = dict((left, right) for left, right in sample)
+        memory[tuple("cab")] = tuple("CB")
+        del memory[tuple("b")]
+        translator = DictionaryTranslator(memory)
+
+        evaluator = Evaluation.Evaluator()
+        evaluator.setSample(sample)
+        results = []
+        for jobs in [1, 3]:
+            evaluator.resultFile = io.StringIO()
+            results.append((evaluator.evaluate(translator, jobs), evaluator.resultFile))
+            self.assertEqual(translator.stackUsage(), 3)
+        (serial, serialTable), (parallel, parallelTable) = results
+        for counter in Evaluation.Result.counters:
+            self.assertEqual(getattr(serial, counter), getattr(parallel, counter))
+        self.assertEqual(serial.nStringsFailed, 1)
+        self.assertEqual(serial.nStringErrors, 1)
+        self.assertEqual(serialTable.getvalue(), parallelTable.getvalue())
+        self.assertEqual(len(serialTable.getvalue().splitlines()), 5)
+
+    def testSymbolAlignment(self):
+        pairs = [
+            ((), ()),
+            ((1, 2, 3), ()),
+            ((), (4, 5)),
+            ((1, 2, 3, 4), (1, 3, 3, 4, 5)),
+            ((2, 2, 1), (1, 2, 2)),
+        ]
+        counts = sequitur_.closestEditCounts([([a], b) for a, b in pairs])
+        self.assertEqual(
+            sequitur_.editDistances(pairs, True), [tuple(c[1:]) for c in counts]
+        )
+        for (a, b), (index, errors, nIns, nDel, nSub) in zip(pairs, counts):
+            alignment, expected = sequitur_.align(a, b)
+            self.assertEqual(errors, expected)
+            self.assertEqual(sequitur_.alignClosest([a], b), (0, alignment, expected))
+            self.assertEqual(sequitur_.editDistance(a, b), expected)
+            self.assertEqual(sequitur_.editDistances([(a, b)]), [expected])
+            self.assertEqual(sequitur_.editCounts(a, b), (errors, nIns, nDel, nSub))
+            self.assertEqual(sequitur_.alignSymbols(a, b), (alignment, expected))
+            result = Evaluation.Result()
+            result.accu((), a, b, alignment, errors)
+            self.assertEqual(
+                (result.nInsertions, result.nDeletions, result.nSubstitutions),
+                (nIns, nDel, nSub),
+            )
+
+        references = [(1, 2, 3), (1, 2), (1, 3), (2, 2)]
+        index, alignment, errors = sequitur_.alignClosest(references, (1, 4))
+        self.assertEqual((index, errors), (1, 1))
+        self.assertEqual(alignment, [(1, 1), (2, 4)])
+        self.assertEqual(
+            sequitur_.closestEditCounts([(references, (1, 4)), (references, (2, 2))]),
+            [(1, 1, 0, 0, 1), (3, 0, 0, 0, 0)],
+        )
+        self.assertRaises(ValueError, sequitur_.alignClosest, [], (1,))
+
+        sample = [(tuple(w), tuple(w.upper())) for w in ["abc", "bca", "ab"]]
+        sample.append((tuple("ab"), tuple("AC")))
+        translator = DictionaryTranslator(
+            {tuple("abc"): tuple("AXC"), tuple("bca"): tuple("BA"), tuple("ab"): tuple("AC")}
+        )
+        evaluator = Evaluation.Evaluator()
+        evaluator.setSample(sample)
+        counted = evaluator.evaluate(translator)
+        evaluator.verboseLog = io.StringIO()
+        aligned = evaluator.evaluate(translator)
+        for counter in Evaluation.Result.counters:
+            self.assertEqual(getattr(counted, counter), getattr(aligned, counter))
+        self.assertEqual(counted.nStringErrors, 2)
+
 
 class EstimatorTestCase(unittest.TestCase):
     def setUp(self):
@@ -90,6 +236,27 @@ class EstimatorTestCase(unittest.TestCase):
     def tearDown(self):
         del self.sequitur
 
+    def nullLog(self):
+        log = open(os.devnull, "w")
+        self.addCleanup(log.close)
+        return log
+
+    def makeTrainingContext(self, **templateAttributes):
+        """
+        A training context on five short words with static discounts
+        and a log that is closed after the test.
+        """
+        template = ModelTemplate(self.sequitur)
+        template.DiscountAdjustmentStrategy = StaticDiscounts
+        for name, value in templateAttributes.items():
+            setattr(template, name, value)
+        sample = self.sequitur.compileSample(
+            [(tuple(w), tuple(w.upper())) for w in ["abc", "bca", "aab", "cab", "ab"]]
+        )
+        context = template.makeContext(sample, None)
+        context.log = self.nullLog()
+        return template, sample, context
+
     def obliviousModel(self, Q):
         result = SequenceModel.SequenceModel()
         result.setInitAndTerm(self.sequitur.term, self.sequitur.term)
@@ -135,6 +302,325 @@ class EstimatorTestCase(unittest.TestCase):
             else:
                 self.assertAlmostEqual(p, 0.4)
 
+    def testDuplicates(self):
+        sizeTemplates = [(1, 1), (1, 0), (0, 1)]
+        model = self.obliviousModel(3)
+        sample = [((c,), (c,)) for c in list("abcaa")]
+        sample = self.sequitur.compileSample(sample)
+        sample = Sample(
+            self.sequitur,
+            sizeTemplates,
+            EstimationGraphBuilder.emergeNewMultigrams,
+            sample,
+            model,
+        )
+        self.assertEqual(len(sample.sample), 3)
+        self.assertEqual(list(sample.weights), [3, 1, 1])
+        self.assertEqual(sample.size(), 5)
+        pairs = [((1,), (2, 3)), ((1, 2), (3,)), ((1,), (2, 3))]
+        compiled = CompiledSample.fromPairs(pairs)
+        self.assertEqual([(tuple(l), tuple(r)) for l, r in compiled], pairs[:2])
+        self.assertEqual(list(compiled.weights), [2, 1])
+        evidence, logLik = sample.evidence(model, useMaximumApproximation=False)
+        self.assertAlmostEqual(logLik, sample.logLik(model, False))
+        values = sorted([p for hist, seg, p in evidence.asList()], reverse=True)
+        most = [p for hist, seg, p in evidence.mostEvident(3)]
+        least = [p for hist, seg, p in evidence.leastEvident(2)]
+        for p, q in zip(most + least, values[:3] + values[-2:]):
+            self.assertAlmostEqual(p, q)
+        for hist, seg, p in evidence.asList():
+            l, r = self.sequitur.symbol(seg)
+            if l == ("__term__",) and r == ("__term__",):
+                self.assertAlmostEqual(p, 5.0)
+            elif l == ("a",) and r == ("a",):
+                self.assertAlmostEqual(p, 1.8)
+
+    def testParallelGraphs(self):
+        sizeTemplates = [(1, 1), (1, 0), (0, 1), (2, 1), (1, 2)]
+        words = ["abc", "bca", "aab", "cab"]
+        results = []
+        for nJobs in [1, 3]:
+            sequitur = Sequitur()
+            sample = sequitur.compileSample([(tuple(w), tuple(w.upper())) for w in words])
+            model = SequenceModel.SequenceModel()
+            model.setInitAndTerm(sequitur.term, sequitur.term)
+            model.setZerogram(sequitur.inventory.size() + 100)
+            trainSample = Sample(
+                sequitur,
+                sizeTemplates,
+                EstimationGraphBuilder.emergeNewMultigrams,
+                sample,
+                model,
+            )
+            trainSample.nJobs = nJobs
+            evidence, logLik = trainSample.evidence(model, False)
+            results.append(
+                (
+                    logLik,
+                    sorted(
+                        (sequitur.symbol(seg), p) for hist, seg, p in evidence.asList()
+                    ),
+                )
+            )
+        self.assertAlmostEqual(results[0][0], results[1][0])
+        self.assertEqual(len(results[0][1]), len(results[1][1]))
+        for (a, p), (b, q) in zip(results[0][1], results[1][1]):
+            self.assertEqual(a, b)
+            self.assertAlmostEqual(p, q)
+
+    def testStream(self):
+        sizeTemplates = [(1, 1), (1, 0), (0, 1)]
+        model = self.obliviousModel(3)
+        pairs = [((c,), (c,)) for c in list("abca")]
+
+        class RereadableSample(object):
+            isRereadable = True
+
+            def __iter__(self):
+                return iter(pairs)
+
+        stream = self.sequitur.compileSample(RereadableSample())
+        self.assertTrue(isinstance(stream, CompiledSampleStream))
+        self.assertEqual(stream.size, len(pairs))
+        compiled = self.sequitur.compileSample(pair for pair in pairs)
+        self.assertTrue(isinstance(compiled, CompiledSample))
+        self.assertEqual(sum(compiled.weights), len(pairs))
+        results = []
+        for sample in [self.sequitur.compileSample(pairs), stream]:
+            sample = Sample(
+                self.sequitur,
+                sizeTemplates,
+                EstimationGraphBuilder.emergeNewMultigrams,
+                sample,
+                model,
+            )
+            evidence, logLik = sample.evidence(model, useMaximumApproximation=False)
+            results.append((logLik, sorted(evidence.asList())))
+        self.assertAlmostEqual(results[0][0], results[1][0])
+        for (h, s, p), (hh, ss, q) in zip(results[0][1], results[1][1]):
+            self.assertEqual(s, ss)
+            self.assertAlmostEqual(p, q)
+
+    def testUpdateSequenceModel(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        context.model.sequenceModel.rampUp()
+        evidence, logLik = Sample(
+            self.sequitur,
+            template.sizeTemplates,
+            EstimationGraphBuilder.suppressNewMultigrams,
+            sample,
+            context.model.sequenceModel,
+        ).evidence(context.model.sequenceModel, False)
+        estimator = evidence.makeSequenceModelEstimator()
+        self.assertEqual(evidence.maximumHistoryLength(), 1)
+
+        discount = [0.3, 0.5]
+        reference = template.sequenceModel(estimator, discount)
+        trial = SequenceModel.SequenceModel()
+        for d in [[0.1, 0.9], discount]:
+            revision = trial.revision()
+            estimator.updateSequenceModel(
+                trial, template.nPossibleMultigrams(), num.array(d)
+            )
+            self.assertNotEqual(trial.revision(), revision)
+
+        tokens = list(range(1, self.sequitur.inventory.size() + 1))
+        for previous in [None] + tokens:
+            hr, ht = reference.initial(), trial.initial()
+            if previous is not None:
+                hr, ht = reference.advanced(hr, previous), trial.advanced(ht, previous)
+            for t in tokens:
+                self.assertAlmostEqual(
+                    reference.probability(t, hr), trial.probability(t, ht)
+                )
+
+    def testStepwise(self):
+        template, sample, context = self.makeTrainingContext(minibatchSize=2)
+        for i in range(3):
+            template.iterate(context)
+        self.assertEqual(len(context.minibatches), 3)
+        self.assertEqual(context.nUpdates, 9)
+        self.assertTrue(
+            min(ev[2] for ev in context.evidence.asList())
+            >= template.stepwiseMinEvidence
+        )
+        self.assertTrue(context.logLikTrain[-1] > context.logLikTrain[0])
+
+    def testRampUpContext(self):
+        template, sample, context = self.makeTrainingContext(
+            minIterations=0, maxIterations=2
+        )
+        template.run(context)
+        self.assertEqual(context.order, 0)
+        newContext = template.rampUpContext(context)
+        self.assertTrue(newContext.trainSample is context.trainSample)
+        self.assertTrue(newContext.trainSample.storedGraphs is None)
+        template.run(newContext)
+        self.assertEqual(newContext.order, 1)
+        self.assertTrue(newContext.bestModel is not None)
+
+    def testEvidencePruning(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        context.model.sequenceModel.rampUp()
+        trainSample = Sample(
+            self.sequitur,
+            template.sizeTemplates,
+            EstimationGraphBuilder.suppressNewMultigrams,
+            sample,
+            context.model.sequenceModel,
+        )
+        full, logLik = trainSample.evidence(context.model.sequenceModel, False)
+        bucketed, bucketedLogLik = trainSample.evidence(
+            context.model.sequenceModel, False, threshold=0.1
+        )
+        self.assertAlmostEqual(logLik, bucketedLogLik)
+        self.assertTrue(bucketed.size() < full.size())
+        self.assertAlmostEqual(bucketed.total(), full.total())
+
+        total, size = full.total(), full.size()
+        nRemoved = full.prune(0.5)
+        self.assertTrue(nRemoved > 0)
+        self.assertEqual(full.size(), size - nRemoved)
+        self.assertTrue(full.total() <= total)
+        self.assertTrue(min(ev[2] for ev in full.asList()) >= 0.5)
+
+    def testPrune(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        context.model.rampUp()
+        context = template.makeContext(sample, None, context.model)
+        context.log = self.nullLog()
+        template.iterate(context)
+        model = context.model
+        vocabularySize = template.nPossibleMultigrams()
+        unseen = self.sequitur.inventory.size() + 1
+
+        def total(history):
+            return sum(
+                model.sequenceModel.probability(w, history)
+                for w in range(1, unseen)
+            ) + model.sequenceModel.probability(unseen, history) * (
+                vocabularySize - unseen + 1
+            )
+
+        oldSize, newSize = model.prune(0.0)
+        self.assertEqual(oldSize, newSize)
+        oldSize, newSize = model.prune(0.1)
+        self.assertTrue(newSize < oldSize)
+        history = model.sequenceModel.initial()
+        self.assertAlmostEqual(total(history), 1.0)
+        for history, predicted, score in model.sequenceModel.get():
+            self.assertTrue(score < float("inf"))
+        for w in range(1, unseen):
+            self.assertAlmostEqual(
+                total(model.sequenceModel.advanced(model.sequenceModel.initial(), w)),
+                1.0,
+            )
+
+    def testQuantize(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        sm = context.model.sequenceModel
+        data = sm.get()
+        history = sm.initial()
+        tokens = [predicted for h, predicted, score in data if predicted is not None]
+        memoryUsed = sm.memoryUsed()
+        pickleSize = len(pickle.dumps(sm))
+        sm.quantize(2)
+        self.assertEqual(sm.quantization(), 2)
+        quantized = sm.get()
+        self.assertEqual(len(quantized), len(data))
+        scores = set(score for h, predicted, score in quantized if predicted is not None)
+        self.assertTrue(len(scores) <= 4)
+        for h, predicted, score in quantized:
+            if predicted is not None:
+                self.assertAlmostEqual(
+                    sm.probability(predicted, history), math.exp(-score)
+                )
+        self.assertTrue(sm.memoryUsed() < memoryUsed)
+
+        self.assertTrue(len(pickle.dumps(sm)) < pickleSize)
+        restored = pickle.loads(pickle.dumps(sm))
+        self.assertEqual(restored.quantization(), 2)
+        self.assertEqual(restored.codebook(), sm.codebook())
+        self.assertEqual(set(restored.get()), set(quantized))
+
+        quantizedMemoryUsed = sm.memoryUsed()
+        sm.set(data)
+        sm.quantize(16)
+        self.assertTrue(sm.memoryUsed() > quantizedMemoryUsed)
+        for token in tokens:
+            self.assertAlmostEqual(
+                sm.probability(token, history),
+                dict((p, math.exp(-s)) for h, p, s in data)[token],
+            )
+
+    def testParallelEstimation(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        context.model.sequenceModel.rampUp()
+        evidence, logLik = Sample(
+            self.sequitur,
+            template.sizeTemplates,
+            EstimationGraphBuilder.suppressNewMultigrams,
+            sample,
+            context.model.sequenceModel,
+        ).evidence(context.model.sequenceModel, False)
+        discount = num.array([0.3, 0.5])
+        models = []
+        for nThreads in [1, 3]:
+            estimator = evidence.makeSequenceModelEstimator(nThreads)
+            sm = SequenceModel.SequenceModel()
+            estimator.makeSequenceModel(sm, template.nPossibleMultigrams(), discount)
+            models.append(set(sm.get()))
+        self.assertEqual(models[0], models[1])
+
+    def testLogLikGradient(self):
+        template, sample, context = self.makeTrainingContext()
+        template.iterate(context)
+        context.model.sequenceModel.rampUp()
+        evidence, logLik = Sample(
+            self.sequitur,
+            template.sizeTemplates,
+            EstimationGraphBuilder.suppressNewMultigrams,
+            sample,
+            context.model.sequenceModel,
+        ).evidence(context.model.sequenceModel, False)
+        estimator = evidence.makeSequenceModelEstimator()
+        develSample = Sample(
+            self.sequitur,
+            template.sizeTemplates,
+            EstimationGraphBuilder.suppressNewMultigrams,
+            self.sequitur.compileSample(
+                [(tuple(w), tuple(w.upper())) for w in ["cba", "abb", "ca"]]
+            ),
+            context.model.sequenceModel,
+        )
+
+        def logLik(discount):
+            sm = SequenceModel.SequenceModel()
+            estimator.updateSequenceModel(
+                sm, template.nPossibleMultigrams(), num.array(discount)
+            )
+            return sm, develSample.logLik(sm, False)
+
+        discount = num.array([0.3, 0.5])
+        sm, ll = logLik(discount)
+        posteriors, develLogLik = develSample.evidence(
+            sm, False, shouldAcceptAnonymized=True
+        )
+        self.assertAlmostEqual(ll, develLogLik)
+        gradient = estimator.logLikGradient(posteriors)
+        self.assertEqual(len(gradient), 2)
+        h = 1e-5
+        for k in range(2):
+            step = num.zeros(2)
+            step[k] = h
+            numeric = (logLik(discount + step)[1] - logLik(discount - step)[1]) / (2 * h)
+            self.assertAlmostEqual(gradient[k], numeric, places=4)
+
     def testAbcMonoGrams(self):
         return
 